@@ -0,0 +1,286 @@
+"""
+分析エンジンの HTTP/JSON API（Streamlit を使わない別の入口）
+
+    python api_server.py --port 8080
+
+  POST   /v1/sessions                 会話を作る（{"messages": [...]} で保存した履歴から再開）
+  GET    /v1/sessions/{id}            会話のメッセージを返す
+  DELETE /v1/sessions/{id}            会話を消す
+  POST   /v1/sessions/{id}/messages   質問する（JSON または multipart。"stream": true で NDJSON を順に返す）
+  GET    /healthz                     死活監視
+
+会話は config.SESSION_DB_PATH の SQLite に1件ずつ書き込むため、再起動後も同じIDで続けられる
+（同じ会話を複数プロセスで同時に扱うときは、ロードバランサーで同じプロセスに振り分ける）。
+毎回 "messages" を付けて送れば、サーバーに状態は残らない。
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+import config
+import engine
+import evidence_store
+import session_store
+
+# ==============================================================================
+# 会話の保管（プロセス内・上限つき。古いものから消す。消えた会話は保存先から読み戻す）
+# ==============================================================================
+
+
+class SessionRegistry:
+    def __init__(self, max_sessions, ttl, backing=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.backing = backing          # session_store.SessionStore（None ならメモリ上だけ）
+        self._items = OrderedDict()     # ID → (Session, 最終利用時刻, 実行中ロック)
+        self._lock = threading.Lock()
+
+    def create(self, messages=None):
+        session = engine.Session(messages=messages, store=self.backing)
+        with self._lock:
+            self._items[session.session_id] = (session, time.time(), asyncio.Lock())
+            self._evict()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._items.get(session_id)
+            if entry is None:
+                if self.backing is None or not self.backing.exists(session_id):
+                    return None, None
+                entry = (engine.Session(session_id, store=self.backing), None, asyncio.Lock())
+            session, _, lock = entry
+            self._items[session_id] = (session, time.time(), lock)
+            self._items.move_to_end(session_id)
+            self._evict()
+            return session, lock
+
+    def delete(self, session_id):
+        """会話と、その会話で送った資料（索引・抽出結果・録音）を消す。"""
+        with self._lock:
+            entry = self._items.pop(session_id, None)
+        session = entry[0] if entry is not None else None
+        if session is None and self.backing is not None and self.backing.exists(session_id):
+            session = engine.Session(session_id, store=self.backing)
+        if session is not None:
+            session.delete_evidence()
+        else:
+            # メモリから追い出された会話でも、資料の索引は消しておく
+            evidence_store.delete_session(session_id)
+        if self.backing is not None and self.backing.exists(session_id):
+            self.backing.delete_session(session_id)
+        return session is not None
+
+    def _evict(self):
+        now = time.time()
+        while self._items:
+            session_id, (_, used, _) = next(iter(self._items.items()))
+            if len(self._items) <= self.max_sessions and now - used < self.ttl:
+                break
+            del self._items[session_id]
+
+
+# ==============================================================================
+# 入出力
+# ==============================================================================
+def _json_error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+def _read_messages(value):
+    """送られてきた履歴を、保存した履歴ファイルと同じ形式チェックにかける（正しくなければ ValueError）。"""
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        raise ValueError("messages が配列ではありません")
+    if len(value) > config.HISTORY_MAX_MESSAGES:
+        raise ValueError(f"メッセージが多すぎます（上限 {config.HISTORY_MAX_MESSAGES:,} 件）")
+    return [session_store.validate_message(message, index) for index, message in enumerate(value)]
+
+
+def _read_files(value):
+    uploads = []
+    if not isinstance(value, list):
+        raise ValueError("files が配列ではありません")
+    for index, f in enumerate(value):
+        if not (isinstance(f, dict) and isinstance(f.get("name"), str) and isinstance(f.get("data"), str)
+                and isinstance(f.get("mime_type", ""), str)):
+            raise ValueError(f"{index + 1}件目の files の形式が正しくありません")
+        uploads.append(engine.Upload(base64.b64decode(f["data"], validate=True), f["name"],
+                                     f.get("mime_type", "application/octet-stream")))
+    return uploads
+
+
+async def _read_json(request):
+    body = await request.json()
+    if not isinstance(body, dict):
+        raise ValueError("JSON のオブジェクトではありません")
+    return body
+
+
+async def _read_request(request):
+    """質問と添付ファイルを取り出す。JSON の files は {"name", "mime_type", "data"(base64)} の配列。"""
+    if request.content_type.startswith("multipart/"):
+        fields, uploads = {}, []
+        async for part in await request.multipart():
+            if part.filename:
+                data = await part.read(decode=True)
+                mime_type = part.headers.get("Content-Type", "application/octet-stream")
+                uploads.append(engine.Upload(bytes(data), part.filename, mime_type))
+            else:
+                fields[part.name] = await part.text()
+        body = dict(fields)
+        body["stream"] = fields.get("stream") in ("1", "true")
+        if "messages" in fields:
+            body["messages"] = _read_messages(json.loads(fields["messages"]))
+        return body, uploads
+    body = await _read_json(request)
+    body["messages"] = _read_messages(body.get("messages"))
+    return body, _read_files(body.get("files", []))
+
+
+def _event_json(event, session, stateless):
+    if event.kind == "wait":
+        return {"type": "wait", **event.data._asdict()}
+    if event.kind in ("notice", "chunk"):
+        return {"type": event.kind, "text": event.data}
+    data = {"type": event.kind, **event.data, "session_id": session.session_id}
+    if stateless and event.kind == "done":
+        # 状態を持たない呼び出しでは、次の質問で送り返す履歴を返す
+        data["messages"] = session.messages
+    return data
+
+
+def _run_in_thread(loop, queue, session, prompt, uploads):
+    """エンジンはブロッキングで動くため、スレッドで回してイベントをイベントループへ渡す。"""
+
+    def on_wait(status):
+        loop.call_soon_threadsafe(queue.put_nowait, engine.Event("wait", status))
+
+    def worker():
+        try:
+            for event in engine.run_turn(session, prompt, uploads, on_wait=on_wait):
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    return loop.run_in_executor(None, worker)
+
+
+# ==============================================================================
+# ルーティング
+# ==============================================================================
+routes = web.RouteTableDef()
+
+
+@routes.get("/healthz")
+async def healthz(request):
+    return web.json_response({"status": "ok"})
+
+
+@routes.post("/v1/sessions")
+async def create_session(request):
+    try:
+        messages = _read_messages((await _read_json(request)).get("messages")) if request.can_read_body else None
+    except ValueError as e:
+        return _json_error(400, f"リクエストを読めませんでした: {e}")
+    session = request.app["sessions"].create(messages)
+    return web.json_response({"session_id": session.session_id, "messages": session.messages}, status=201)
+
+
+@routes.get("/v1/sessions/{session_id}")
+async def get_session(request):
+    session, _ = request.app["sessions"].get(request.match_info["session_id"])
+    if session is None:
+        return _json_error(404, "会話が見つかりません")
+    return web.json_response({"session_id": session.session_id, "messages": session.messages})
+
+
+@routes.delete("/v1/sessions/{session_id}")
+async def delete_session(request):
+    if not request.app["sessions"].delete(request.match_info["session_id"]):
+        return _json_error(404, "会話が見つかりません")
+    return web.Response(status=204)
+
+
+@routes.post("/v1/sessions/{session_id}/messages")
+async def post_message(request):
+    try:
+        body, uploads = await _read_request(request)
+    except (ValueError, KeyError) as e:
+        return _json_error(400, f"リクエストを読めませんでした: {e}")
+    prompt = body.get("prompt") or ""
+    if not isinstance(prompt, str):
+        return _json_error(400, "prompt が文字列ではありません")
+    prompt = prompt.strip()
+    if not prompt:
+        return _json_error(400, "prompt がありません")
+
+    stateless = body.get("messages") is not None
+    if stateless:
+        # 状態を持たない呼び出し：送られてきた履歴で一時的な会話を作る
+        session, lock = engine.Session(session_id=request.match_info["session_id"], messages=body["messages"]), asyncio.Lock()
+    else:
+        session, lock = request.app["sessions"].get(request.match_info["session_id"])
+        if session is None:
+            return _json_error(404, "会話が見つかりません")
+
+    # 同じ会話の質問は1件ずつ順に処理する
+    async with lock:
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        task = _run_in_thread(loop, queue, session, prompt, uploads)
+
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson; charset=utf-8"})
+            await response.prepare(request)
+            while (event := await queue.get()) is not None:
+                line = json.dumps(_event_json(event, session, stateless), ensure_ascii=False) + "\n"
+                await response.write(line.encode("utf-8"))
+            await task
+            await response.write_eof()
+            return response
+
+        notices, final = [], None
+        while (event := await queue.get()) is not None:
+            if event.kind == "notice":
+                notices.append(event.data)
+            elif event.kind in ("done", "error"):
+                final = event
+        await task
+
+    if final.kind == "error":
+        status = 429 if final.data["category"] in ("queue_full", "rate_limited") else 502
+        return web.json_response({**_event_json(final, session, stateless), "notices": notices}, status=status)
+    return web.json_response({**_event_json(final, session, stateless), "notices": notices})
+
+
+def create_app():
+    app = web.Application(client_max_size=config.API_MAX_UPLOAD_BYTES)
+    app["sessions"] = SessionRegistry(config.API_MAX_SESSIONS, config.API_SESSION_TTL, session_store.get_store())
+    app.add_routes(routes)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="いじめ対応支援AI の HTTP/JSON API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--api-key", help="Gemini APIキー（省略時は環境変数 GEMINI_API_KEY）")
+    args = parser.parse_args(argv)
+
+    api_key = args.api_key or os.environ.get("GEMINI_API_KEY")
+    if api_key:
+        engine.configure(api_key)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
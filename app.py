@@ -1,16 +1,15 @@
+import time
+
 import streamlit as st
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import pandas as pd
-from PIL import Image
-import pypdf
-import json
 
-# law_data.py からテキストを読み込む
-try:
-    from law_data import PROMPT_TEXT
-except ImportError:
-    PROMPT_TEXT = "（法律データファイル law_data.py が見つかりませんでした。）"
+# 分析の本体（証拠資料の取り込み・プロンプト組み立て・AI呼び出し）は engine.py にまとめてある
+import chat_view
+import config
+import engine
+import evidence_store
+import jobs
+import metrics
+import session_store
 
 # ページ設定
 st.set_page_config(
@@ -32,121 +31,45 @@ st.markdown("""
 
 # APIキーの設定
 try:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    engine.configure(st.secrets["GEMINI_API_KEY"])
 except:
     st.error("APIキー設定エラー：Streamlit CloudのSecretsを確認してください。")
 
-# ==============================================================================
-# 1. ページ数・URL対応表
-# ==============================================================================
-REFERENCE_MAP = """
-【重要資料のページ数・URL対応表】
-AIは回答時に、以下の情報を参照して「該当ページ数」と「URL」を必ず提示してください。
-
-■いじめの重大事態の調査に関するガイドライン（令和6年8月改訂版）
-https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
-[ページ目安] P.1(基本的姿勢), P.2(重大事態定義), P.4(報告義務), P.15(公表)
-
-■いじめ防止対策推進法（条文）
-https://elaws.e-gov.go.jp/document?lawid=425AC1000000071
-[ページ目安] 第22条(組織), 第23条(通報義務), 第28条(重大事態)
-
-■いじめの防止等のための基本的な方針（平成29年改定）
-https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
-[ページ目安] P.3(定義), P.12(解消定義), P.15(抱え込み禁止)
-
-■こども基本法
-https://elaws.e-gov.go.jp/document?lawid=504AC1000000077
-[ページ目安] 第3条(意見表明・最善の利益), 第11条(意見の反映)
-
-■学校における個人情報の取扱いQ&A（黒塗り対策）
-https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
-[ページ目安] いじめ防止基本方針のP.15〜18付近、またはガイドライン参照
-
-■不登校支援・教育機会確保法（出席扱い等）
-https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
-[ページ目安] 令和元年10月25日通知「不登校児童生徒への支援の在り方について」
-"""
-
-# ==============================================================================
-# 2. システムプロンプト
-# ==============================================================================
-SYSTEM_INSTRUCTION = f"""
-あなたは、いじめ被害児童とその家族を守るための「法務・教育行政アドバイザーAI」です。
-ユーザーと継続的な対話を行い、学校側の対応に違法性がないかチェックしてください。
-
-【重要：URLの出力について】
-根拠資料を提示する際、「入手先URL」の欄には必ず「https://」から始まる実際のURLをそのまま出力してください。「〜を参照」という説明だけで終わらせず、ユーザーがタップして飛べるようにURL文字列を明記すること。
-
-【重要：記憶と履歴について】
-あなたは、現在提供されている「会話履歴（Context）」を、自分自身の「記憶」として扱ってください。
-ユーザーが「前回話した内容は？」や「さっきの資料は？」と質問した場合、「記憶がありません」と答えるのではなく、履歴にある情報を読み返して回答してください。
-
-【あなたの役割】
-1. **証拠の解析**: 提示されたPDF、音声、画像の内容を読み取る。
-2. **法的指摘**: 学校の対応の不備を指摘する。
-3. **視覚的強調**: 根拠となる資料とページ数を、罫線を使って大きく表示する。
-4. **対話の維持**: ユーザーの追加質問にも、過去の文脈（資料内容など）を踏まえて回答する。
-
----
-【参照すべき法律知識 (law_data.py)】
-{PROMPT_TEXT}
-
-【ページ数・URLリスト (REFERENCE_MAP)】
-{REFERENCE_MAP}
----
-
-【出力フォーマット（この形式を厳守！）】
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-
-　📖 **根拠資料**
-　**[資料名]**
-
-　📍 **該当箇所**
-　**【 第〇条 第〇項 】** （または P.〇〇）
-　※条文の場合は必ず「第何項」まで特定すること！
-
-　🔗 **入手先URL**
-　[ここに必ず https:// から始まるURLを直接記載する]
-　※「ガイドライン」等は「ページ内の【PDF】を開いてください」と添える
-
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-> **内容:** 「......」
-
-**解説:** ...
-"""
-
-# 安全フィルターの完全解除
-safety_settings = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-}
-
 # ---------------------------------------------------------
 # セッション管理
 # ---------------------------------------------------------
 
-# 1. モデルの準備
-if "model" not in st.session_state:
-    st.session_state.model = genai.GenerativeModel(
-        model_name="gemini-flash-latest",  # ← 以前動いたこの名前に戻します
-        system_instruction=SYSTEM_INSTRUCTION,
-        safety_settings=safety_settings
+# 1. 会話（メッセージ・送信済みの添付資料・順番待ち用のID）。モデルは engine 側で全セッション共通
+#    会話のIDをURL（?sid=...）に載せ、サーバーの再起動やページの再読み込みの後も保存先から続きを開く
+#    分析中のジョブがあれば、その会話につなぎ直す（ページを読み込み直しても処理は続いている）
+#    URL の会話IDは、このブラウザに発行したもの（クッキーの署名が合う）で、実際にある会話のときだけ開く。
+#    知らないIDや他人から渡されたリンクのIDは使わず、新しい会話にする（URL を知っているだけでは読めない）
+if "session" not in st.session_state:
+    sid = st.query_params.get("sid")
+    resumed = None
+    if session_store.can_resume(sid, st.context.cookies.get(session_store.SESSION_COOKIE)):
+        running = jobs.get_manager().get(sid)
+        store = session_store.get_store()
+        if running is not None:
+            resumed = running.session
+        elif store is not None and store.exists(sid):
+            resumed = engine.open_session(sid)
+    st.session_state.session = resumed or engine.open_session()
+session = st.session_state.session
+if st.query_params.get("sid") != session.session_id:
+    st.query_params["sid"] = session.session_id
+if st.session_state.get("session_cookie") != session.session_id:
+    # 署名はクッキーだけに入れる（Streamlit からは HttpOnly を付けられないため、同じサイトだけに送る設定にする）
+    st.session_state.session_cookie = session.session_id
+    st.html(
+        "<script>document.cookie = "
+        f"'{session_store.SESSION_COOKIE}={session_store.session_token(session.session_id)}; path=/; "
+        f"max-age={config.SESSION_RETENTION_DAYS * 86400}; SameSite=Strict'"
+        " + (location.protocol === 'https:' ? '; Secure' : '');</script>",
+        unsafe_allow_javascript=True,
     )
 
-# 2. 画面表示用の履歴初期化
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-    st.session_state.messages.append({
-        "role": "assistant",
-        "content": "こんにちは。学校の対応について、法律やガイドラインに基づいた分析を行います。\n証拠資料（PDF、録音、写真など）があればアップロードしてください。"
-    })
-
-# 3. アップローダーのリセット用キー
+# 2. アップローダーのリセット用キー
 if "uploader_key" not in st.session_state:
     st.session_state["uploader_key"] = 0
 
@@ -166,76 +89,98 @@ with st.expander("📂 証拠資料をアップロードする（PDF・音声・
             st.session_state["uploader_key"] += 1
             st.rerun()
 
+# ---------------------------------------------------------
+# 資料の中を検索（この会話で送った資料の索引。AIに送る抜粋と同じ索引を使う）
+# ---------------------------------------------------------
+evidence = evidence_store.get_store(session.session_id)
+searchable = [] if evidence is None else evidence.searchable_digests(list(session.sent_attachments))
+if searchable:
+    with st.expander("🔎 送った資料の中を検索する"):
+        query = st.text_input("探したい言葉（例：いつ学校に報告したか）", key="evidence_query")
+        if query:
+            results = evidence.search(query, config.EVIDENCE_TOP_K, searchable)
+            if not results:
+                st.info("見つかりませんでした。言葉を変えてお試しください。")
+            for passage in results:
+                st.markdown(f"**📄 {passage.name}**　{passage.location}")
+                st.caption(evidence_store.snippet(passage.text, query))
+
 # ---------------------------------------------------------
 # チャット履歴表示
 # ---------------------------------------------------------
-for message in st.session_state.messages:
+# 分析はバックグラウンドのジョブで動く（画面の再実行で処理が捨てられない）。処理中のやり取りは下で別に表示する
+job = jobs.get_manager().get(session.session_id)
+active = job is not None and not job.finished
+messages = session.messages[:job.base] if active else session.messages
+
+# 直近のやり取りだけをそのまま表示し、古いやり取りはページごとに折りたたむ（開いたページだけ描画する）
+pages, recent_start = chat_view.layout(messages, config.CHAT_RECENT_TURNS, config.CHAT_PAGE_TURNS)
+for page in pages:
+    expander = st.expander(chat_view.page_label(messages, page), key=f"history_page_{page[0]}", on_change="rerun")
+    if expander.open:
+        with expander:
+            st.markdown(chat_view.page_markdown(messages, page[0], page[1]))
+
+for message in messages[recent_start:]:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
 # ---------------------------------------------------------
-# チャット入力処理
+# 分析ジョブの進み具合
 # ---------------------------------------------------------
-if prompt := st.chat_input("相談内容を入力してください..."):
-    
-    with st.chat_message("user"):
-        st.markdown(prompt)
-    st.session_state.messages.append({"role": "user", "content": prompt})
+def show_error(error):
+    if error["level"] == "warning":
+        st.warning(error["message"])
+    else:
+        st.error(error["message"])
 
-    with st.chat_message("assistant"):
-        with st.spinner("分析中..."):
-            try:
-                # 記憶の再構築（同期処理）
-                history_for_gemini = []
-                for msg in st.session_state.messages[:-1]:
-                    role = "user" if msg["role"] == "user" else "model"
-                    if msg["content"]:
-                        history_for_gemini.append({"role": role, "parts": [msg["content"]]})
-                
-                chat = st.session_state.model.start_chat(history=history_for_gemini)
 
-                # 送信コンテンツの準備
-                content_parts = [prompt]
-                
-                if uploaded_files:
-                    for uploaded_file in uploaded_files:
-                        file_type = uploaded_file.type
-                        if "pdf" in file_type:
-                            try:
-                                reader = pypdf.PdfReader(uploaded_file)
-                                pdf_text = "".join([page.extract_text() for page in reader.pages])
-                                content_parts.append(f"【参照資料(PDF)】\n{pdf_text}")
-                            except: st.error("PDF読込エラー")
-                        elif "image" in file_type:
-                            content_parts.append(Image.open(uploaded_file))
-                        elif "audio" in file_type:
-                            content_parts.append({"mime_type": file_type, "data": uploaded_file.read()})
-                        elif "spreadsheet" in file_type or "csv" in file_type or "excel" in file_type:
-                            try:
-                                df = pd.read_csv(uploaded_file) if "csv" in file_type else pd.read_excel(uploaded_file)
-                                content_parts.append(f"【参照データ】\n{df.to_string()}")
-                            except: st.error("表読込エラー")
+def wait_message(status):
+    if status.retry_in is not None:
+        return f"⏳ 混雑しているため、{status.retry_in:.0f}秒後に自動で再送します（{status.attempt}回目）"
+    return f"⏳ 順番待ちです（あと{status.position}番目）。このままお待ちください。"
 
-                # AIへ送信
-                response = chat.send_message(
-                    content_parts,
-                    generation_config={"temperature": 0.0},
-                    safety_settings=safety_settings
-                )
-                
-                st.markdown(response.text)
-                st.session_state.messages.append({"role": "assistant", "content": response.text})
 
-            except Exception as e:
-                error_msg = str(e)
-                if "429" in error_msg or "ResourceExhausted" in error_msg:
-                    st.warning("⚠️ **現在、アクセスが集中しています**\n\n1分ほど時間を空けてから、もう一度入力してください。")
-                elif "500" in error_msg or "Internal error" in error_msg:
-                    st.warning("⚠️ **一時的なサーバーエラーです**\n\nGoogleのAIサーバー側で一時的な不具合が発生しました。少し時間を置いてからもう一度お試しください。")
-                elif "finish_reason" in error_msg and "1" in error_msg:
-                    st.error("⚠️ **回答できませんでした**\n\nAIの安全フィルターにより回答が中断されました。言い回しを変えて再度お試しください。")
-                else:
-                    st.error(f"システムエラーが発生しました: {e}")
+@st.fragment(run_every=config.JOB_POLL_SECONDS)
+def show_job(job):
+    # この部分だけを一定間隔で描き直す。終わったら画面全体を描き直し、回答を履歴として表示する
+    if job.finished:
+        st.rerun()
+    with st.chat_message("user"):
+        st.markdown(job.prompt)
+    with st.chat_message("assistant"):
+        for notice in job.notices:
+            st.error(notice)
+        if job.wait is not None:
+            st.info(wait_message(job.wait))
+        else:
+            stage = engine.STAGES.get(job.stage, "分析の順番を待っています")
+            st.info(f"⏳ {stage}…（{job.elapsed:.0f}秒）")
+        if job.chunks:
+            st.markdown(job.text)
+        if st.button("⏹️ 分析を取り消す", key=f"cancel_{job.job_id}"):
+            job.cancel()
+
+
+if active:
+    show_job(job)
+elif job is not None and not job.reported:
+    # 終わったジョブの資料の読込エラー・失敗の案内は、終わった直後に一度だけ表示する
+    job.reported = True
+    if job.status == "done":
+        # 表示：ジョブが終わってから、回答を含む画面全体を描き終えるまで（進み具合の確認の間隔・再実行を含む）
+        metrics.record_after(session.session_id, "render", time.monotonic() - job.finished_at)
+    for notice in job.notices:
+        st.error(notice)
+    if job.error is not None:
+        show_error(job.error)
+
+# ---------------------------------------------------------
+# チャット入力処理
+# ---------------------------------------------------------
+if prompt := st.chat_input("相談内容を入力してください...", disabled=active):
+    jobs.get_manager().submit(session, prompt, uploaded_files)
+    st.rerun()
 
 # ---------------------------------------------------------
 # サイドバー（保存・読込・リセット）
@@ -244,22 +189,21 @@ with st.sidebar:
     st.header("💾 履歴の保存・読込")
     st.caption("相談内容を自分の端末に保存して、後で続きから再開できます。")
 
-    chat_history_json = json.dumps(st.session_state.messages, ensure_ascii=False, indent=2)
+    # 保存ファイル（gzip 圧縮）はボタンが押されたときだけ作る
     st.download_button(
         label="📥 今日の相談履歴を保存",
-        data=chat_history_json,
-        file_name="ijime_soudan_history.json",
-        mime="application/json"
+        data=lambda: session_store.export_history(session.messages),
+        file_name="ijime_soudan_history.json.gz",
+        mime="application/gzip"
     )
 
     st.divider()
 
-    uploaded_history = st.file_uploader("📤 過去の履歴を読み込む", type=["json"])
+    uploaded_history = st.file_uploader("📤 過去の履歴を読み込む", type=["json", "gz"])
     if uploaded_history is not None:
-        if st.button("🔄 読み込みを実行する"):
+        if st.button("🔄 読み込みを実行する", disabled=active):
             try:
-                uploaded_history.seek(0)
-                st.session_state.messages = json.load(uploaded_history)
+                session.load(session_store.read_history(uploaded_history))
                 st.session_state.show_load_success = True
                 st.rerun()
             except Exception as e:
@@ -267,10 +211,6 @@ with st.sidebar:
 
     st.divider()
 
-    if st.button("🗑️ 会話履歴をリセット"):
-        st.session_state.messages = []
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": "こんにちは。学校の対応について、法律やガイドラインに基づいた分析を行います。\n証拠資料（PDF、録音、写真など）があればアップロードしてください。"
-        })
+    if st.button("🗑️ 会話履歴をリセット", disabled=active):
+        session.reset()
         st.rerun()
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""
+事前計算したデータの作成（コンテナのビルド時などに1回実行しておく）
+
+    python artifacts.py
+
+法律データの索引（law_index）・検索索引（BM25）・引用チェックと条文の直接表示に使う表を
+config.ARTIFACT_DIR に保存する。
+実行しなくても、最初に起動したプロセスが作って保存する。
+"""
+import glob
+import hashlib
+import os
+import pickle
+import stat
+import sys
+import tempfile
+
+import config
+
+# ==============================================================================
+# 事前計算したデータの保存と読み込み（起動を速くするため）
+# 毎回同じ結果になる前処理はファイルに保存し、次の起動からは読み込むだけにする。
+# 元になるソースファイルの中身が変わったら、別のファイル名で作り直す。
+# ==============================================================================
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _key(name, sources):
+    digest = hashlib.sha256(f"{name}\n{sys.version}".encode("utf-8"))
+    for source in sources:
+        with open(os.path.join(HERE, source), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def path_for(name, sources):
+    return os.path.join(config.ARTIFACT_DIR, f"{name}-{_key(name, sources)}.pickle")
+
+
+def _private_dir(directory, create):
+    # evidence_store は retrieval を読み込むので、使うときに読み込む（先に読み込むと循環する）
+    import evidence_store
+    return evidence_store.private_dir(directory, create)
+
+
+def _open_private(path):
+    """本人が作り、本人しか書き換えられない通常のファイルだけを開く（ほかのユーザーが置いた pickle は読まない）。"""
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    info = os.fstat(fd)
+    if (not stat.S_ISREG(info.st_mode) or (hasattr(os, "getuid") and info.st_uid != os.getuid())
+            or stat.S_IMODE(info.st_mode) & 0o022):
+        os.close(fd)
+        raise PermissionError(f"本人だけが書き換えられるファイルではありません: {path}")
+    return os.fdopen(fd, "rb")
+
+
+def _save(path, name, value):
+    directory = os.path.dirname(path)
+    _private_dir(directory, create=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # 同時に起動した別プロセスと重なっても、どちらかの完成したファイルだけが残る
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    for old in glob.glob(os.path.join(directory, f"{name}-*.pickle")):
+        if old != path:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def load_or_build(name, sources, build):
+    """
+    保存済みの name があれば読み込み、なければ build() で作って保存する。
+    sources（このフォルダからの相対パス）の中身が変わると作り直す。ARTIFACT_DIR が空なら毎回作る。
+    """
+    if not config.ARTIFACT_DIR:
+        return build()
+    path = path_for(name, sources)
+    try:
+        if _private_dir(config.ARTIFACT_DIR, create=False):
+            with _open_private(path) as f:
+                return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, OSError) as e:
+        # 途中で壊れたファイル・ほかのユーザーのフォルダやファイルは読まずに作り直す
+        print(f"保存済みの {name} を使わずに作り直します: {e}", file=sys.stderr)
+    value = build()
+    try:
+        _save(path, name, value)
+    except OSError:
+        # 書き込めない環境（本人だけのフォルダを用意できない場合も）では保存せずに動く
+        pass
+    return value
+
+
+def main():
+    if not config.ARTIFACT_DIR:
+        print("IJIME_ARTIFACT_DIR が空のため保存しません", file=sys.stderr)
+        return 1
+    import citations
+    import law_index
+    import lookup
+    import retrieval
+    law_index.get_index()
+    retrieval.get_retriever("bm25")
+    citations.get_matcher()
+    lookup.get_table()
+    for path in sorted(glob.glob(os.path.join(config.ARTIFACT_DIR, "*.pickle"))):
+        print(f"{path}  {os.path.getsize(path) / 1024:,.0f} KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
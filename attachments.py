@@ -0,0 +1,295 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import audio
+import config
+import evidence_store
+import images
+import metrics
+import pdf_extract
+import spreadsheet
+import workers
+
+# ==============================================================================
+# 添付ファイルの処理とキャッシュ
+# ファイルの中身（SHA-256）をキーに、抽出結果を1回だけ作って使い回す。
+# 会話ごとに「送信済み」の資料を記録し、追加の質問では新しい資料だけを送る。
+# 本文が資料の索引（evidence_store）にある資料は、以降のターンの履歴では名前だけにし、中身は質問ごとの抜粋で送る。
+# ==============================================================================
+
+# kind: "pdf" / "image" / "audio" / "table" / "other"
+# parts: send_message に渡す部品、text: 条文検索などに使う抽出テキスト（画像・音声は None）
+# fingerprint: 画像の知覚ハッシュ（ほぼ同じ写真の判定用。画像以外は None）
+ProcessedAttachment = namedtuple(
+    "ProcessedAttachment",
+    ["digest", "name", "mime_type", "kind", "parts", "text", "error", "fingerprint"],
+    defaults=[None],
+)
+
+
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def stream_digest(stream, chunk_size=audio.READ_CHUNK):
+    # 大きな録音もメモリに丸ごと載せずにハッシュを取る
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def attachment_kind(mime_type):
+    if "pdf" in mime_type:
+        return "pdf"
+    if "image" in mime_type:
+        return "image"
+    if "audio" in mime_type:
+        return "audio"
+    if "spreadsheet" in mime_type or "csv" in mime_type or "excel" in mime_type:
+        return "table"
+    return "other"
+
+
+class AttachmentCache:
+    """
+    プロセス共通のLRUキャッシュ。中身が同じファイルは誰がアップロードしても同じ結果になる。
+    backing（session_store.SessionStore）があれば、LRUから消えた資料もそこから読み戻す。
+    """
+
+    def __init__(self, max_entries, backing=None):
+        self.max_entries = max_entries
+        self.backing = backing
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            item = self._items.get(digest)
+            if item is not None:
+                self._items.move_to_end(digest)
+                return item
+        if self.backing is None:
+            return None
+        item = self.backing.get_attachment(digest)
+        if item is not None:
+            self._remember(item)
+        return item
+
+    def put(self, item):
+        self._remember(item)
+        if self.backing is not None:
+            self.backing.put_attachment(item)
+
+    def delete(self, digest):
+        with self._lock:
+            self._items.pop(digest, None)
+        if self.backing is not None:
+            self.backing.delete_attachment(digest)
+
+    def _remember(self, item):
+        with self._lock:
+            self._items[item.digest] = item
+            self._items.move_to_end(item.digest)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+CACHE = AttachmentCache(config.ATTACHMENT_CACHE_SIZE)
+
+
+# ---------------------------------------------------------
+# 種類ごとの抽出
+# ---------------------------------------------------------
+def _extract(digest, name, mime_type, data):
+    kind = attachment_kind(mime_type)
+    try:
+        if kind == "pdf":
+            text, problems = pdf_extract.extract_text(data)
+            note = ""
+            if problems:
+                pages = ", ".join(f"P.{number}" for number, _ in problems)
+                note = f"\n※テキストを読み取れなかったページ: {pages}"
+            return ProcessedAttachment(digest, name, mime_type, kind, [f"【参照資料(PDF)】{name}{note}\n{text}"], text, None)
+        if kind == "image":
+            part, fingerprint = images.preprocess(data)
+            return ProcessedAttachment(digest, name, mime_type, kind, [part], None, None, fingerprint)
+        if kind == "audio":
+            # data はファイルオブジェクト。区間に分けてディスクに置き、送信時に item_parts で組み立てる
+            audio.prepare(data, digest, mime_type)
+            return ProcessedAttachment(digest, name, mime_type, kind, [], None, None)
+        if kind == "table":
+            # 全行は作業プロセスから直接ファイルに書き出し、結果（キャッシュに残るもの）には概要だけを持たせる
+            with evidence_store.spool(digest) as passages:
+                text = spreadsheet.summarize_table(data, mime_type, passages=passages)
+            return ProcessedAttachment(digest, name, mime_type, kind, [f"【参照データ】{name}\n{text}"], text, None)
+    except Exception:
+        return _extract_error(digest, name, mime_type)
+    return ProcessedAttachment(digest, name, mime_type, kind, [], None, None)
+
+
+def _extract_error(digest, name, mime_type):
+    kind = attachment_kind(mime_type)
+    error = "PDF読込エラー" if kind == "pdf" else "表読込エラー" if kind == "table" else f"読込エラー: {name}"
+    return ProcessedAttachment(digest, name, mime_type, kind, [], None, error)
+
+
+def process_upload(uploaded_file):
+    digest = stream_digest(uploaded_file)
+    item = CACHE.get(digest)
+    if item is None:
+        is_audio = attachment_kind(uploaded_file.type) == "audio"
+        data = uploaded_file if is_audio else uploaded_file.getvalue()
+        item = _extract(digest, uploaded_file.name, uploaded_file.type, data)
+        CACHE.put(item)
+    return item
+
+
+def _submit(digest, uploaded_file):
+    # 表の解析は別プロセス、PDFはスレッドから（大きなPDFはさらにページ範囲ごとにプロセスへ）、
+    # 写真・音声はスレッドで処理する
+    name, mime_type = uploaded_file.name, uploaded_file.type
+    kind = attachment_kind(mime_type)
+    if kind == "table":
+        return workers.process_pool().submit(_extract, digest, name, mime_type, uploaded_file.getvalue())
+    data = uploaded_file if kind == "audio" else uploaded_file.getvalue()
+    return workers.thread_pool().submit(_extract, digest, name, mime_type, data)
+
+
+def process_uploads(uploaded_files, timeout=None):
+    """
+    複数の添付ファイルを並列に前処理し、アップロードされた順に ProcessedAttachment を返す。
+    待ち時間は各ファイルの処理時間の合計ではなく最大値になる。制限時間を超えたファイルはエラー扱い。
+    """
+    timeout = config.ATTACHMENT_TIMEOUT if timeout is None else timeout
+    digests = [stream_digest(uploaded_file) for uploaded_file in uploaded_files]
+    items, futures, finished = {}, {}, {}
+    for digest, uploaded_file in zip(digests, uploaded_files):
+        if digest in items or digest in futures:
+            continue
+        item = CACHE.get(digest)
+        if item is not None:
+            items[digest] = item
+        else:
+            try:
+                future = _submit(digest, uploaded_file)
+                # 計測用：受け取る順番に関係なく、各ファイルの処理が終わった時刻を残す
+                future.add_done_callback(lambda _, digest=digest: finished.setdefault(digest, time.monotonic()))
+                futures[digest] = (uploaded_file, future)
+            except Exception:
+                items[digest] = _extract_error(digest, uploaded_file.name, uploaded_file.type)
+
+    # 制限時間は投入した時点から全ファイル共通に数える
+    submitted = time.monotonic()
+    deadline = submitted + timeout
+    for digest, (uploaded_file, future) in futures.items():
+        try:
+            item = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            future.cancel()
+            # タイムアウトはキャッシュしない（次の質問で改めて読み直す）
+            items[digest] = ProcessedAttachment(
+                digest, uploaded_file.name, uploaded_file.type, attachment_kind(uploaded_file.type),
+                [], None, f"読込タイムアウト: {uploaded_file.name}（{timeout:g}秒以内に読み取れませんでした）"
+            )
+            continue
+        except Exception:
+            # 作業プロセスごと落ちた場合など。タイムアウトと同じくキャッシュせず、次の質問で読み直す
+            items[digest] = _extract_error(digest, uploaded_file.name, uploaded_file.type)
+            continue
+        metrics.record("preprocess", finished.get(digest, time.monotonic()) - submitted, kind=item.kind)
+        CACHE.put(item)
+        items[digest] = item
+    return [items[digest] for digest in digests]
+
+
+def item_parts(item):
+    """
+    送信用の部品。音声はアップロード済みの区間を時刻ラベル付きで参照する。
+    大きなPDFは全文の代わりに見出しだけにする（本文は evidence_store から質問ごとに抜粋して送る）。
+    """
+    if item.kind == "audio":
+        return audio.parts_for(item.digest, item.name)
+    if evidence_store.is_excerpted(item):
+        header = item.parts[0][:len(item.parts[0]) - len(item.text)].rstrip("\n")
+        pages = sum(1 for _ in pdf_extract.split_pages(item.text))
+        return [f"{header}\n（全文{pages}ページのうち、質問に関係する箇所（見つからなければ冒頭）を【資料からの抜粋】として送付）"]
+    return item.parts
+
+
+# ---------------------------------------------------------
+# 会話単位の送信管理
+# ---------------------------------------------------------
+def collect_new_evidence(uploaded_files, sent):
+    """
+    まだこの会話で送っていない資料だけを部品にする。
+    sent は {digest: ファイル名}（送信済みの記録。呼び出し側のセッションに保存する）。
+    戻り値: (送信する部品, 抽出テキスト, 新しく送った資料, 読込エラー)
+    """
+    parts, texts, new_items, errors = [], [], [], []
+    already_sent, duplicates = [], []
+    sent_fingerprints = [item.fingerprint for item in (CACHE.get(digest) for digest in sent)
+                         if item is not None and item.fingerprint is not None]
+    for item in process_uploads(uploaded_files or []):
+        if item.error:
+            errors.append(item.error)
+            continue
+        if item.digest in sent:
+            already_sent.append(item.name)
+            continue
+        if item.digest in {new.digest for new in new_items}:
+            continue
+        if item.fingerprint is not None:
+            # 連写などほぼ同じ写真は、最初の1枚だけ送る
+            fingerprints = sent_fingerprints + [new.fingerprint for new in new_items if new.fingerprint is not None]
+            if images.is_near_duplicate(item.fingerprint, fingerprints):
+                duplicates.append(item.name)
+                continue
+        parts.extend(item_parts(item))
+        if item.text:
+            texts.append(item.text)
+        new_items.append(item)
+    if already_sent:
+        names = "\n".join(f"・{name}" for name in already_sent)
+        parts.append(f"【送信済みの資料】以下の資料は以前のやり取りで送付済みです（内容は会話履歴・【資料からの抜粋】を参照）。\n{names}")
+    if duplicates:
+        names = "\n".join(f"・{name}" for name in duplicates)
+        parts.append(f"【同じ内容の写真】以下は送付済みの写真とほぼ同じため省略しました。\n{names}")
+    return parts, texts, new_items, errors
+
+
+def history_parts(message, store=None):
+    """
+    履歴の1メッセージに、そのターンで送った資料を付け直す。
+    store（evidence_store.EvidenceStore）で本文を検索できる資料は名前だけにする（全文は送ったターンの1回だけ。
+    以降は質問に関係する箇所を【資料からの抜粋】で送る）。音声はアップロード済みの区間を参照するだけで送り直さない。
+    キャッシュから消えた資料は名前だけ残す。
+    """
+    parts = [message["content"]] if message["content"] else []
+    for attachment in message.get("attachments", []):
+        item = CACHE.get(attachment["digest"])
+        if store is not None and store.searchable_digests([attachment["digest"]]):
+            parts.append(f"【資料「{attachment['name']}」はこのターンで送付済み（質問に関係する箇所を【資料からの抜粋】として送付）】")
+        elif item is not None:
+            parts.extend(item_parts(item))
+        else:
+            parts.append(f"【資料「{attachment['name']}」はこのターンで送付済み（内容は再送されていません）】")
+    return parts
+
+
+def delete(digests):
+    """資料の抽出結果（キャッシュ・保存先・表の行の書き出し・録音の区間）を消す。会話の削除・やり直しのときに呼ぶ。"""
+    for digest in digests:
+        CACHE.delete(digest)
+        evidence_store.delete_spool(digest)
+        audio.delete(digest)
+
+
+def attachment_records(items):
+    """メッセージに保存する送信記録（JSON保存できる形）。"""
+    return [{"digest": item.digest, "name": item.name} for item in items]
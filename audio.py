@@ -0,0 +1,205 @@
+import os
+import tempfile
+import threading
+import time
+import warnings
+import wave
+from collections import namedtuple
+
+import backends
+import config
+import evidence_store
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+# ==============================================================================
+# 音声の前処理
+# 録音はメモリに丸ごと読まず、少しずつディスクへ書き出してから時間ごとの区間に分ける。
+# 区間はファイルの中身のハッシュで保存し、AIへは1回だけアップロードして以降は参照で送る。
+# 書き出し先は本人だけが使えるフォルダ（ファイルも本人だけが読める）で、保存期間を過ぎたものは消す。
+# ==============================================================================
+
+# start / end は秒（長さが分からない形式では end は None）
+AudioSegment = namedtuple("AudioSegment", ["index", "start", "end", "path", "mime_type"])
+
+READ_CHUNK = 1024 * 1024
+WAV_BLOCK_SECONDS = 10
+EXTENSIONS = {"audio/wav": ".wav", "audio/x-wav": ".wav", "audio/mpeg": ".mp3", "audio/mp4": ".m4a", "audio/x-m4a": ".m4a"}
+
+_lock = threading.Lock()
+_segments = {}      # digest → [AudioSegment]
+_uploads = {}       # 区間のパス → (アップロード済みファイル, アップロード時刻)
+_purged = False
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _cache_dir():
+    global _purged
+    evidence_store.private_dir(config.AUDIO_CACHE_DIR)
+    if not _purged:
+        _purged = True
+        purge(config.SESSION_RETENTION_DAYS)
+    return config.AUDIO_CACHE_DIR
+
+
+def purge(days):
+    """しばらく使われていない録音の書き出しを消す（使うたびに更新時刻を新しくしている）。"""
+    cutoff = time.time() - days * 86400
+    for name in os.listdir(config.AUDIO_CACHE_DIR):
+        path = os.path.join(config.AUDIO_CACHE_DIR, name)
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+    with _lock:
+        for digest in [d for d, segments in _segments.items() if not all(os.path.exists(s.path) for s in segments)]:
+            del _segments[digest]
+
+
+def delete(digest):
+    """録音の書き出しと区間を消す（会話の削除・やり直しのとき）。"""
+    with _lock:
+        segments = _segments.pop(digest, [])
+        for segment in segments:
+            _uploads.pop(segment.path, None)
+    if not os.path.isdir(config.AUDIO_CACHE_DIR):
+        return
+    for name in os.listdir(config.AUDIO_CACHE_DIR):
+        if name.startswith(digest):
+            try:
+                os.remove(os.path.join(config.AUDIO_CACHE_DIR, name))
+            except OSError:
+                pass
+
+
+def _write_atomic(path, write):
+    """本人だけが読める一時ファイルに write(f) で書き、書き終えたら path に置き換える。"""
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+def spool(stream, digest, mime_type):
+    """アップロードされたファイルを少しずつディスクに書き出す（同じ中身なら書き直さない）。"""
+    path = os.path.join(_cache_dir(), digest + EXTENSIONS.get(mime_type, ".audio"))
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        def write(f):
+            stream.seek(0)
+            for chunk in iter(lambda: stream.read(READ_CHUNK), b""):
+                f.write(chunk)
+        _write_atomic(path, write)
+    return path
+
+
+# ---------------------------------------------------------
+# 区間への分割
+# ---------------------------------------------------------
+def _convert(frames, channels, width, rate, state):
+    # モノラル化・16kHz化（audioop が使える環境のみ。使えなければそのまま）
+    if audioop is None or not config.AUDIO_DOWNMIX:
+        return frames, channels, rate, state
+    if channels == 2:
+        frames = audioop.tomono(frames, width, 0.5, 0.5)
+        channels = 1
+    if rate > config.AUDIO_SAMPLE_RATE:
+        frames, state = audioop.ratecv(frames, width, channels, rate, config.AUDIO_SAMPLE_RATE, state)
+        rate = config.AUDIO_SAMPLE_RATE
+    return frames, channels, rate, state
+
+
+def split_wav(path, digest):
+    segments = []
+    with wave.open(path, "rb") as source:
+        channels, width, rate = source.getnchannels(), source.getsampwidth(), source.getframerate()
+        total = source.getnframes()
+        per_segment = rate * config.AUDIO_SEGMENT_SECONDS
+        for index, first in enumerate(range(0, total, per_segment)):
+            count = min(per_segment, total - first)
+            out_path = os.path.join(_cache_dir(), f"{digest}_{index:03d}.wav")
+            if not os.path.exists(out_path):
+                def write(f, count=count):
+                    with wave.open(f, "wb") as out:
+                        state, params_set = None, False
+                        remaining = count
+                        while remaining:
+                            block = source.readframes(min(rate * WAV_BLOCK_SECONDS, remaining))
+                            remaining -= min(rate * WAV_BLOCK_SECONDS, remaining)
+                            block, out_channels, out_rate, state = _convert(block, channels, width, rate, state)
+                            if not params_set:
+                                out.setnchannels(out_channels)
+                                out.setsampwidth(width)
+                                out.setframerate(out_rate)
+                                params_set = True
+                            out.writeframes(block)
+                _write_atomic(out_path, write)
+            else:
+                os.utime(out_path)
+                source.setpos(first + count)
+            segments.append(AudioSegment(index, first / rate, (first + count) / rate, out_path, "audio/wav"))
+    return segments
+
+
+def prepare(stream, digest, mime_type):
+    """録音を書き出して区間に分ける。結果はハッシュごとに保持する。"""
+    with _lock:
+        segments = _segments.get(digest)
+    if segments and all(os.path.exists(segment.path) for segment in segments):
+        for segment in segments:
+            os.utime(segment.path)
+        return segments
+    path = spool(stream, digest, mime_type)
+    if path.endswith(".wav"):
+        segments = split_wav(path, digest)
+    else:
+        # mp3 / m4a は分割にデコーダーが必要なため、圧縮済みの1区間のまま扱う
+        segments = [AudioSegment(0, 0.0, None, path, mime_type)]
+    with _lock:
+        _segments[digest] = segments
+    return segments
+
+
+# ---------------------------------------------------------
+# 送信用の部品（アップロードは1区間につき1回）
+# ---------------------------------------------------------
+def _uploaded(segment):
+    with _lock:
+        entry = _uploads.get(segment.path)
+    if entry and time.time() - entry[1] < config.AUDIO_UPLOAD_TTL:
+        return entry[0]
+    handle = backends.get_backend().upload_file(
+        segment.path, mime_type=segment.mime_type, display_name=os.path.basename(segment.path)
+    )
+    with _lock:
+        _uploads[segment.path] = (handle, time.time())
+    return handle
+
+
+def parts_for(digest, name):
+    segments = _segments.get(digest)
+    if not segments:
+        return [f"【音声「{name}」はこのターンで送付済み（内容は再送されていません）】"]
+    parts = [f"【音声資料】{name}（{len(segments)}区間。発言を引用するときは区間の開始時刻からの時刻で示してください）"]
+    for segment in segments:
+        if segment.end is None:
+            parts.append(f"[音声 {name} 全体]")
+        else:
+            parts.append(f"[音声 {name} {format_time(segment.start)}〜{format_time(segment.end)}]")
+        parts.append(_uploaded(segment))
+    return parts
@@ -0,0 +1,94 @@
+import datetime
+import functools
+import sys
+import time
+
+import config
+
+# ==============================================================================
+# AIバックエンド
+# モデルの生成方法だけをここに閉じ込め、Gemini とローカルの代替実装を差し替えられるようにする
+# ==============================================================================
+
+_api_key = None
+
+
+def configure(api_key):
+    """
+    APIキーを覚えておき、Gemini を初めて使うときに設定する。
+    google.generativeai は読み込みに1秒以上かかるため、起動時には読み込まない。
+    """
+    global _api_key
+    _api_key = api_key
+    if "google.generativeai" in sys.modules:
+        sys.modules["google.generativeai"].configure(api_key=api_key)
+
+
+class GeminiBackend:
+    supports_context_cache = True
+
+    def __init__(self):
+        import google.generativeai as genai
+        if _api_key:
+            genai.configure(api_key=_api_key)
+        self.genai = genai
+
+    def create_model(self, model_name, system_instruction, safety_settings):
+        return self.genai.GenerativeModel(
+            model_name=model_name,
+            system_instruction=system_instruction,
+            safety_settings=safety_settings
+        )
+
+    def create_cached_model(self, model_name, system_instruction, safety_settings, ttl, display_name):
+        # システムプロンプトをサーバー側に1回だけ登録し、以降は参照で送る
+        from google.generativeai import caching
+        cached = caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            display_name=display_name,
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+        return self.genai.GenerativeModel.from_cached_content(
+            cached_content=cached,
+            safety_settings=safety_settings
+        )
+
+    def upload_file(self, path, mime_type, display_name):
+        # 大きな音声などは File API に1回だけ上げ、以降はファイル参照で送る
+        uploaded = self.genai.upload_file(path, mime_type=mime_type, display_name=display_name)
+        deadline = time.monotonic() + config.AUDIO_UPLOAD_TIMEOUT
+        while uploaded.state.name == "PROCESSING":
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"ファイルの処理が{config.AUDIO_UPLOAD_TIMEOUT:g}秒以内に終わりませんでした: {display_name}"
+                )
+            time.sleep(1)
+            uploaded = self.genai.get_file(uploaded.name)
+        if uploaded.state.name == "FAILED":
+            raise RuntimeError(f"ファイルのアップロードに失敗しました: {display_name}")
+        return uploaded
+
+
+def _create_fake_backend():
+    from fake_backend import FakeBackend
+    model_latency = {}
+    if config.LIGHT_MODEL_NAME and config.FAKE_LIGHT_LATENCY:
+        model_latency[config.LIGHT_MODEL_NAME] = float(config.FAKE_LIGHT_LATENCY)
+    return FakeBackend(
+        latency=config.FAKE_LATENCY,
+        chunk_delay=config.FAKE_CHUNK_DELAY,
+        error_rate=config.FAKE_ERROR_RATE,
+        model_latency=model_latency,
+    )
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": _create_fake_backend,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name=None):
+    return BACKENDS[name or config.BACKEND]()
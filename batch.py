@@ -0,0 +1,282 @@
+"""
+ケースフォルダの一括分析（画面を使わない別の入口）
+
+    python batch.py cases/ --out results.jsonl
+    python batch.py cases/ --out results.jsonl --workers 8 --question "学校の対応の問題点を整理してください"
+
+cases/ の下を順にたどり、対応している資料（PDF・表・写真・音声）か保存した履歴（.json / .json.gz）を
+直接含むフォルダを1件のケースとして扱う。フォルダに question.txt があればその内容を質問にする。
+ケースは --workers 件ずつ並行して処理し、AIへの送信は画面・API と同じ流量制御（rate_limit）を通る。
+
+結果は1ケース1行の JSONL で、終わったケースから順に追記する。途中で止めても、同じ --out で
+もう一度実行すれば、成功したケース（資料・質問が変わっていないもの）は飛ばして続きから処理する。
+失敗したケースは次の実行でやり直す。
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import config
+import engine
+import session_store
+
+# ==============================================================================
+# ケースの収集
+# ==============================================================================
+
+# 拡張子 → MIMEタイプ（app.py のアップロード欄と同じ種類）
+EVIDENCE_TYPES = {
+    ".pdf": "application/pdf",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".m4a": "audio/mp4",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+}
+HISTORY_SUFFIXES = (".json", ".json.gz")
+
+DEFAULT_QUESTION = "添付した資料とこれまでの経緯をもとに、学校の対応を法律・ガイドラインに照らして分析してください。"
+
+
+class Case:
+    """1件のケース（フォルダ）。資料・履歴は処理するときに読み込む。"""
+
+    def __init__(self, case_id, directory, evidence, histories, question_file):
+        self.case_id = case_id
+        self.directory = directory
+        self.evidence = evidence            # 資料のパスの一覧
+        self.histories = histories          # 履歴ファイルのパスの一覧
+        self.question_file = question_file  # 質問ファイルのパス（無ければ None）
+
+    def paths(self):
+        return self.evidence + self.histories + ([self.question_file] if self.question_file else [])
+
+    def fingerprint(self, question):
+        """資料・履歴・質問の中身から作る値。変わっていなければ前回の結果を使う。"""
+        digest = hashlib.sha256(question.encode("utf-8"))
+        for path in sorted(self.paths()):
+            digest.update(os.path.relpath(path, self.directory).encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()[:16]
+
+
+def _is_history(name):
+    return name.lower().endswith(HISTORY_SUFFIXES)
+
+
+def find_cases(roots):
+    """roots の下で、資料か履歴を直接含むフォルダをケースとして返す（パス順）。"""
+    cases = []
+    for root in roots:
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            files = sorted(f for f in filenames if not f.startswith("."))
+            evidence = [os.path.join(directory, f) for f in files if os.path.splitext(f)[1].lower() in EVIDENCE_TYPES]
+            histories = [os.path.join(directory, f) for f in files if _is_history(f)]
+            if not evidence and not histories:
+                continue
+            question_file = os.path.join(directory, config.BATCH_QUESTION_FILE)
+            cases.append(Case(
+                os.path.normpath(directory), directory, evidence, histories,
+                question_file if os.path.isfile(question_file) else None,
+            ))
+    return cases
+
+
+def read_question(case, default):
+    if case.question_file is None:
+        return default
+    with open(case.question_file, encoding="utf-8-sig") as f:
+        return f.read().strip() or default
+
+
+def load_history(case):
+    """
+    保存した履歴を読み込む。複数あれば名前順につなげ、2つ目以降の最初の挨拶は除く。
+    戻り値: メッセージの一覧（履歴が無ければ None）
+    """
+    messages = None
+    for path in case.histories:
+        with open(path, "rb") as f:
+            loaded = session_store.read_history(f)
+        if messages is None:
+            messages = loaded
+        else:
+            messages.extend(loaded[1:] if loaded and loaded[0]["role"] == "assistant" else loaded)
+    return messages
+
+
+# ==============================================================================
+# 途中経過（結果の JSONL がそのまま再開用の記録になる）
+# ==============================================================================
+def read_checkpoint(path):
+    """ケースID → 最後に記録した結果。書きかけで途切れた行は読み飛ばす。"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    # 文字の途中で途切れた行もあるので、バイト列のまま1行ずつ読み、行ごとに復号する
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "case" in record:
+                done[record["case"]] = record
+    return done
+
+
+class ResultWriter:
+    """結果を1行ずつ追記する（複数のスレッドから呼ばれる。書いた行はすぐディスクに書き出す）。"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "ab+")
+        # 前回の実行が行の途中（文字の途中のこともある）で止まっていたら、改行してから続きを書く
+        end = self._file.seek(0, os.SEEK_END)
+        if end:
+            self._file.seek(end - 1)
+            if self._file.read(1) != b"\n":
+                self._file.write(b"\n")
+
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+# ==============================================================================
+# 1ケースの処理
+# ==============================================================================
+def run_case(case, question, fingerprint):
+    """画面と同じ engine.run_turn で1ケースを分析し、結果の1行（dict）を返す。"""
+    started = time.monotonic()
+    record = {
+        "case": case.case_id,
+        "fingerprint": fingerprint,
+        "question": question,
+        "files": [os.path.relpath(path, case.directory) for path in case.evidence + case.histories],
+    }
+    try:
+        messages = load_history(case)
+        uploads = []
+        for path in case.evidence:
+            with open(path, "rb") as f:
+                uploads.append(engine.Upload(f.read(), os.path.basename(path),
+                                             EVIDENCE_TYPES[os.path.splitext(path)[1].lower()]))
+    except (OSError, ValueError) as e:
+        record.update(status="error", error={"category": "input", "message": str(e)})
+    else:
+        session = engine.Session(session_id=f"batch-{fingerprint}", messages=messages)
+        notices, error, final = [], None, None
+        for event in engine.run_turn(session, question, uploads, stream=False):
+            if event.kind == "notice":
+                notices.append(event.data)
+            elif event.kind == "error":
+                error = event.data
+            elif event.kind == "done":
+                final = event.data
+        record["notices"] = notices
+        if final is not None:
+            record.update(status="ok", answer=final["answer"], local=final["local"], cached=final["cached"],
+                          citations=final["citations"])
+        else:
+            record.update(status="error", error=error)
+    record["seconds"] = round(time.monotonic() - started, 3)
+    record["finished_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    return record
+
+
+# ==============================================================================
+# 一括処理
+# ==============================================================================
+def run_batch(cases, out_path, question, workers, progress=None):
+    """
+    cases を並行して処理し、結果を out_path に追記する。前回成功したケースは飛ばす。
+    戻り値: (成功した数, 失敗した数, 飛ばした数)
+    """
+    done = read_checkpoint(out_path)
+    pending = []
+    skipped = 0
+    for case in cases:
+        case_question = read_question(case, question)
+        fingerprint = case.fingerprint(case_question)
+        previous = done.get(case.case_id)
+        if previous and previous.get("status") == "ok" and previous.get("fingerprint") == fingerprint:
+            skipped += 1
+        else:
+            pending.append((case, case_question, fingerprint))
+
+    ok = failed = 0
+    writer = ResultWriter(out_path)
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch")
+    try:
+        futures = {executor.submit(run_case, *item): item[0] for item in pending}
+        for future in as_completed(futures):
+            record = future.result()
+            writer.write(record)
+            if record["status"] == "ok":
+                ok += 1
+            else:
+                failed += 1
+            if progress:
+                progress(ok + failed, len(pending), record)
+    finally:
+        # 中断されたら、まだ始まっていないケースは取り消す（処理中のケースは書き終えてから止まる）
+        executor.shutdown(wait=True, cancel_futures=True)
+        writer.close()
+    return ok, failed, skipped
+
+
+def _print_progress(count, total, record):
+    mark = "✔" if record["status"] == "ok" else "✖"
+    detail = "" if record["status"] == "ok" else f"  {record['error']['message']}"
+    print(f"[{count}/{total}] {mark} {record['case']} ({record['seconds']:.1f}s){detail}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ケースフォルダの一括分析（結果は JSONL）")
+    parser.add_argument("roots", nargs="+", help="ケースフォルダをたどる起点のフォルダ")
+    parser.add_argument("--out", required=True, help="結果の JSONL（既にあれば続きから処理する）")
+    parser.add_argument("--question", default=DEFAULT_QUESTION,
+                        help=f"質問（ケースフォルダに {config.BATCH_QUESTION_FILE} があればそちらを使う）")
+    parser.add_argument("--workers", type=int, default=config.BATCH_WORKERS, help="同時に処理するケースの数")
+    parser.add_argument("--api-key", help="Gemini APIキー（省略時は環境変数 GEMINI_API_KEY）")
+    args = parser.parse_args(argv)
+
+    missing = [root for root in args.roots if not os.path.isdir(root)]
+    if missing:
+        parser.error(f"フォルダが見つかりません: {', '.join(missing)}")
+    api_key = args.api_key or os.environ.get("GEMINI_API_KEY")
+    if api_key:
+        engine.configure(api_key)
+
+    cases = find_cases(args.roots)
+    print(f"{len(cases)} 件のケースが見つかりました", file=sys.stderr)
+    try:
+        ok, failed, skipped = run_batch(cases, args.out, args.question, args.workers, _print_progress)
+    except KeyboardInterrupt:
+        print("中断しました（同じ --out でもう一度実行すると続きから処理します）", file=sys.stderr)
+        return 130
+    print(f"成功 {ok} 件・失敗 {failed} 件・前回の結果を使用 {skipped} 件 → {args.out}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""
+オフラインのベンチマーク（APIを呼ばず、割り当て量も使わない）
+
+    python benchmark.py                       # 全シナリオ
+    python benchmark.py large_pdf big_xlsx    # シナリオを選ぶ
+    python benchmark.py --json result.json    # 結果を保存
+    python benchmark.py --baseline result.json --tolerance 0.2   # 以前の結果より遅くなったら終了コード1
+    python benchmark.py cold_start            # 起動時間（import の所要時間）だけを測る
+
+シナリオごとに別プロセスで実行し、スループット・レイテンシ（p50/p95）・最大メモリ・送信サイズを表示する。
+cold_start は新しいプロセスで engine を読み込む時間と、その内訳（python -X importtime）を表示する。
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# ==============================================================================
+# 合成データ（実在の相談・資料は使わない）
+# ==============================================================================
+QUESTIONS = [
+    "学校が重大事態として扱わない",
+    "欠席が30日を超えたのに調査が始まらない",
+    "加害児童への指導内容を教えてもらえない",
+    "第23条第5項の情報提供について知りたい",
+    "出席扱いの要件を教えてください",
+]
+
+
+def upload(data, name, mime_type):
+    # engine.Upload（st.file_uploader の UploadedFile と同じ形）。子プロセスでだけ読み込む
+    import engine
+    return engine.Upload(data, name, mime_type)
+
+
+def make_pdf(pages, lines_per_page=40, seed=0):
+    """テキストだけの簡単なPDFを組み立てる（pypdf で抽出できる最小構成）。"""
+    rng = random.Random(seed)
+    words = ["school", "report", "bullying", "absence", "meeting", "parent", "survey", "article", "board", "incident"]
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for number in range(pages):
+        rows = [f"Page {number + 1} line {i}: " + " ".join(rng.choice(words) for _ in range(10)) for i in range(lines_per_page)]
+        body = "BT /F1 9 Tf 40 800 Td 12 TL " + " ".join(f"({row}) '" for row in rows) + " ET"
+        stream = body.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), pages)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (i, obj))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_xlsx(rows, seed=0):
+    """出欠記録ふうの表（日付・氏名・出欠・備考）。"""
+    import datetime
+
+    import openpyxl
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("出欠記録")
+    sheet.append(["日付", "氏名", "出欠", "欠席日数", "備考"])
+    start = datetime.date(2022, 4, 1)
+    for i in range(rows):
+        status = rng.choice(["出席", "出席", "出席", "欠席", "遅刻", "保健室登校"])
+        sheet.append([start + datetime.timedelta(days=i % 900), f"生徒{i % 40:02d}", status,
+                      1 if status == "欠席" else 0, rng.choice(["", "", "体調不良", "面談", "連絡なし"])])
+    out = io.BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+def make_image(seed, size=(3024, 4032)):
+    """スマホ写真くらいの大きさの画像（1枚ずつ違う模様にして、ほぼ同じ写真の判定に掛からないようにする）。"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle([x, y, x + rng.randrange(200, 1500), y + rng.randrange(200, 1500)],
+                       fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def make_history(turns, seed=0):
+    """条文の引用を含む長い相談履歴。"""
+    rng = random.Random(seed)
+    messages = [{"role": "assistant", "content": "こんにちは。学校の対応について分析を行います。"}]
+    for i in range(turns):
+        question = rng.choice(QUESTIONS) + f"（{i + 1}回目の相談）。" + "経緯を説明します。" * rng.randrange(5, 40)
+        messages.append({"role": "user", "content": question})
+        answer = ("┏━━━━┓\n　📖 **根拠資料**\n　**いじめ防止対策推進法**\n　📍 **該当箇所**\n　**【 第23条 第5項 】**\n┗━━━━┛\n"
+                  if i % 3 == 0 else "") + "学校は組織的に対応する義務があります。" * rng.randrange(10, 80)
+        messages.append({"role": "assistant", "content": answer})
+    return messages
+
+
+# ==============================================================================
+# シナリオ
+# ==============================================================================
+# files: () -> [engine.Upload]、history: 事前の会話の長さ（ターン数）、error_rate: 429 を起こす割合
+SCENARIOS = {
+    "first_question": {"files": lambda: [], "history": 0},
+    "large_pdf": {"files": lambda: [upload(make_pdf(300), "学校からの報告書.pdf", "application/pdf")], "history": 0},
+    "big_xlsx": {"files": lambda: [upload(make_xlsx(50000), "出欠記録.xlsx",
+                                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")], "history": 0},
+    "many_images": {"files": lambda: [upload(make_image(i), f"写真{i + 1}.jpg", "image/jpeg") for i in range(12)], "history": 0},
+    "long_history": {"files": lambda: [], "history": 120},
+    "follow_up": {"files": lambda: [], "history": 4},
+    "throttled": {"files": lambda: [], "history": 4, "error_rate": 0.3},
+    "mixed": {"files": lambda: [
+        upload(make_pdf(60, seed=1), "手紙.pdf", "application/pdf"),
+        upload(make_xlsx(5000, seed=1), "出欠.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        upload(make_image(100), "メモ.jpg", "image/jpeg"),
+    ], "history": 20},
+}
+
+
+# ==============================================================================
+# 起動時間
+# ==============================================================================
+STARTUP = "cold_start"
+# 起動時には読み込まず、必要になったときに読み込むモジュール（読み込まれていたら悪化として扱う）
+HEAVY_MODULES = ("pandas", "openpyxl", "pypdf", "PIL", "google.generativeai", "law_data")
+
+
+def _parse_importtime(stderr):
+    """python -X importtime の出力を (深さ, モジュール名, 累計マイクロ秒) にする。"""
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        yield depth, name.strip(), int(fields[1])
+
+
+def run_startup(iterations, env, cwd):
+    """毎回新しいプロセスで engine を読み込み、所要時間と直接読み込むモジュールごとの内訳を測る。"""
+    totals, modules, heavy = [], defaultdict(list), set()
+    for _ in range(iterations):
+        completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import engine"],
+                                   env=env, cwd=cwd, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(completed.stderr)
+        children = []
+        for depth, name, cumulative in _parse_importtime(completed.stderr):
+            heavy.update(module for module in HEAVY_MODULES if name == module or name.startswith(module + "."))
+            # 子のモジュールは親より先に出力される
+            if depth == 1:
+                children.append((name, cumulative))
+            elif depth == 0:
+                if name == "engine":
+                    totals.append(cumulative / 1e6)
+                    for child, child_cumulative in children:
+                        modules[child].append(child_cumulative / 1e3)
+                children = []
+    return {
+        "scenario": STARTUP,
+        "iterations": iterations,
+        "p50_s": statistics.median(totals),
+        "p95_s": percentile(totals, 0.95),
+        "modules_ms": {name: statistics.median(values) for name, values in modules.items()},
+        "heavy_modules": sorted(heavy),
+    }
+
+
+def print_startup(result, top=8):
+    print(f"{result['scenario']}: import engine  p50 {result['p50_s'] * 1000:.1f} ms  p95 {result['p95_s'] * 1000:.1f} ms")
+    print(f"  起動時に読み込まれた重い依存: {', '.join(result['heavy_modules']) or 'なし'}")
+    slowest = sorted(result["modules_ms"].items(), key=lambda item: item[1], reverse=True)[:top]
+    for name, ms in slowest:
+        print(f"  {name:<28}{ms:>8.1f} ms")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # Linux は KB、macOS はバイト単位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class _Collector:
+    """metrics のシンク。1ターン分の計測結果をそのまま受け取る。"""
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+def run_scenario(name, iterations, warm):
+    """子プロセスで1シナリオを実行する（メモリの最大値をシナリオごとに測るため）。"""
+    spec = SCENARIOS[name]
+    import attachments
+    import backends
+    import config
+    import engine
+    import metrics
+
+    collector = _Collector()
+    metrics.set_sinks([collector])
+
+    generate_started = time.perf_counter()
+    files = spec["files"]()
+    history_messages = make_history(spec["history"])
+    setup_seconds = time.perf_counter() - generate_started
+    input_bytes = sum(len(f.getvalue()) for f in files)
+
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        if not warm:
+            # 毎回、初めてアップロードされた資料として処理する
+            attachments.CACHE = attachments.AttachmentCache(config.ATTACHMENT_CACHE_SIZE)
+        # app.py と同じ engine.run_turn を、毎回同じ長さの履歴から始める
+        session = engine.Session(session_id=f"bench-{i}", messages=history_messages)
+        turn_started = time.perf_counter()
+        for event in engine.run_turn(session, QUESTIONS[i % len(QUESTIONS)], files, stream=True):
+            if event.kind == "error":
+                raise RuntimeError(event.data["message"])
+        latencies.append(time.perf_counter() - turn_started)
+    elapsed = time.perf_counter() - started
+
+    def span_values(span_name):
+        return [span["seconds"] for event in collector.events for span in event["spans"] if span["name"] == span_name]
+
+    prompt_tokens = [event["usage"].get("prompt_token_count", 0) for event in collector.events]
+    light_turns = sum(1 for event in collector.events if event.get("model_profile") == "light")
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "throughput_per_s": iterations / elapsed,
+        "p50_s": statistics.median(latencies),
+        "p95_s": percentile(latencies, 0.95),
+        "first_chunk_p50_s": statistics.median(span_values("first_chunk") or [0.0]),
+        "peak_rss_mb": peak_rss_mb(),
+        "prompt_tokens": int(statistics.mean(prompt_tokens)),
+        "input_mb": input_bytes / 1024 / 1024,
+        "retries": backends.get_backend().errors,
+        "light_turns": light_turns,
+        "setup_s": setup_seconds,
+    }
+
+
+def print_table(results):
+    header = f"{'scenario':<16}{'turns/s':>9}{'p50 s':>9}{'p95 s':>9}{'1st s':>8}{'RSS MB':>9}{'prompt tok':>12}{'input MB':>10}{'429s':>6}{'light':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<16}{r['throughput_per_s']:>9.2f}{r['p50_s']:>9.3f}{r['p95_s']:>9.3f}"
+              f"{r['first_chunk_p50_s']:>8.3f}{r['peak_rss_mb']:>9.1f}{r['prompt_tokens']:>12,}{r['input_mb']:>10.1f}{r['retries']:>6}{r.get('light_turns', 0):>7}")
+
+
+def compare(results, baseline_path, tolerance):
+    """以前の結果と比べ、p95 レイテンシ・送信サイズが許容幅を超えて悪化したシナリオを返す。"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)}
+    regressions = []
+    for r in results:
+        before = baseline.get(r["scenario"])
+        if before is None:
+            continue
+        for field in ("p95_s", "prompt_tokens", "peak_rss_mb"):
+            if before.get(field) and field in r and r[field] > before[field] * (1 + tolerance):
+                regressions.append(f"{r['scenario']}: {field} {before[field]:.3f} → {r[field]:.3f}")
+        added = set(r.get("heavy_modules", ())) - set(before.get("heavy_modules", ()))
+        if added:
+            regressions.append(f"{r['scenario']}: 起動時に読み込まれるようになった依存 {', '.join(sorted(added))}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="オフラインのベンチマーク（代替バックエンドを使用）")
+    parser.add_argument("scenarios", nargs="*", help=f"実行するシナリオ（既定: すべて）: {STARTUP}, {', '.join(SCENARIOS)}")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2, help="代替モデルの応答までの秒数")
+    parser.add_argument("--light-latency", type=float, default=0.1, help="軽いモデル（routing の light）の応答までの秒数")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="ストリーミングのチャンク間隔（秒）")
+    parser.add_argument("--warm", action="store_true", help="添付資料のキャッシュを残したまま繰り返す")
+    parser.add_argument("--json", help="結果を書き出すファイル")
+    parser.add_argument("--baseline", help="比較する以前の結果（--json で保存したもの）")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="悪化とみなす割合（既定 0.2 = 20%%）")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        result = run_scenario(args.child, args.iterations, args.warm)
+        print(json.dumps(result))
+        return 0
+
+    names = args.scenarios or [STARTUP, *SCENARIOS]
+    unknown = [name for name in names if name not in SCENARIOS and name != STARTUP]
+    if unknown:
+        parser.error(f"不明なシナリオ: {', '.join(unknown)}")
+
+    # 回答キャッシュは無効にして毎回バックエンドまで通す。割り当て量の制限は測らない（429 の再送だけを測る）
+    env = dict(os.environ, IJIME_BACKEND="fake", IJIME_RESPONSE_CACHE="0", IJIME_METRICS_SINKS="", IJIME_SESSION_DB_PATH="",
+               IJIME_FAKE_LATENCY=str(args.latency), IJIME_FAKE_LIGHT_LATENCY=str(args.light_latency),
+               IJIME_FAKE_CHUNK_DELAY=str(args.chunk_delay),
+               IJIME_RATE_LIMIT_RPM="1000000", IJIME_RATE_LIMIT_BURST="1000000",
+               IJIME_RETRY_BASE_DELAY=os.environ.get("IJIME_RETRY_BASE_DELAY", "0.05"))
+    results = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    if STARTUP in names:
+        results.append(run_startup(args.iterations, env, here))
+        print(f"[{STARTUP}] 完了", file=sys.stderr)
+    # 資料の索引などはシナリオごとの一時フォルダに作り、終わったら消す（前回の実行の索引を持ち越さない）
+    with tempfile.TemporaryDirectory(prefix="ijime_bench_") as scratch:
+        for name in (name for name in names if name != STARTUP):
+            env["IJIME_FAKE_ERROR_RATE"] = str(SCENARIOS[name].get("error_rate", 0.0))
+            env["IJIME_DATA_DIR"] = os.path.join(scratch, name)
+            env["IJIME_EVIDENCE_DIR"] = os.path.join(scratch, name, "evidence")
+            command = [sys.executable, os.path.abspath(__file__), "--child", name, "--iterations", str(args.iterations)]
+            if args.warm:
+                command.append("--warm")
+            completed = subprocess.run(command, env=env, capture_output=True, text=True, cwd=here)
+            if completed.returncode != 0:
+                print(f"[{name}] 失敗しました:\n{completed.stderr}", file=sys.stderr)
+                return 1
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+            print(f"[{name}] 完了", file=sys.stderr)
+    for result in results:
+        if result["scenario"] == STARTUP:
+            print_startup(result)
+            print()
+    scenario_results = [result for result in results if result["scenario"] != STARTUP]
+    if scenario_results:
+        print_table(scenario_results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\n⚠️ 以前の結果より悪化しています:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
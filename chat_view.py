@@ -0,0 +1,76 @@
+import re
+from functools import lru_cache
+
+# ==============================================================================
+# チャット履歴の表示（長い会話のページ分け）
+# 直近のやり取りだけを通常どおり表示し、それより古いやり取りはページごとに折りたたむ。
+# 折りたたんだページは開いたときだけ描画し、1ページ分のMarkdownを1つにまとめてキャッシュする。
+# ==============================================================================
+
+ROLE_HEADERS = {"user": "#### 🧑 ご相談", "assistant": "#### 🛡️ 回答"}
+LABEL_CHARS = 30
+PAGE_CACHE_SIZE = 256
+
+
+def split_turns(messages):
+    """
+    メッセージを「質問1件＋その回答」のやり取りに分ける。戻り値は各やり取りの (開始位置, 終了位置)。
+    最初の挨拶など、質問より前のメッセージは先頭のやり取りに含める。
+    """
+    starts = [i for i, message in enumerate(messages) if message["role"] == "user"]
+    if not starts:
+        return [(0, len(messages))] if messages else []
+    starts[0] = 0
+    return list(zip(starts, starts[1:] + [len(messages)]))
+
+
+def layout(messages, recent_turns, page_turns):
+    """
+    戻り値: (折りたたむページの一覧, 通常どおり表示する最初のメッセージの位置)
+    ページは (開始位置, 終了位置, 最初のやり取りの番号, 最後のやり取りの番号)。番号は1から数える。
+    """
+    turns = split_turns(messages)
+    if len(turns) <= recent_turns:
+        return [], 0
+    older = turns[:len(turns) - recent_turns]
+    pages = []
+    for i in range(0, len(older), page_turns):
+        last = min(i + page_turns, len(older)) - 1
+        pages.append((older[i][0], older[last][1], i + 1, last + 1))
+    return pages, older[-1][1]
+
+
+def _preview(text):
+    text = re.sub(r"[┏┗┛┓━\s#*]+", " ", text).strip()
+    return text if len(text) <= LABEL_CHARS else text[:LABEL_CHARS] + "…"
+
+
+def page_label(messages, page):
+    """折りたたんだページの見出し（やり取りの番号と、最初の質問の書き出し）。"""
+    start, end, first, last = page
+    question = next((m["content"] for m in messages[start:end] if m["role"] == "user"), "")
+    label = f"過去のやり取り {first}〜{last}" if first != last else f"過去のやり取り {first}"
+    return f"{label}：{_preview(question)}" if question else label
+
+
+@lru_cache(maxsize=PAGE_CACHE_SIZE)
+def _page_markdown(entries):
+    blocks = []
+    for role, content, names in entries:
+        block = f"{ROLE_HEADERS.get(role, role)}\n\n{content}"
+        if names:
+            block += "\n\n" + "\n".join(f"- 📎 {name}" for name in names)
+        blocks.append(block)
+    return "\n\n---\n\n".join(blocks)
+
+
+def page_markdown(messages, start, end):
+    """
+    1ページ分のやり取りを1つのMarkdownにする（メッセージごとに要素を作るより送るデータが少ない）。
+    文字列は同じオブジェクトのままなのでハッシュの計算は初回だけで済み、同じページは作り直さない。
+    """
+    entries = tuple(
+        (m["role"], m["content"], tuple(a["name"] for a in m.get("attachments", ())))
+        for m in messages[start:end]
+    )
+    return _page_markdown(entries)
@@ -0,0 +1,228 @@
+import re
+from collections import deque, namedtuple
+
+import artifacts
+import config
+import law_index
+
+# ==============================================================================
+# 回答の引用チェック（AIを呼ばずにその場で照合する）
+# 回答の罫線ボックス（┏〜┛）から資料名・条・項・ページ・URLを取り出し、law_index と照合する。
+# 資料名は複数パターン照合（Aho–Corasick）で1回の走査で見つけ、URLの誤りは正しいものに直す。
+# 確認できた条文は原文の抜粋を回答の末尾に付ける。
+# ==============================================================================
+
+# status: "verified"（原文を確認）/ "fixed"（URLを修正）/ "not_found"（資料内に無い）
+#         / "unknown_document"（資料名が分からない）/ "unchecked"（照合できる項目が無い）
+Citation = namedtuple("Citation", ["document", "doc_id", "location", "url", "status", "note", "excerpt"])
+
+BOX_RE = re.compile(r"┏[^\n]*\n(.*?)┗[━─]*┛", re.S)
+FIELD_RE = re.compile(r"(📖|📍|🔗)[^\n]*\n(.*?)(?=📖|📍|🔗|\Z)", re.S)
+ARTICLE_REF_RE = re.compile(rf"第\s*({law_index.NUMERAL})\s*条(?:\s*第\s*({law_index.NUMERAL})\s*項)?")
+PAGE_REF_RE = re.compile(r"P\s*\.\s*(\d+)")
+URL_RE = re.compile(r"https?://[^\s)）\]」>*]+")
+
+# 回答で使われる略称（正式名称・REFERENCE_MAP の見出しはインデックスから加える）
+ALIASES = {
+    "いじめ防止法": "ijime_act",
+    "推進法": "ijime_act",
+    "重大事態ガイドライン": "guideline_r6",
+    "基本方針": "basic_policy",
+    "生徒指導提要": "guidance_detail",
+    "教育機会確保法": "truancy",
+    "個人情報の取扱いQ&A": "personal_info_qa",
+}
+
+
+# ---------------------------------------------------------
+# 複数パターン照合（Aho–Corasick）
+# ---------------------------------------------------------
+class Matcher:
+    """登録した全パターンの出現を、本文を1回走査するだけで見つける。"""
+
+    def __init__(self, patterns):
+        # patterns: {パターン: 値}
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern, value in patterns.items():
+            state = 0
+            for ch in pattern:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state].append((len(pattern), value))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        """(開始位置, 長さ, 値) を出現順に返す。"""
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for length, value in self.output[state]:
+                yield i - length + 1, length, value
+
+    def best(self, text):
+        """最も長く一致したパターンの値（同じ長さなら先に出てきたもの）。"""
+        matches = sorted(self.find(text), key=lambda m: (-m[1], m[0]))
+        return matches[0][2] if matches else None
+
+
+def _build_matcher():
+    index = law_index.get_index()
+    patterns = dict(ALIASES)
+    patterns.update({prefix: doc_id for doc_id, prefix in law_index.REFERENCE_TITLES.items()})
+    for title in index.references:
+        doc_id = next((d for d, prefix in law_index.REFERENCE_TITLES.items() if title.startswith(prefix)), None)
+        if doc_id:
+            patterns[title] = doc_id
+    patterns.update({title: doc_id for doc_id, title in index.titles.items()})
+    return Matcher(patterns)
+
+
+_matcher = None
+
+
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        sources = law_index.SOURCES + ("citations.py",)
+        _matcher = artifacts.load_or_build("citation_matcher", sources, _build_matcher)
+    return _matcher
+
+
+# ---------------------------------------------------------
+# 照合
+# ---------------------------------------------------------
+def _clean(text):
+    return re.sub(r"[*　\s]+", " ", text).strip()
+
+
+def _fields(box):
+    fields = {}
+    for marker, body in FIELD_RE.findall(box):
+        lines = [_clean(line) for line in body.splitlines()]
+        fields[marker] = "\n".join(line for line in lines if line)
+    return fields
+
+
+def _excerpt(text):
+    limit = config.CITATION_EXCERPT_CHARS
+    text = text.strip()
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def check_box(box, index=None):
+    """罫線ボックス1つを照合して Citation を返す。"""
+    index = index or law_index.get_index()
+    fields = _fields(box)
+    document = fields.get("📖", "")
+    location = fields.get("📍", "")
+    url_match = URL_RE.search(fields.get("🔗", ""))
+    url = url_match.group(0) if url_match else None
+
+    doc_id = get_matcher().best(document)
+    if doc_id is None:
+        return Citation(document, None, location, url, "unknown_document", "資料名が法律データの資料と一致しません", None)
+    known_url, hints = index.reference_for(doc_id)
+
+    excerpt, status, notes = None, "unchecked", []
+    article = ARTICLE_REF_RE.search(location)
+    page = PAGE_REF_RE.search(location)
+    if article:
+        number = law_index.to_int(article.group(1))
+        paragraph = law_index.to_int(article.group(2)) if article.group(2) else None
+        provision = index.lookup(doc_id, number, paragraph)
+        if provision is None:
+            label = f"第{number}条" + (f"第{paragraph}項" if paragraph else "")
+            notes.append(f"{label}は「{index.titles[doc_id]}」の中に見つかりません")
+            status = "not_found"
+        else:
+            excerpt = _excerpt(index.text(provision))
+            status = "verified"
+    elif page:
+        labels = [label for p, label in hints if p == f"P.{page.group(1)}"]
+        if labels:
+            status = "verified"
+            notes.append(f"ページ目安の「{labels[0]}」と一致します")
+        elif hints:
+            notes.append("ページ数はページ目安の一覧にありません（原本でご確認ください）")
+
+    if known_url and url is None:
+        notes.append(f"入手先URL：{known_url}")
+    elif known_url and url != known_url:
+        notes.append(f"入手先URLを修正しました → {known_url}")
+        if status == "verified":
+            status = "fixed"
+    return Citation(document, doc_id, location, url, status, "。".join(notes), excerpt)
+
+
+def verify(text, index=None):
+    """
+    回答の罫線ボックスをすべて照合する。
+    戻り値: (URLを直した回答, [Citation, ...])。ボックスが無ければ一覧は空になる。
+    """
+    index = index or law_index.get_index()
+    citations = []
+
+    def fix(match):
+        citation = check_box(match.group(1), index)
+        citations.append(citation)
+        known_url, _ = index.reference_for(citation.doc_id) if citation.doc_id else (None, [])
+        if known_url and citation.url and citation.url != known_url:
+            return match.group(0).replace(citation.url, known_url)
+        return match.group(0)
+
+    fixed = BOX_RE.sub(fix, text)
+    return fixed, citations
+
+
+REPORT_HEADER = "🔎 **引用の確認（law_data.py の原文と照合）**"
+REPORT_SEPARATOR = f"\n\n---\n{REPORT_HEADER}"
+STATUS_MARKS = {"verified": "✅", "fixed": "🔧", "not_found": "⚠️", "unknown_document": "⚠️", "unchecked": "ℹ️"}
+
+
+def format_report(citations):
+    """回答の末尾に付ける照合結果（Markdown）。"""
+    if not citations:
+        return ""
+    lines = [REPORT_SEPARATOR]
+    for c in citations:
+        where = " ".join(part for part in (c.document, c.location.replace("\n", " ")) if part) or "（資料名なし）"
+        if c.status in ("verified", "fixed"):
+            message = "原文を確認しました"
+        elif c.status in ("not_found", "unknown_document"):
+            message = "法律データの中で確認できませんでした。学校に示す前に原文をご確認ください"
+        else:
+            message = "条・項の指定がないため照合していません"
+        note = f"（{c.note}）" if c.note else ""
+        lines.append(f"- {STATUS_MARKS[c.status]} {where}：{message}{note}")
+        if c.excerpt:
+            excerpt = c.excerpt.replace("\n", " ")
+            lines.append(f"  > 原文：「{excerpt}」")
+    return "\n".join(lines)
+
+
+def strip_report(message):
+    """履歴としてAIに送るときは、手元で付けた照合結果を外す（同じ dict か、外した写し）。"""
+    content = message.get("content") or ""
+    cut = content.find(REPORT_SEPARATOR)
+    if cut < 0:
+        return message
+    return {**message, "content": content[:cut]}
@@ -0,0 +1,159 @@
+import os
+
+# ==============================================================================
+# 動作設定（環境変数 IJIME_〇〇 で上書きできます）
+# ==============================================================================
+
+def _env(name, default):
+    return os.environ.get(f"IJIME_{name}", default)
+
+
+# 法律データの送り方
+#   "bm25" : 質問ごとに関連する条文・項目だけを検索して送る
+#   "full" : 全13資料をシステムプロンプトに入れて毎回送る（従来の動作）
+RETRIEVAL_MODE = _env("RETRIEVAL_MODE", "bm25")
+RETRIEVAL_TOP_K = int(_env("RETRIEVAL_TOP_K", "8"))
+
+# AIモデル・バックエンド
+#   "gemini" : Google Gemini API
+#   "fake"   : ローカルの代替バックエンド（テスト・ベンチマーク用、APIを呼ばない）
+BACKEND = _env("BACKEND", "gemini")
+MODEL_NAME = _env("MODEL_NAME", "gemini-flash-latest")
+
+# モデルの振り分け（資料つき・最初の相談・長い質問は MODEL_NAME、短い追加の質問は LIGHT_MODEL_NAME）
+# LIGHT_MODEL_NAME を空にするか ROUTING を "0" にすると、常に MODEL_NAME を使う
+LIGHT_MODEL_NAME = _env("LIGHT_MODEL_NAME", "gemini-flash-lite-latest")
+ROUTING = _env("ROUTING", "1") == "1"
+# 軽いモデルに回す上限（質問の文字数・履歴のトークン数。新しい資料のあるターンは常に MODEL_NAME）
+ROUTING_LIGHT_MAX_PROMPT_CHARS = int(_env("ROUTING_LIGHT_MAX_PROMPT_CHARS", "200"))
+ROUTING_LIGHT_MAX_HISTORY_TOKENS = int(_env("ROUTING_LIGHT_MAX_HISTORY_TOKENS", "30000"))
+
+# システムプロンプトをサーバー側にキャッシュする（対応モデルのみ。非対応なら通常のモデルで動く）
+CONTEXT_CACHE = _env("CONTEXT_CACHE", "1") == "1"
+CONTEXT_CACHE_TTL = int(_env("CONTEXT_CACHE_TTL", "3600"))
+
+# 回答を届いた部分から順に表示する（"0" で従来どおり完成後にまとめて表示）
+STREAMING = _env("STREAMING", "1") == "1"
+
+# 送信の流量制御（プロセス全体。1分あたりの送信数・連続送信の上限・待ち行列の上限と待ち時間の上限）
+RATE_LIMIT_RPM = float(_env("RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_BURST = int(_env("RATE_LIMIT_BURST", "5"))
+RATE_QUEUE_MAX = int(_env("RATE_QUEUE_MAX", "50"))
+RATE_QUEUE_TIMEOUT = float(_env("RATE_QUEUE_TIMEOUT", "120"))
+
+# 429・500 などの一時的なエラーの自動再送（回数・待ち時間の基準と上限・秒）
+RETRY_MAX_ATTEMPTS = int(_env("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(_env("RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(_env("RETRY_MAX_DELAY", "30"))
+
+# 代替バックエンドの動作（429 を起こす割合、応答までの秒数、ストリーミングのチャンク間隔・秒）
+FAKE_ERROR_RATE = float(_env("FAKE_ERROR_RATE", "0"))
+FAKE_LATENCY = float(_env("FAKE_LATENCY", "0"))
+FAKE_CHUNK_DELAY = float(_env("FAKE_CHUNK_DELAY", "0"))
+# 代替バックエンドで LIGHT_MODEL_NAME が応答までにかかる秒数（空なら FAKE_LATENCY と同じ）
+FAKE_LIGHT_LATENCY = _env("FAKE_LIGHT_LATENCY", "")
+
+# 回答キャッシュ（同じ入力の分析は保存した回答を返す。"0" で無効。
+# RESPONSE_CACHE_PATH を指定するとディスク（SQLite）にも保存し、再起動後も使う）
+RESPONSE_CACHE = _env("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_MEMORY_BYTES = int(_env("RESPONSE_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_PATH = _env("RESPONSE_CACHE_PATH", "")
+RESPONSE_CACHE_DISK_BYTES = int(_env("RESPONSE_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+# 添付ファイルの抽出結果を中身のハッシュで保持する件数（プロセス共通）
+ATTACHMENT_CACHE_SIZE = int(_env("ATTACHMENT_CACHE_SIZE", "64"))
+
+# PDFの並列抽出（この枚数以上のPDFはページ範囲に分けて読む。PDF_WORKERS は PDF・表の解析に使うプロセス数）
+PDF_WORKERS = int(_env("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(_env("PDF_PAGES_PER_TASK", "16"))
+PDF_PARALLEL_MIN_PAGES = int(_env("PDF_PARALLEL_MIN_PAGES", "32"))
+
+# 添付ファイルの並列前処理（写真・音声を扱うスレッド数、1ファイルあたりの制限時間・秒）
+ATTACHMENT_THREADS = int(_env("ATTACHMENT_THREADS", "4"))
+ATTACHMENT_TIMEOUT = float(_env("ATTACHMENT_TIMEOUT", "120"))
+
+# 会話履歴のトークン予算（超えた分は古いやり取りから要約にまとめる）
+HISTORY_TOKEN_BUDGET = int(_env("HISTORY_TOKEN_BUDGET", "24000"))
+HISTORY_KEEP_TURNS = int(_env("HISTORY_KEEP_TURNS", "4"))
+HISTORY_SUMMARY_MAX_TOKENS = int(_env("HISTORY_SUMMARY_MAX_TOKENS", "2000"))
+
+# 表データ1ファイルあたりのトークン予算（超える行は先頭＋無作為抽出にする）
+TABLE_TOKEN_BUDGET = int(_env("TABLE_TOKEN_BUDGET", "6000"))
+
+# 写真の前処理（長辺の上限・保存形式・画質、ほぼ同じ写真とみなすハッシュ距離）
+IMAGE_MAX_EDGE = int(_env("IMAGE_MAX_EDGE", "1600"))
+IMAGE_FORMAT = _env("IMAGE_FORMAT", "WEBP")
+IMAGE_QUALITY = int(_env("IMAGE_QUALITY", "80"))
+IMAGE_DEDUPE_DISTANCE = int(_env("IMAGE_DEDUPE_DISTANCE", "5"))
+
+# 相談の中身（会話・添付資料・録音・資料の索引）の保存先。本人だけが読み書きできるフォルダ（0700）を作って使う
+DATA_DIR = _env("DATA_DIR", os.path.join(os.path.expanduser("~"), ".local", "share", "ijime_support"))
+
+# 音声の前処理（区間の長さ・保存先、モノラル16kHzへの変換、アップロード済みファイルの再利用期限）
+# 書き出した録音は SESSION_RETENTION_DAYS を過ぎたら消す
+AUDIO_SEGMENT_SECONDS = int(_env("AUDIO_SEGMENT_SECONDS", "600"))
+AUDIO_CACHE_DIR = _env("AUDIO_CACHE_DIR", os.path.join(DATA_DIR, "audio"))
+AUDIO_DOWNMIX = _env("AUDIO_DOWNMIX", "1") == "1"
+AUDIO_SAMPLE_RATE = int(_env("AUDIO_SAMPLE_RATE", "16000"))
+# Gemini のアップロードファイルは48時間で消えるため、少し手前で上げ直す
+AUDIO_UPLOAD_TTL = int(_env("AUDIO_UPLOAD_TTL", str(47 * 3600)))
+# アップロードしたファイルがサーバー側で使えるようになるまで待つ上限（秒）
+AUDIO_UPLOAD_TIMEOUT = float(_env("AUDIO_UPLOAD_TIMEOUT", "300"))
+
+# 1ターンごとの計測結果の出力先（カンマ区切りで "jsonl" / "prometheus"。空なら出力しない）
+METRICS_SINKS = _env("METRICS_SINKS", "")
+METRICS_LOG_PATH = _env("METRICS_LOG_PATH", "ijime_metrics.jsonl")
+METRICS_PROM_PATH = _env("METRICS_PROM_PATH", "")
+METRICS_PORT = int(_env("METRICS_PORT", "0"))
+
+# HTTP API（api_server.py）：1リクエストの上限サイズ、保持する会話の数と保持時間（秒）
+API_MAX_UPLOAD_BYTES = int(_env("API_MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+API_MAX_SESSIONS = int(_env("API_MAX_SESSIONS", "1000"))
+API_SESSION_TTL = int(_env("API_SESSION_TTL", str(6 * 3600)))
+
+# 会話の保存先（SQLite。空にするとメモリ上だけで動き、再起動で会話が消える）と保存期間（日）
+SESSION_DB_PATH = _env("SESSION_DB_PATH", os.path.join(DATA_DIR, "sessions.sqlite3"))
+SESSION_RETENTION_DAYS = int(_env("SESSION_RETENTION_DAYS", "30"))
+# 画面の会話を再開するためのクッキーの署名鍵（空なら DATA_DIR に作って保存する）
+SESSION_SECRET = _env("SESSION_SECRET", "")
+# チャット履歴の表示（直近この数のやり取りだけをそのまま表示し、古いものはこの数ずつ折りたたむ）
+CHAT_RECENT_TURNS = int(_env("CHAT_RECENT_TURNS", "10"))
+CHAT_PAGE_TURNS = int(_env("CHAT_PAGE_TURNS", "20"))
+
+# 回答の引用チェック（罫線ボックスの資料名・条・項・URLを法律データと照合する。"0" で無効）と、付ける原文の長さ
+CITATION_CHECK = _env("CITATION_CHECK", "1") == "1"
+CITATION_EXCERPT_CHARS = int(_env("CITATION_EXCERPT_CHARS", "160"))
+
+# 条文を引くだけの質問（「第23条第5項を全文で」など）はAIを呼ばずに原文を返す（"0" で無効）。この文字数を超える質問は対象外
+LOCAL_LOOKUP = _env("LOCAL_LOOKUP", "1") == "1"
+LOCAL_LOOKUP_MAX_CHARS = int(_env("LOCAL_LOOKUP_MAX_CHARS", "40"))
+
+# 事前計算したデータ（法律データの索引・検索索引）の保存先。空にすると毎回起動時に作る
+ARTIFACT_DIR = _env("ARTIFACT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ijime_support"))
+
+# 読み込める履歴ファイルのメッセージ数の上限
+HISTORY_MAX_MESSAGES = int(_env("HISTORY_MAX_MESSAGES", "5000"))
+
+# ケースフォルダの一括分析（batch.py）：同時に処理するケースの数、ケースごとの質問を書くファイルの名前
+BATCH_WORKERS = int(_env("BATCH_WORKERS", "4"))
+BATCH_QUESTION_FILE = _env("BATCH_QUESTION_FILE", "question.txt")
+
+# 画面からの分析はバックグラウンドのジョブとして動かす（同時に動かすジョブの数、
+# 画面が進み具合を確かめる間隔・秒、終わったジョブの結果を残しておく秒数）
+JOB_WORKERS = int(_env("JOB_WORKERS", "4"))
+JOB_POLL_SECONDS = float(_env("JOB_POLL_SECONDS", "0.5"))
+JOB_RESULT_TTL = int(_env("JOB_RESULT_TTL", "600"))
+
+# 会話ごとの証拠資料の索引（PDFのページ・表の行を保存して検索する。"0" か保存先を空にすると従来どおり全文を送る）
+# この量を超えるPDFは全文の代わりに、質問に関係する箇所（上位 EVIDENCE_TOP_K 件・予算内）だけを送る
+# （学校からの通常の手紙・報告書は全文を送る大きさにしておく。関係する箇所が見つからなければ冒頭を送る）
+EVIDENCE_INDEX = _env("EVIDENCE_INDEX", "1") == "1"
+EVIDENCE_DIR = _env("EVIDENCE_DIR", os.path.join(DATA_DIR, "evidence"))
+EVIDENCE_FULL_TOKENS = int(_env("EVIDENCE_FULL_TOKENS", "20000"))
+EVIDENCE_TOP_K = int(_env("EVIDENCE_TOP_K", "12"))
+EVIDENCE_TOKEN_BUDGET = int(_env("EVIDENCE_TOKEN_BUDGET", "4000"))
+# 箇所の大きさ（PDFは1ページをこの文字数ほどで区切る、表はこの行数ずつ）、開いたままにする索引の数、検索結果の表示の長さ
+EVIDENCE_PASSAGE_CHARS = int(_env("EVIDENCE_PASSAGE_CHARS", "800"))
+EVIDENCE_ROWS_PER_PASSAGE = int(_env("EVIDENCE_ROWS_PER_PASSAGE", "10"))
+EVIDENCE_OPEN_STORES = int(_env("EVIDENCE_OPEN_STORES", "32"))
+EVIDENCE_SNIPPET_CHARS = int(_env("EVIDENCE_SNIPPET_CHARS", "160"))
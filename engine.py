@@ -0,0 +1,341 @@
+import functools
+import io
+import time
+import uuid
+from collections import namedtuple
+
+import attachments
+import backends
+import citations
+import config
+import evidence_store
+import history
+import lookup
+import metrics
+import model_cache
+import prompts
+import rate_limit
+import response_cache
+import routing
+import session_store
+
+# ==============================================================================
+# 相談の分析エンジン（画面に依存しない本体）
+# 証拠資料の取り込み・プロンプトの組み立て・履歴・AIの呼び出し・エラーの区分けをまとめる。
+# Streamlit の画面（app.py）も HTTP API（api_server.py）も、ここを呼ぶだけにする。
+# ==============================================================================
+
+GREETING = "こんにちは。学校の対応について、法律やガイドラインに基づいた分析を行います。\n証拠資料（PDF、録音、写真など）があればアップロードしてください。"
+
+# 安全フィルターの完全解除（google.generativeai は文字列の指定も受け付ける）
+SAFETY_SETTINGS = {
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
+}
+
+# エラーの区分（metrics.classify_error）→ (表示の種類, 利用者への案内)
+ERROR_NOTICES = {
+    "queue_full": ("warning", "⚠️ **現在、アクセスが集中しています**\n\n順番待ちの人数が多いため送信できませんでした。数分後にもう一度入力してください。"),
+    "rate_limited": ("warning", "⚠️ **現在、アクセスが集中しています**\n\n1分ほど時間を空けてから、もう一度入力してください。"),
+    "server_error": ("warning", "⚠️ **一時的なサーバーエラーです**\n\nGoogleのAIサーバー側で一時的な不具合が発生しました。少し時間を置いてからもう一度お試しください。"),
+    "safety": ("error", "⚠️ **回答できませんでした**\n\nAIの安全フィルターにより回答が中断されました。言い回しを変えて再度お試しください。"),
+    "other": ("error", "システムエラーが発生しました: {error}"),
+}
+
+# kind: "notice"（資料の読込エラーなど）/ "chunk"（回答の一部）/ "done"（回答の完成）/ "error"（失敗）
+#       / "cancelled"（取り消し。cancel を渡したときだけ）
+Event = namedtuple("Event", ["kind", "data"])
+
+# 処理の段階（on_stage に渡す名前 → 画面に出す説明）。送信の順番待ちは on_wait で別に知らせる
+STAGES = {
+    "history": "会話の履歴を整理しています",
+    "attachments": "資料を読み込んでいます（解析・アップロード）",
+    "evidence": "資料から質問に関係する箇所を探しています",
+    "law_context": "関連する条文を探しています",
+    "send_message": "AIに送信しています",
+    "receiving": "回答を受け取っています",
+    "citations": "引用を法律データと照合しています",
+}
+CANCELLED_NOTE = "⏹️ 分析を取り消しました。"
+
+
+class Upload(io.BytesIO):
+    """アップロードされたファイル（Streamlit の UploadedFile と同じく name・type・getvalue を持つ）。"""
+
+    def __init__(self, data, name, mime_type):
+        super().__init__(data)
+        self.name = name
+        self.type = mime_type
+
+
+def configure(api_key):
+    backends.configure(api_key)
+
+
+def get_model(profile=None):
+    """全セッション共通のモデル（model_cache でプロファイルごとに1つだけ作る）。既定は通常のモデル。"""
+    profile = profile or routing.PROFILES["full"]
+    return model_cache.get_model(backends.get_backend(), profile.model_name,
+                                 routing.system_instruction(profile), SAFETY_SETTINGS)
+
+
+def error_notice(error):
+    """例外を (区分, 表示の種類, 利用者への案内) にする。"""
+    category = metrics.classify_error(error)
+    level, message = ERROR_NOTICES[category]
+    return category, level, message.format(error=error)
+
+
+# ---------------------------------------------------------
+# 会話
+# ---------------------------------------------------------
+class Session:
+    """
+    1人の相談者との会話（メッセージと、この会話で送信済みの資料）。
+    store（session_store.SessionStore）があれば、メッセージを1件ずつ書き込み、同じIDで再開できる。
+    """
+
+    def __init__(self, session_id=None, messages=None, store=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.store = store
+        if messages is not None:
+            self.load(messages)
+        elif store is not None and session_id:
+            # サーバーの再起動後などは、保存してある会話から再開する
+            self._set(store.load_messages(self.session_id))
+        else:
+            self._set(None)
+
+    def _set(self, messages):
+        self.messages = list(messages) if messages else [{"role": "assistant", "content": GREETING}]
+        self.sent_attachments = {
+            a["digest"]: a["name"] for message in self.messages for a in message.get("attachments", [])
+        }
+        # 保存先に書き込み済みのメッセージ数（最初の挨拶だけの会話は、質問が来るまで書き込まない）
+        self._saved = len(messages) if messages else 0
+
+    def load(self, messages=None):
+        """保存した履歴から再開する（None なら最初の挨拶だけの会話にする）。"""
+        self._set(messages)
+        if self.store is not None:
+            self.store.replace_messages(self.session_id, self.messages[:self._saved])
+
+    def reset(self):
+        """最初からやり直す（送った資料の索引・抽出結果・録音も消す）。"""
+        self.delete_evidence()
+        self.load(None)
+
+    def delete_evidence(self):
+        """この会話で送った資料の索引・抽出結果・録音をディスクとキャッシュから消す。"""
+        evidence_store.delete_session(self.session_id)
+        attachments.delete(list(self.sent_attachments))
+        self.sent_attachments = {}
+
+    def append(self, message):
+        self.messages.append(message)
+        if self.store is not None:
+            for seq in range(self._saved, len(self.messages)):
+                self.store.put_message(self.session_id, seq, self.messages[seq])
+        self._saved = len(self.messages)
+
+    def update(self, index):
+        """index 番目のメッセージを書き直す（添付資料の記録を付けたときなど）。"""
+        index %= len(self.messages)
+        if self.store is not None and index < self._saved:
+            self.store.put_message(self.session_id, index, self.messages[index])
+
+
+def open_session(session_id=None):
+    """設定された保存先（config.SESSION_DB_PATH）につながった会話を開く。保存済みなら続きから。"""
+    return Session(session_id, store=session_store.get_store())
+
+
+def run_turn(session, prompt, uploaded_files=(), on_wait=None, stream=None, on_stage=None, cancel=None):
+    """
+    1回の質問を処理し、Event を順に返すジェネレーター。
+    最後は必ず "done" か "error" になり、done のときは回答が session.messages に追加されている。
+    回答の引用（罫線ボックス）は法律データと照合し、結果を回答の末尾に付ける（done の "citations" にも入れる）。
+    条文を引くだけの質問は lookup が法律データから直接答え、AIは呼ばない（done の "local" が True）。
+    on_wait(rate_limit.WaitStatus) は送信の順番待ち・自動再送のあいだ呼ばれる。
+    on_stage(段階の名前) は STAGES の各段階に入るときに呼ばれる。
+    cancel（threading.Event）が立つと、AIへの送信前か受信の途中で止め、取り消しの一言を回答として残して
+    "cancelled" で終わる（送信前に止めれば割り当て量は使わない）。
+    """
+    stream = config.STREAMING if stream is None else stream
+    session.append({"role": "user", "content": prompt})
+
+    def stage(name, cancellable=True):
+        if cancellable and cancel is not None and cancel.is_set():
+            raise rate_limit.Cancelled(f"{name} の前に取り消されました")
+        if on_stage:
+            on_stage(name)
+
+    # 1ターン分の処理時間・トークン数・エラーを計測する（出力先は config.METRICS_SINKS）
+    with metrics.Turn(session.session_id) as turn:
+        try:
+            # 記憶の再構築（トークン予算を超える古いやり取りは要約にまとめる。
+            # 本文が資料の索引にある送信済みの資料は、履歴では名前だけにして、質問ごとの抜粋で送る）
+            stage("history")
+            evidence = evidence_store.get_store(session.session_id)
+            referenced = evidence.searchable_digests(session.sent_attachments) if evidence is not None else []
+            with turn.span("history"):
+                history_for_gemini = history.build_history(
+                    session.messages[:-1], parts_for=functools.partial(attachments.history_parts, store=evidence)
+                )
+
+            # 送信コンテンツの準備
+            content_parts = [prompt]
+
+            # 添付資料（複数ファイルは並列に前処理し、中身のハッシュでキャッシュ。この会話で送信済みの資料は名前だけ送る）
+            stage("attachments")
+            with turn.span("attachments"):
+                evidence_parts, evidence_texts, new_evidence, load_errors = attachments.collect_new_evidence(
+                    uploaded_files, session.sent_attachments
+                )
+            for load_error in load_errors:
+                yield Event("notice", load_error)
+            content_parts.extend(evidence_parts)
+
+            # 資料の索引に登録する（以前のターンで送った資料も未登録なら加える。画面の資料検索にも使う）
+            if evidence is not None:
+                with turn.span("evidence_index"):
+                    earlier = (attachments.CACHE.get(digest) for digest in session.sent_attachments
+                               if digest not in evidence.documents)
+                    for item in [*earlier, *new_evidence]:
+                        if item is not None:
+                            evidence.add(item)
+
+            # 条文を引くだけの質問は、AIを呼ばずに法律データの原文を返す。
+            # 資料やそれまでのやり取りがある会話では、同じ言い回しでも状況に当てはめる質問なのでAIに任せる
+            local = None
+            earlier_turns = any(message["role"] == "user" for message in session.messages[:-1])
+            if config.LOCAL_LOOKUP and not (new_evidence or session.sent_attachments or earlier_turns):
+                with turn.span("local_lookup"):
+                    local = lookup.answer(prompt)
+            turn.attributes["local_answer"] = local is not None
+            if local is not None:
+                answer, cached, checked = local, False, []
+                yield Event("chunk", answer)
+            else:
+                # 大きなPDF・表と、履歴で名前だけにした資料からは、質問に関係する箇所だけを資料名・ページ（行）付きで送る
+                if evidence is not None:
+                    digests = list(dict.fromkeys([
+                        *referenced,
+                        *evidence.excerpt_digests([*session.sent_attachments, *(i.digest for i in new_evidence)]),
+                    ]))
+                    if digests:
+                        stage("evidence")
+                        with turn.span("evidence_search"):
+                            excerpt = evidence_store.excerpt(evidence, prompt, digests)
+                        if excerpt:
+                            content_parts.append(excerpt)
+                        turn.attributes["evidence_excerpt_chars"] = len(excerpt)
+
+                # 質問と証拠資料に関連する条文だけを添付（全文送信モードでは何もしない）
+                stage("law_context")
+                with turn.span("law_context"):
+                    law_context = prompts.build_law_context(prompts.RETRIEVER, prompt, evidence_texts)
+                if law_context:
+                    content_parts.append(law_context)
+
+                # 使うモデルを選ぶ（資料の分析・最初の相談は通常のモデル、短い追加の質問は軽いモデル）
+                route = routing.route(prompt, new_evidence, history_for_gemini)
+                profile = route.profile
+                turn.attributes.update(model_profile=profile.name, model=profile.model_name, route_reason=route.reason)
+
+                # 同じ入力（モデル・法律データ・履歴・質問・添付資料）の分析済みの回答があればそれを使う
+                cache_key = response_cache.make_key(profile.model_name, routing.system_instruction(profile),
+                                                    history_for_gemini, content_parts)
+                answer = response_cache.get_cache().get(cache_key) if config.RESPONSE_CACHE else None
+                cached = answer is not None
+                turn.attributes["response_cache_hit"] = cached
+                checked = []
+                if cached:
+                    yield Event("chunk", answer)
+                else:
+                    with turn.span("start_chat"):
+                        chat = get_model(profile).start_chat(history=history_for_gemini)
+
+                    # AIへ送信（全利用者共通の順番待ち。混雑による一時的なエラーは自動で再送する）
+                    stage("send_message")
+                    sent_at = time.monotonic()
+                    with turn.span("send_message", kind=profile.name):
+                        response = rate_limit.send_message(
+                            chat,
+                            content_parts,
+                            session_id=session.session_id,
+                            on_wait=on_wait,
+                            cancel=cancel,
+                            generation_config={"temperature": 0.0},
+                            safety_settings=SAFETY_SETTINGS,
+                            stream=stream
+                        )
+
+                    if stream:
+                        # 届いた部分から順に返す（途中で止まった場合も下の except で同じように案内する）
+                        stage("receiving")
+                        texts = []
+                        for chunk in turn.stream(response, sent_at, kind=profile.name):
+                            texts.append(chunk.text)
+                            yield Event("chunk", chunk.text)
+                            if cancel is not None and cancel.is_set():
+                                raise rate_limit.Cancelled("受信の途中で取り消されました")
+                        answer = "".join(texts)
+                    else:
+                        answer = response.text
+                        turn.record("response_total", time.monotonic() - sent_at, kind=profile.name)
+                        turn.set_usage(response.usage_metadata)
+
+                    # 引用の照合（AIを呼ばずに手元で。URLの誤りは保存する回答で直す）
+                    report = ""
+                    if config.CITATION_CHECK:
+                        stage("citations", cancellable=False)
+                        with turn.span("citations"):
+                            answer, checked = citations.verify(answer)
+                            report = citations.format_report(checked)
+                        turn.attributes["citations"] = len(checked)
+                        turn.attributes["citations_unverified"] = sum(
+                            c.status in ("not_found", "unknown_document") for c in checked
+                        )
+                    if not stream:
+                        yield Event("chunk", answer)
+                    if report:
+                        answer += report
+                        yield Event("chunk", report)
+                    if config.RESPONSE_CACHE:
+                        response_cache.get_cache().put(cache_key, answer)
+            session.append({"role": "assistant", "content": answer})
+
+            # 今回送った資料を記録し、次の質問からは再送しない
+            if new_evidence:
+                session.messages[-2]["attachments"] = attachments.attachment_records(new_evidence)
+                session.update(-2)
+                for item in new_evidence:
+                    session.sent_attachments[item.digest] = item.name
+            yield Event("done", {"answer": answer, "cached": cached, "local": local is not None,
+                                 "citations": [citation._asdict() for citation in checked]})
+
+        except rate_limit.Cancelled:
+            turn.attributes["cancelled"] = True
+            session.append({"role": "assistant", "content": CANCELLED_NOTE})
+            yield Event("cancelled", {"message": CANCELLED_NOTE})
+
+        except Exception as e:
+            turn.fail(e)
+            category, level, message = error_notice(e)
+            yield Event("error", {"category": category, "level": level, "message": message})
+
+
+def answer(session, prompt, uploaded_files=(), on_wait=None):
+    """ストリーミングしない呼び出し。戻り値: (回答またはNone, 読込エラーなどの案内, 失敗時のエラー情報)"""
+    notices, error, final = [], None, None
+    for event in run_turn(session, prompt, uploaded_files, on_wait=on_wait, stream=False):
+        if event.kind == "notice":
+            notices.append(event.data)
+        elif event.kind == "done":
+            final = event.data["answer"]
+        elif event.kind == "error":
+            error = event.data
+    return final, notices, error
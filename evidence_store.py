@@ -0,0 +1,474 @@
+import contextlib
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from functools import lru_cache
+
+import config
+import pdf_extract
+from retrieval import char_ngrams
+from tokens import estimate_tokens
+
+# ==============================================================================
+# 会話ごとの証拠資料の索引
+# PDFのページ・表の行を「箇所」に分けてディスクに保存し（本文はメモリマップで読む）、文字n-gramの転置索引を作る。
+# 大きな資料は全文を毎回送らず、質問に関係する箇所だけを資料名・ページ（行）付きで送る。
+# 画面の「資料の中を検索」も同じ索引を使う。
+# 保存先は本人だけが使えるフォルダに限り、ファイルはどれも JSON・テキストのまま追記する（読み込んでもコードは動かない）。
+# ==============================================================================
+
+# first: 最初の箇所の通し番号、passages: 箇所の数
+# excerpt: 質問ごとの抜粋の対象にするか（大きなPDFと表。小さなPDFは全文を送るので対象にしない）
+Document = namedtuple("Document", ["digest", "name", "kind", "first", "passages", "excerpt"])
+# location: "P.3" / "シート「出欠」21〜30行目" など、position: 索引での通し番号（資料内の順序）
+# score: 検索の関連度（質問に合う箇所が無かった資料の代わりに送る冒頭の箇所は None）
+Passage = namedtuple("Passage", ["digest", "name", "location", "text", "score", "position"])
+
+TEXT_FILE = "text.bin"
+INDEX_FILE = "index.jsonl"
+# 表の行のまとまりを、読み込んだ作業プロセスから索引に渡すための書き出し先（資料のハッシュごと。会話をまたいで使う）
+SPOOL_DIR = "spool"
+EXCERPT_HEADER = "【資料からの抜粋】ご相談の資料から、今回の質問に関係する箇所だけを抜き出しました（■資料名・ページ／行の順）。"
+
+
+@lru_cache(maxsize=256)
+def _text_tokens(text):
+    # 同じ資料は毎ターン履歴の組み立てで確かめるので、数え直さない
+    return estimate_tokens(text)
+
+
+def is_excerpted(item):
+    """全文の代わりに抜粋を送る資料か（索引が無効なら常に全文）。"""
+    return (item.kind == "pdf" and bool(item.text) and _text_tokens(item.text) > config.EVIDENCE_FULL_TOKENS
+            and available())
+
+
+def private_dir(path, create=True):
+    """
+    本人だけが読み書きできるフォルダか確かめる（create なら無ければ 0700 で作る）。戻り値: フォルダがあるか
+    ほかのユーザーが先に作ったフォルダやシンボリックリンクは使わない（中のファイルを差し替えられるため）。
+    """
+    if create:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISDIR(info.st_mode) or (hasattr(os, "getuid") and info.st_uid != os.getuid()):
+        raise PermissionError(f"本人だけが使えるフォルダではありません: {path}")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+    return True
+
+
+def _windows(text, limit):
+    """長いページは行の切れ目で limit 文字ほどずつに分ける。"""
+    block, size = [], 0
+    for line in text.splitlines():
+        if block and size + len(line) > limit:
+            yield "\n".join(block)
+            block, size = [], 0
+        block.append(line)
+        size += len(line) + 1
+    if any(line.strip() for line in block):
+        yield "\n".join(block)
+
+
+def _spool_path(digest):
+    return os.path.join(config.EVIDENCE_DIR, SPOOL_DIR, f"{digest}.jsonl")
+
+
+class _SpoolWriter:
+    def __init__(self, f):
+        self._file = f
+
+    def append(self, passage):
+        self._file.write(json.dumps(passage, ensure_ascii=False) + "\n")
+
+
+@contextlib.contextmanager
+def spool(digest):
+    """
+    表の (場所, 本文) を1件ずつ書き出す先（append で渡す）。作業プロセスから使い、書き終えたものだけを残す。
+    索引を使えなければ None。
+    """
+    if not available():
+        yield None
+        return
+    directory = os.path.dirname(_spool_path(digest))
+    try:
+        private_dir(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    except OSError:
+        # 書き出せなければ表は概要だけで扱う（読み込み自体は続ける）
+        yield None
+        return
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            yield _SpoolWriter(f)
+        os.replace(tmp, _spool_path(digest))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def split_passages(item):
+    """資料を (場所, 本文) の箇所に分ける。PDFはページ、表は読み込んだときに書き出した行のまとまり（spool）。"""
+    if item.kind == "pdf" and item.text:
+        for number, text in pdf_extract.split_pages(item.text):
+            for window in _windows(text, config.EVIDENCE_PASSAGE_CHARS):
+                yield f"P.{number}", window
+    elif item.kind == "table":
+        path = _spool_path(item.digest)
+        try:
+            f = open(path, encoding="utf-8")
+        except FileNotFoundError:
+            # 書き出しが消えた表（保存期間を過ぎたものなど）は概要だけで扱う
+            return
+        with f:
+            os.utime(path)
+            for line in f:
+                location, text = json.loads(line)
+                yield location, text
+
+
+class EvidenceStore:
+    """
+    1つの会話の資料の索引。本文は text.bin に、資料ごとの箇所の一覧（場所・本文の位置）は index.jsonl に1行ずつ追記する。
+    転置索引は保存せず、開くときに本文から作り直す（資料を足すたびに索引全体を書き直さない）。
+    複数のスレッド（分析ジョブと画面の検索）から使われる。
+    """
+
+    def __init__(self, directory, n=2, k1=1.2, b=0.75):
+        self.directory = directory
+        self.n, self.k1, self.b = n, k1, b
+        self._lock = threading.Lock()
+        self._map = None
+        self.documents = {}                     # digest → Document
+        self.passages = []                      # (digest, 場所, 本文の開始位置, バイト数)
+        self.lengths = array("I")               # 箇所ごとの n-gram の数
+        self.postings = defaultdict(lambda: (array("I"), array("I")))   # n-gram → (箇所の番号, 出現回数)
+        if private_dir(directory, create=False):
+            self._load()
+
+    def _load(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        # 書きかけで途切れた最後の行（文字の途中で切れていることもある）は読み飛ばす
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                    document = Document(record["digest"], record["name"], record["kind"], len(self.passages),
+                                        len(record["passages"]), record["excerpt"])
+                    passages = [(location, offset, length) for location, offset, length in record["passages"]]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                for location, offset, length in passages:
+                    pid = len(self.passages)
+                    self.passages.append((document.digest, location, offset, length))
+                    self._index(pid, self._text(pid))
+                self.documents[document.digest] = document
+
+    def _index(self, pid, text):
+        grams = Counter(char_ngrams(text, self.n))
+        self.lengths.append(sum(grams.values()))
+        for gram, tf in grams.items():
+            ids, counts = self.postings[gram]
+            ids.append(pid)
+            counts.append(tf)
+
+    # ---------------------------------------------------------
+    # 登録
+    # ---------------------------------------------------------
+    def add(self, item):
+        """資料の箇所を登録する（本文の無い写真・音声は資料名だけ記録する）。戻り値: 登録した箇所の数"""
+        with self._lock:
+            if item.digest in self.documents:
+                return 0
+            private_dir(self.directory)
+            first, locations = len(self.passages), []
+            with open(os.path.join(self.directory, TEXT_FILE), "ab") as f:
+                offset = f.tell()
+                for location, text in split_passages(item):
+                    data = text.encode("utf-8")
+                    f.write(data)
+                    pid = len(self.passages)
+                    self.passages.append((item.digest, location, offset, len(data)))
+                    locations.append((location, offset, len(data)))
+                    offset += len(data)
+                    self._index(pid, text)
+            excerpt = item.kind == "table" or is_excerpted(item)
+            record = {"digest": item.digest, "name": item.name, "kind": item.kind, "excerpt": excerpt,
+                      "passages": locations}
+            with open(os.path.join(self.directory, INDEX_FILE), "ab+") as f:
+                # 前回が行の途中で止まっていたら、改行してから続きを書く
+                end = f.seek(0, os.SEEK_END)
+                if end:
+                    f.seek(end - 1)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+                f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.documents[item.digest] = Document(item.digest, item.name, item.kind, first, len(locations), excerpt)
+            return len(locations)
+
+    # ---------------------------------------------------------
+    # 本文（メモリマップ）
+    # ---------------------------------------------------------
+    def _text(self, pid):
+        _, _, offset, length = self.passages[pid]
+        if self._map is None or offset + length > len(self._map):
+            # 追記で大きくなったファイルは開き直す
+            self._unmap()
+            with open(os.path.join(self.directory, TEXT_FILE), "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length].decode("utf-8")
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+
+    # ---------------------------------------------------------
+    # 検索（BM25）
+    # ---------------------------------------------------------
+    def search(self, query, top_k, digests=None):
+        """
+        query に関係する箇所を関連度の高い順に返す。digests を渡すとその資料だけから探す。
+        """
+        with self._lock:
+            total = len(self.passages)
+            if not total:
+                return []
+            avgdl = sum(self.lengths) / total
+            scores = defaultdict(float)
+            for gram in set(char_ngrams(query, self.n)):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    continue
+                ids, counts = posting
+                idf = math.log(1 + (total - len(ids) + 0.5) / (len(ids) + 0.5))
+                for pid, tf in zip(ids, counts):
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[pid] / avgdl)
+                    scores[pid] += idf * tf * (self.k1 + 1) / (tf + norm)
+            if digests is not None:
+                digests = set(digests)
+                scores = {pid: score for pid, score in scores.items() if self.passages[pid][0] in digests}
+            best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [
+                Passage(self.passages[pid][0], self.documents[self.passages[pid][0]].name,
+                        self.passages[pid][1], self._text(pid), score, pid)
+                for pid, score in best
+            ]
+
+    def leading(self, digest, count):
+        """資料の先頭から count 箇所（質問に合う箇所が見つからなかった資料の代わりに送る）。"""
+        with self._lock:
+            document = self.documents[digest]
+            return [
+                Passage(digest, document.name, self.passages[pid][1], self._text(pid), None, pid)
+                for pid in range(document.first, document.first + min(count, document.passages))
+            ]
+
+    def excerpt_digests(self, digests):
+        """digests のうち、質問ごとの抜粋の対象になる資料。"""
+        return [digest for digest in digests if digest in self.documents and self.documents[digest].excerpt]
+
+    def searchable_digests(self, digests):
+        """digests のうち、本文のある（検索できる）資料。"""
+        return [digest for digest in digests if digest in self.documents and self.documents[digest].passages]
+
+
+def _fit(passages, budget):
+    """先頭から予算内に収まる箇所を選ぶ（収まらない箇所は飛ばして次を見る）。戻り値: (選んだ箇所, 使った量)"""
+    chosen, used = [], 0
+    for passage in passages:
+        cost = estimate_tokens(passage.text)
+        if used + cost > budget:
+            continue
+        chosen.append(passage)
+        used += cost
+    return chosen, used
+
+
+def format_passages(passages, budget=None):
+    """
+    関連度の高い順に予算内の箇所を選び、資料・ページ順に並べ直して送信用のテキストにする。
+    """
+    chosen, _ = _fit(passages, config.EVIDENCE_TOKEN_BUDGET if budget is None else budget)
+    if not chosen:
+        return ""
+    # 資料は最も関連する箇所の順、同じ資料の中はページ（行）の順に並べる
+    rank = {}
+    for passage in chosen:
+        rank.setdefault(passage.digest, len(rank))
+    chosen.sort(key=lambda p: (rank[p.digest], p.position))
+    blocks = [EXCERPT_HEADER]
+    blocks += [f"■{p.name}　{p.location}{'（冒頭）' if p.score is None else ''}\n{p.text.strip()}" for p in chosen]
+    return "\n\n".join(blocks)
+
+
+def excerpt(store, query, digests, top_k=None, budget=None):
+    """
+    digests の資料から送る抜粋。質問に関係する箇所を予算内で選び、全文を送っていないPDFで1箇所も選ばれなかった
+    ものは、残りの予算で冒頭の箇所を送る（質問に合う言葉が無くても、資料の中身が何も届かないことがないように）。
+    """
+    budget = config.EVIDENCE_TOKEN_BUDGET if budget is None else budget
+    hits = store.search(query, config.EVIDENCE_TOP_K if top_k is None else top_k, digests)
+    withheld = [digest for digest in digests if store.documents[digest].kind == "pdf"]
+    # 検索で1箇所も見つからない資料があれば、冒頭の分として予算の半分を残しておく
+    found = {passage.digest for passage in hits}
+    reserve = budget // 2 if any(digest not in found for digest in withheld) else 0
+    chosen, used = _fit(hits, budget - reserve)
+    chosen_digests = {passage.digest for passage in chosen}
+    missing = [digest for digest in withheld if digest not in chosen_digests]
+    if missing:
+        share = max((budget - used) // len(missing), budget // (2 * len(withheld)))
+        for digest in missing:
+            # 1資料の分は、予算の残りを超えない
+            share = min(share, budget - used)
+            if share <= 1:
+                break
+            leading = store.leading(digest, max(share // config.EVIDENCE_PASSAGE_CHARS, 1) + 1)
+            if not leading:
+                continue
+            picked, cost = _fit(leading, share)
+            if not picked:
+                # 1箇所も収まらなければ、最初の箇所を予算の分だけ切り詰めて送る
+                picked = [leading[0]._replace(text=leading[0].text[:share - 1])]
+                cost = estimate_tokens(picked[0].text)
+            chosen += picked
+            used += cost
+    return format_passages(chosen, budget=math.inf)
+
+
+def snippet(text, query, width=None):
+    """検索結果の表示用に、query の語が最初に出てくるあたりを切り出す。"""
+    width = width or config.EVIDENCE_SNIPPET_CHARS
+    flat = unicodedata.normalize("NFKC", " ".join(text.split()))
+    lowered = flat.lower()
+    # 入力した語そのままの出現を優先し、無ければ2文字ずつの一致で探す
+    terms = unicodedata.normalize("NFKC", query).lower().split()
+    positions = [lowered.find(term) for term in terms if term in lowered]
+    positions = positions or [lowered.find(gram) for gram in char_ngrams(query) if gram in lowered]
+    start = max(min(positions) - width // 4, 0) if positions else 0
+    piece = flat[start:start + width]
+    return ("…" if start else "") + piece + ("…" if start + width < len(flat) else "")
+
+
+# ==============================================================================
+# 会話ごとの索引を開く（開いたままにする数に上限。使われなくなった索引は保存期間を過ぎたら消す）
+# ==============================================================================
+_stores = OrderedDict()
+_stores_lock = threading.Lock()
+_purged = False
+
+
+def _directory(session_id):
+    # 会話IDをそのままフォルダ名にしない（外から渡されるIDでも安全な名前にする）
+    return os.path.join(config.EVIDENCE_DIR, hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32])
+
+
+def _last_used(path):
+    """最後に使われた時刻。索引のフォルダは中のファイルの追記も含めて一番新しい時刻（追記ではフォルダの時刻は変わらない）。"""
+    times = [os.path.getmtime(path)]
+    if os.path.isdir(path):
+        times += [os.path.getmtime(os.path.join(path, name)) for name in os.listdir(path)]
+    return max(times)
+
+
+def purge(days):
+    """しばらく使われていない会話の索引を消す（開くたびにフォルダの時刻を新しくしている）。"""
+    if not private_dir(config.EVIDENCE_DIR, create=False):
+        return
+    cutoff = time.time() - days * 86400
+    spooled = os.path.join(config.EVIDENCE_DIR, SPOOL_DIR)
+    paths = [os.path.join(config.EVIDENCE_DIR, name) for name in os.listdir(config.EVIDENCE_DIR) if name != SPOOL_DIR]
+    if os.path.isdir(spooled):
+        paths += [os.path.join(spooled, name) for name in os.listdir(spooled)]
+    for path in paths:
+        try:
+            if _last_used(path) >= cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+@lru_cache(maxsize=1)
+def available():
+    """索引を使えるか（EVIDENCE_INDEX が有効で、保存先が本人だけのフォルダとして用意できる）。"""
+    if not (config.EVIDENCE_INDEX and config.EVIDENCE_DIR):
+        return False
+    try:
+        return private_dir(config.EVIDENCE_DIR)
+    except OSError:
+        # 使えない保存先なら索引を使わず、これまでどおり全文を送る
+        return False
+
+
+def get_store(session_id):
+    """会話の資料の索引。索引を使えなければ None。"""
+    global _purged
+    if not available():
+        return None
+    with _stores_lock:
+        if not _purged:
+            purge(config.SESSION_RETENTION_DAYS)
+            _purged = True
+        store = _stores.get(session_id)
+        if store is None:
+            try:
+                store = EvidenceStore(_directory(session_id))
+            except PermissionError:
+                return None
+            _stores[session_id] = store
+            while len(_stores) > config.EVIDENCE_OPEN_STORES:
+                _, old = _stores.popitem(last=False)
+                old.close()
+        _stores.move_to_end(session_id)
+    try:
+        os.utime(store.directory)
+    except FileNotFoundError:
+        pass
+    return store
+
+
+def delete_session(session_id):
+    """会話の索引（本文・箇所の一覧）を消す。会話の削除・やり直しのときに呼ぶ。"""
+    if not available():
+        return
+    with _stores_lock:
+        store = _stores.pop(session_id, None)
+    if store is not None:
+        store.close()
+    shutil.rmtree(_directory(session_id), ignore_errors=True)
+
+
+def delete_spool(digest):
+    """表の行の書き出しを消す。"""
+    if not available():
+        return
+    try:
+        os.remove(_spool_path(digest))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,144 @@
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+
+# ==============================================================================
+# ローカルの代替バックエンド（テスト・ベンチマーク用）
+# GenerativeModel.start_chat / ChatSession.send_message と同じ呼び出し方で動き、APIは呼ばない
+# ==============================================================================
+
+UsageMetadata = namedtuple("UsageMetadata", ["prompt_token_count", "candidates_token_count", "total_token_count"])
+FakeChunk = namedtuple("FakeChunk", ["text"])
+FakeFile = namedtuple("FakeFile", ["name", "uri", "mime_type", "size_bytes"])
+
+
+class FakeResourceExhausted(Exception):
+    """Gemini API の 429 を模したエラー。"""
+
+
+def _part_size(part):
+    if isinstance(part, str):
+        return len(part)
+    if isinstance(part, dict):
+        return len(part.get("data", b"")) // 4 or len(part.get("parts", ()))
+    if hasattr(part, "size_bytes"):
+        return part.size_bytes // 500
+    return 256
+
+
+def default_reply(content):
+    prompt = content[0] if isinstance(content, list) and content and isinstance(content[0], str) else ""
+    return (
+        "【テスト応答】ご相談の内容を確認しました。\n\n"
+        "┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓\n\n"
+        "　📖 **根拠資料**\n　**いじめ防止対策推進法**\n\n"
+        "　📍 **該当箇所**\n　**【 第23条 第5項 】**\n\n"
+        "　🔗 **入手先URL**\n　https://elaws.e-gov.go.jp/document?lawid=425AC1000000071\n\n"
+        "┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛\n\n"
+        f"**解説:** 「{prompt[:40]}」について、学校は組織的に対応する義務があります。"
+    )
+
+
+class FakeResponse:
+    def __init__(self, chunks, usage_metadata, chunk_delay=0.0):
+        self._chunks = chunks
+        self._chunk_delay = chunk_delay
+        self.usage_metadata = usage_metadata
+
+    def __iter__(self):
+        for i, text in enumerate(self._chunks):
+            if i and self._chunk_delay:
+                time.sleep(self._chunk_delay)
+            yield FakeChunk(text)
+
+    def resolve(self):
+        pass
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history)
+
+    def send_message(self, content, generation_config=None, safety_settings=None, stream=False):
+        backend = self.model.backend
+        parts = content if isinstance(content, list) else [content]
+        with backend.lock:
+            backend.calls += 1
+            throttled = backend.fail_next > 0 or backend.random.random() < backend.error_rate
+            if throttled:
+                backend.fail_next = max(backend.fail_next - 1, 0)
+                backend.errors += 1
+        if throttled:
+            raise FakeResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+        latency = backend.model_latency.get(self.model.model_name, backend.latency)
+        if latency:
+            time.sleep(latency)
+
+        text = backend.reply(parts)
+        prompt_tokens = (len(self.model.system_instruction or "")
+                         + sum(_part_size(p) for m in self.history for p in m.get("parts", ()))
+                         + sum(_part_size(p) for p in parts))
+        usage = UsageMetadata(prompt_tokens, len(text), prompt_tokens + len(text))
+        size = backend.chunk_size if stream else len(text) or 1
+        chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        self.history.append({"role": "user", "parts": parts})
+        self.history.append({"role": "model", "parts": [text]})
+        return FakeResponse(chunks, usage, backend.chunk_delay if stream else 0.0)
+
+
+class FakeModel:
+    def __init__(self, backend, model_name, system_instruction, cached_content=None):
+        self.backend = backend
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.cached_content = cached_content
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history or [])
+
+
+class FakeBackend:
+    supports_context_cache = True
+
+    def __init__(self, latency=0.0, chunk_size=40, chunk_delay=0.0, reply=default_reply, error_rate=0.0, fail_next=0, seed=0,
+                 model_latency=None):
+        self.latency = latency
+        # モデル名ごとの応答までの秒数（軽いモデルへの振り分けを試すため。無いモデルは latency）
+        self.model_latency = dict(model_latency or {})
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.reply = reply
+        # error_rate: 送信が 429 になる確率、fail_next: 次の何回かを必ず 429 にする
+        self.error_rate = error_rate
+        self.fail_next = fail_next
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.models_created = 0
+        self.cached_contents = {}
+        self.uploaded_files = {}
+
+    def create_model(self, model_name, system_instruction, safety_settings):
+        with self.lock:
+            self.models_created += 1
+        return FakeModel(self, model_name, system_instruction)
+
+    def create_cached_model(self, model_name, system_instruction, safety_settings, ttl, display_name):
+        with self.lock:
+            self.models_created += 1
+            self.cached_contents[display_name] = system_instruction
+        return FakeModel(self, model_name, system_instruction, cached_content=display_name)
+
+    def upload_file(self, path, mime_type, display_name):
+        with self.lock:
+            self.uploaded_files[display_name] = path
+        name = f"files/{display_name}"
+        return FakeFile(name, f"fake://{name}", mime_type, os.path.getsize(path))
@@ -0,0 +1,144 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import attachments
+import citations
+import config
+from tokens import estimate_part_tokens, estimate_tokens
+
+# ==============================================================================
+# 会話履歴の組み立て（トークン予算つき）
+# 直近のやり取りはそのまま送り、古いやり取りは要約にまとめる。
+# 証拠資料や条文の引用を含むやり取りは、予算が許す限り原文のまま残す。
+# ==============================================================================
+
+# 優先して原文のまま残すやり取りの目印。回答の罫線ボックスや条文の引用はほぼ毎回付くので目印にしない。
+# 相談者が条文・資料のページを指して尋ねたもの（USER_CITATION_RE）と、回答が資料のページ [P.n] を引いたもの
+USER_CITATION_RE = re.compile(r"第[0-9０-９〇一二三四五六七八九十百]+条|\[P\.\d+\]")
+EVIDENCE_PAGE_RE = re.compile(r"\[P\.\d+\]")
+SUMMARY_HEADER = "【これまでの相談の要約（古いやり取りを自動でまとめたもの）】"
+SUMMARY_ACK = "承知しました。これまでの経緯を踏まえて回答します。"
+
+# ---------------------------------------------------------
+# 要約（1メッセージごとに1行。内容のハッシュでキャッシュし、再計算しない）
+# ---------------------------------------------------------
+_summary_lines = OrderedDict()
+_summary_lock = threading.Lock()
+SUMMARY_CACHE_SIZE = 4096
+
+
+def _first_sentences(text, limit):
+    text = re.sub(r"[┏┗━\s]+", " ", text).strip()
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def summarize_message(message):
+    content = message.get("content") or ""
+    key = hashlib.sha1(f"{message['role']}\n{content}".encode("utf-8")).hexdigest()
+    with _summary_lock:
+        line = _summary_lines.get(key)
+        if line is not None:
+            _summary_lines.move_to_end(key)
+            return line
+
+    if message["role"] == "user":
+        line = f"・相談者: {_first_sentences(content, 120)}"
+    else:
+        cited = sorted(set(re.findall(r"第[0-9０-９〇一二三四五六七八九十百]+条(?:\s*第[0-9０-９〇一二三四五六七八九十]+項)?", content)))
+        line = f"・AI: {_first_sentences(content, 160)}"
+        if cited:
+            line += f"（引用: {'、'.join(cited[:6])}）"
+    names = [a["name"] for a in message.get("attachments", [])]
+    if names:
+        line += f"（送付資料: {'、'.join(names)}）"
+
+    with _summary_lock:
+        _summary_lines[key] = line
+        while len(_summary_lines) > SUMMARY_CACHE_SIZE:
+            _summary_lines.popitem(last=False)
+    return line
+
+
+# ---------------------------------------------------------
+# 履歴の組み立て
+# ---------------------------------------------------------
+def _group_turns(messages):
+    """ユーザーの発言と、それに続くAIの回答を1ターンにまとめる。"""
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def _is_pinned(turn):
+    for message in turn:
+        pattern = USER_CITATION_RE if message["role"] == "user" else EVIDENCE_PAGE_RE
+        if message.get("attachments") or pattern.search(message.get("content") or ""):
+            return True
+    return False
+
+
+def _entries(turn, parts_for):
+    entries = []
+    for message in turn:
+        parts = parts_for(message)
+        if parts:
+            role = "user" if message["role"] == "user" else "model"
+            entries.append({"role": role, "parts": parts})
+    return entries
+
+
+def _tokens(entries):
+    return sum(estimate_part_tokens(p) for entry in entries for p in entry["parts"])
+
+
+def build_history(messages, budget=None, keep_turns=None, parts_for=attachments.history_parts):
+    """
+    start_chat(history=...) に渡す履歴を作る。
+    直近 keep_turns ターンは必ずそのまま、それより前は予算内で引用・資料つきのターンを優先して残し、
+    入りきらないものを要約1件にまとめる（予算内に収まる会話は何も省かない）。
+    """
+    budget = config.HISTORY_TOKEN_BUDGET if budget is None else budget
+    keep_turns = config.HISTORY_KEEP_TURNS if keep_turns is None else keep_turns
+
+    turns = _group_turns([citations.strip_report(m) for m in messages])
+    recent = turns[-keep_turns:] if keep_turns else []
+    older = turns[:len(turns) - len(recent)]
+
+    recent_entries = [_entries(turn, parts_for) for turn in recent]
+    older_entries = [_entries(turn, parts_for) for turn in older]
+    used = sum(_tokens(entries) for entries in recent_entries)
+
+    # 古いターンは「引用・資料つき」→「その他」の順に、それぞれ新しいものから予算内で残す
+    kept = set()
+    order = sorted(range(len(older)), key=lambda i: (not _is_pinned(older[i]), -i))
+    for i in order:
+        cost = _tokens(older_entries[i])
+        if used + cost <= budget:
+            kept.add(i)
+            used += cost
+
+    folded = [m for i, turn in enumerate(older) if i not in kept for m in turn]
+    history = []
+    if folded:
+        lines = [summarize_message(m) for m in folded]
+        # 要約自体も上限を超えたら、古い行から省く（新しい行から数えて、入りきらなくなる位置を1回で求める）
+        cut, total = len(lines) - 1, estimate_tokens(lines[-1])
+        while cut > 0 and total + estimate_tokens(lines[cut - 1]) <= config.HISTORY_SUMMARY_MAX_TOKENS:
+            cut -= 1
+            total += estimate_tokens(lines[cut])
+        lines = lines[cut:]
+        history.append({"role": "user", "parts": [SUMMARY_HEADER + "\n" + "\n".join(lines)]})
+
+    rest = [entry for i, entries in enumerate(older_entries) if i in kept for entry in entries]
+    rest += [entry for entries in recent_entries for entry in entries]
+    # ユーザーとAIの発言が交互になるよう、要約の直後がユーザー発言なら受け答えを1つ挟む
+    if history and (not rest or rest[0]["role"] == "user"):
+        history.append({"role": "model", "parts": [SUMMARY_ACK]})
+    history.extend(rest)
+    return history
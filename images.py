@@ -0,0 +1,59 @@
+import io
+
+import config
+
+# ==============================================================================
+# 写真の前処理
+# スマホの写真は向きを直して縮小・再圧縮し、位置情報などのメタデータを落としてから送る。
+# ほぼ同じ写真（連写など）は知覚ハッシュで見分けて1枚にまとめる。
+# ==============================================================================
+
+MIME_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+def dhash(image, size=8):
+    """差分ハッシュ（64ビット）。縮小・再圧縮しても値がほとんど変わらない。"""
+    from PIL import Image
+    small = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def is_near_duplicate(fingerprint, others):
+    return any(hamming(fingerprint, other) <= config.IMAGE_DEDUPE_DISTANCE for other in others)
+
+
+def preprocess(data):
+    """
+    送信用に整えた画像を返す。
+    戻り値: ({"mime_type": ..., "data": ...}, 知覚ハッシュ)
+    """
+    # Pillow は写真が来たときに初めて読み込む（起動を速くするため）
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(data))
+    # EXIFの回転情報を画素に反映してから、メタデータごと捨てる
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"):
+        background = Image.new("RGB", image.size, "white")
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    image.thumbnail((config.IMAGE_MAX_EDGE, config.IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    image_format = config.IMAGE_FORMAT.upper()
+    if image_format == "PNG":
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.save(output, format=image_format, quality=config.IMAGE_QUALITY)
+    return {"mime_type": MIME_TYPES.get(image_format, "image/jpeg"), "data": output.getvalue()}, dhash(image)
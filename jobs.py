@@ -0,0 +1,143 @@
+import threading
+import time
+import uuid
+
+import config
+import engine
+import workers
+
+# ==============================================================================
+# バックグラウンドの分析ジョブ
+# 画面（app.py）から受け付けた質問を、画面の再実行と切り離してワーカーのスレッドで最後まで処理する。
+# 画面はジョブの進み具合（段階・順番待ち・届いた回答）を読んで表示するだけなので、
+# ボタン操作などで再実行されても処理は捨てられず、同じAIの呼び出しを繰り返すこともない。
+# ジョブは会話IDごとに1つだけ持ち、ページを読み込み直しても同じジョブにつなぎ直せる。
+# ==============================================================================
+
+# status: "queued"（空き待ち）/ "running"（処理中）/ "done"（完了）/ "error"（失敗）/ "cancelled"（取り消し）
+FINISHED = ("done", "error", "cancelled")
+
+
+class Job:
+    """1回の質問の処理。状態はワーカーのスレッドが書き、画面のスレッドが読む。"""
+
+    def __init__(self, session, prompt, uploads):
+        self.job_id = uuid.uuid4().hex
+        self.session = session
+        self.prompt = prompt
+        # 受け付けた時点のメッセージ数（これより後は処理中のやり取りとして表示する）
+        self.base = len(session.messages)
+        self.status = "queued"
+        self.stage = None
+        self.wait = None            # rate_limit.WaitStatus（順番待ち・再送待ちのときだけ）
+        self.notices = []
+        self.chunks = []
+        self.error = None           # 失敗したときの {"category", "level", "message"}
+        self.reported = False       # 画面で結果（案内・エラー）を表示したか
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+        self.future = None
+        self._cancel = threading.Event()
+        self._uploads = uploads
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.submitted_at
+
+    def cancel(self):
+        """取り消す。まだ始まっていなければそのまま止め、処理中ならAIへの送信前か受信の途中で止まる。"""
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self._finish("cancelled")
+
+    def _finish(self, status):
+        self.stage = None
+        self.wait = None
+        self._uploads = None
+        self.finished_at = time.monotonic()
+        self.status = status
+
+    def _on_stage(self, name):
+        self.stage = name
+        self.wait = None
+
+    def _on_wait(self, status):
+        self.wait = status
+
+    def run(self):
+        self.status = "running"
+        status = "error"
+        try:
+            events = engine.run_turn(self.session, self.prompt, self._uploads, stream=True,
+                                     on_wait=self._on_wait, on_stage=self._on_stage, cancel=self._cancel)
+            for event in events:
+                if event.kind == "notice":
+                    self.notices.append(event.data)
+                elif event.kind == "chunk":
+                    self.wait = None
+                    self.chunks.append(event.data)
+                elif event.kind == "error":
+                    self.error = event.data
+                else:
+                    status = event.kind
+        except Exception as e:
+            # run_turn の外側（会話の保存など）で失敗した場合
+            category, level, message = engine.error_notice(e)
+            self.error = {"category": category, "level": level, "message": message}
+        finally:
+            self._finish(status)
+
+
+class JobManager:
+    """会話IDごとの最新のジョブ（プロセス全体で共有。終わったジョブは JOB_RESULT_TTL 秒で忘れる）。"""
+
+    def __init__(self, result_ttl):
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        expired = [sid for sid, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.result_ttl]
+        for sid in expired:
+            del self._jobs[sid]
+
+    def submit(self, session, prompt, uploaded_files=()):
+        """
+        質問をジョブとして受け付ける。同じ会話で処理中のジョブがあれば、新しく作らずにそれを返す。
+        アップロードされたファイルはそのまま渡す（UploadedFile は中身を自分で持っているので、画面が再実行されて
+        アップロード欄が空になってもジョブから読める。録音などの大きなファイルをもう1つメモリに写さない）。
+        """
+        with self._lock:
+            self._prune(time.monotonic())
+            current = self._jobs.get(session.session_id)
+            if current is not None and not current.finished:
+                return current
+            job = Job(session, prompt, list(uploaded_files or ()))
+            self._jobs[session.session_id] = job
+            job.future = workers.job_pool().submit(job.run)
+            return job
+
+    def get(self, session_id):
+        with self._lock:
+            return self._jobs.get(session_id)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(config.JOB_RESULT_TTL)
+        return _manager
@@ -313,6 +313,57 @@ POLICE_COLLABORATION_DATA = r"""
 """
 
 
+# ==============================================================================
+# 【資料一覧】検索・引用チェック用の資料ID・資料名
+# ==============================================================================
+DOCUMENTS = [
+    ("ijime_act", "いじめ防止対策推進法", IJIME_PREVENTION_ACT_FULL_TEXT),
+    ("notification_2017", "平成29年 基本方針改定通知", NOTIFICATION_REVISION_2017),
+    ("basic_policy", "いじめの防止等のための基本的な方針", BASIC_POLICY_ON_BULLYING),
+    ("basic_policy_points", "基本方針改定のポイント", BASIC_POLICY_REVISION_POINTS),
+    ("guideline_h29", "いじめの重大事態の調査に関するガイドライン（平成29年版）", bullying_major_incident_guideline_h29),
+    ("guidance_structure", "生徒指導提要（構成）", student_guidance_structure),
+    ("guidance_detail", "生徒指導提要（詳細抜粋）", student_guidance_guidelines),
+    ("guidance_history", "生徒指導提要 改定履歴", student_guidance_revision_history),
+    ("guideline_r6", "いじめの重大事態の調査に関するガイドライン（令和6年8月改訂版）", MAJOR_INCIDENT_GUIDELINE_R6_FULL),
+    ("children_act", "こども基本法", CHILDREN_BASIC_ACT_FULL),
+    ("personal_info_qa", "学校における個人情報の取扱いQ&A", PERSONAL_INFO_QA_FULL),
+    ("truancy", "不登校支援・教育機会確保法", TRUANCY_AND_OPPORTUNITY_ACT),
+    ("police", "学校と警察の連携", POLICE_COLLABORATION_DATA),
+]
+
+# ==============================================================================
+# 【ページ数・URL対応表】
+# ==============================================================================
+REFERENCE_MAP = """
+【重要資料のページ数・URL対応表】
+AIは回答時に、以下の情報を参照して「該当ページ数」と「URL」を必ず提示してください。
+
+■いじめの重大事態の調査に関するガイドライン（令和6年8月改訂版）
+https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
+[ページ目安] P.1(基本的姿勢), P.2(重大事態定義), P.4(報告義務), P.15(公表)
+
+■いじめ防止対策推進法（条文）
+https://elaws.e-gov.go.jp/document?lawid=425AC1000000071
+[ページ目安] 第22条(組織), 第23条(通報義務), 第28条(重大事態)
+
+■いじめの防止等のための基本的な方針（平成29年改定）
+https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
+[ページ目安] P.3(定義), P.12(解消定義), P.15(抱え込み禁止)
+
+■こども基本法
+https://elaws.e-gov.go.jp/document?lawid=504AC1000000077
+[ページ目安] 第3条(意見表明・最善の利益), 第11条(意見の反映)
+
+■学校における個人情報の取扱いQ&A（黒塗り対策）
+https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
+[ページ目安] いじめ防止基本方針のP.15〜18付近、またはガイドライン参照
+
+■不登校支援・教育機会確保法（出席扱い等）
+https://www.mext.go.jp/a_menu/shotou/seitoshidou/1302904.htm
+[ページ目安] 令和元年10月25日通知「不登校児童生徒への支援の在り方について」
+"""
+
 # ==============================================================================
 # 【最終処理】すべての資料を無修正でPROMPT_TEXTに合体
 # ==============================================================================
@@ -0,0 +1,218 @@
+import functools
+import hashlib
+import re
+import unicodedata
+from collections import namedtuple
+
+import artifacts
+
+# ==============================================================================
+# law_data.py の構造化インデックス
+# 各資料を条・項・節ごとのレコードに分解し、(資料ID, 条, 項) で直接引けるようにする。
+# 本文はコピーせず、PROMPT_TEXT（全資料を連結した1本の文字列）への位置で持つ。
+# 構築したインデックスは artifacts に保存し、次の起動からは law_data.py を読み込まずに使う。
+# ==============================================================================
+
+# kind: "preamble"(表題) / "chapter"(章) / "article"(条全体) / "paragraph"(項) / "section"(節・見出し)
+Provision = namedtuple(
+    "Provision",
+    ["doc_id", "kind", "article", "paragraph", "heading", "page", "url", "start", "end"],
+)
+
+# 資料ID → REFERENCE_MAP の見出し（■〜）の書き出し
+REFERENCE_TITLES = {
+    "ijime_act": "いじめ防止対策推進法",
+    "guideline_r6": "いじめの重大事態の調査に関するガイドライン",
+    "basic_policy": "いじめの防止等のための基本的な方針",
+    "children_act": "こども基本法",
+    "personal_info_qa": "学校における個人情報の取扱いQ&A",
+    "truancy": "不登校支援・教育機会確保法",
+}
+
+KANJI_DIGITS = {"〇": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+NUMERAL = r"[0-9０-９〇一二三四五六七八九十百千]+"
+
+ARTICLE_RE = re.compile(rf"^第({NUMERAL})条")
+CHAPTER_RE = re.compile(rf"^第({NUMERAL})章")
+PARAGRAPH_RE = re.compile(r"^([0-9０-９]+)　")
+SECTION_RE = re.compile(r"^(?:第([0-9０-９]+)　|([0-9０-９]+)[．.]|Q\.|（.+）$)")
+ITEM_RE = re.compile(r"^[0-9０-９]+[．.]")
+PAGE_HINT_RE = re.compile(r"P\.(\d+)\(([^)]+)\)")
+
+
+def to_int(numeral):
+    """「二十三」「２３」「23」を 23 に変換する。"""
+    numeral = unicodedata.normalize("NFKC", numeral)
+    if numeral.isdigit():
+        return int(numeral)
+    total, digit = 0, 0
+    for ch in numeral:
+        if ch in KANJI_DIGITS:
+            digit = digit * 10 + KANJI_DIGITS[ch]
+        elif ch in KANJI_UNITS:
+            total += (digit or 1) * KANJI_UNITS[ch]
+            digit = 0
+        else:
+            raise ValueError(f"数字として読めません: {numeral}")
+    return total + digit
+
+
+# この内容が変わったらインデックスを作り直す
+SOURCES = ("law_data.py", "law_index.py")
+
+
+def parse_reference_map(text):
+    """REFERENCE_MAP を {見出し: (URL, [(ページ, ラベル), ...])} に変換する。"""
+    entries = {}
+    for block in text.split("■")[1:]:
+        lines = [line.strip() for line in block.strip().splitlines() if line.strip()]
+        if len(lines) < 2:
+            continue
+        hints = [(f"P.{page}", label) for page, label in PAGE_HINT_RE.findall(" ".join(lines[2:]))]
+        entries[lines[0]] = (lines[1], hints)
+    return entries
+
+
+def _lines_with_offsets(text, base):
+    offset = base
+    for line in text.splitlines(keepends=True):
+        yield line.rstrip(), offset, offset + len(line.rstrip("\n"))
+        offset += len(line)
+
+
+def _parse_document(doc_id, text, base, url, hints):
+    records = []
+    # 作成途中のレコード: [kind, article, paragraph, heading, start, end]
+    current = None
+    article = None      # 条全体: [article, heading, start, end]
+    caption = None      # 条文直前の（見出し）: (text, start)
+
+    def page_for(heading):
+        # 「解消定義」と「いじめの解消の定義」のような表記ゆれを吸収し、長いラベルを優先する
+        plain = (heading or "").replace("の", "")
+        matches = [(len(label), page) for page, label in hints if label.replace("の", "") in plain]
+        return max(matches)[1] if matches else None
+
+    def close_current():
+        nonlocal current
+        if current is not None:
+            kind, number, paragraph, heading, start, end = current
+            records.append(Provision(doc_id, kind, number, paragraph, heading,
+                                     page_for(heading), url, start, end))
+            current = None
+
+    def close_article():
+        nonlocal article
+        if article is not None:
+            number, heading, start, end = article
+            records.append(Provision(doc_id, "article", number, None, heading,
+                                     page_for(heading), url, start, end))
+            article = None
+
+    for line, start, end in _lines_with_offsets(text, base):
+        if not line:
+            continue
+        match = ARTICLE_RE.match(line)
+        if match:
+            close_current()
+            close_article()
+            heading, first = (caption[0], caption[1]) if caption else (line.split("　")[0], start)
+            number = to_int(match.group(1))
+            article = [number, heading, first, end]
+            current = ["paragraph", number, 1, heading, first, end]
+            caption = None
+            continue
+        match = PARAGRAPH_RE.match(line)
+        if article is not None and match:
+            close_current()
+            current = ["paragraph", article[0], to_int(match.group(1)), article[1], start, end]
+            article[3] = end
+            continue
+        match = CHAPTER_RE.match(line)
+        section = SECTION_RE.match(line)
+        if match or (section and not (current and current[3].startswith("（") and ITEM_RE.match(line))):
+            close_current()
+            close_article()
+            caption = None
+            if match:
+                records.append(Provision(doc_id, "chapter", to_int(match.group(1)), None, line,
+                                         None, url, start, end))
+                continue
+            if line.startswith("（") and not line.startswith("（第"):
+                # 次の行が条文ならその条の見出し、そうでなければ節見出しになる
+                caption = (line, start)
+                current = ["section", None, None, line, start, end]
+                continue
+            number = section.group(1) or section.group(2)
+            current = ["section", to_int(number) if number else None, None, line, start, end]
+            continue
+        if current is None:
+            current = ["preamble", None, None, line, start, end]
+        caption = None
+        current[5] = end
+        if article is not None:
+            article[3] = end
+    close_current()
+    close_article()
+
+    # 条文の見出しとして吸収された（見出し）の仮レコードを除く
+    article_starts = {r.start for r in records if r.kind == "article"}
+    return [r for r in records if not (r.kind == "section" and r.start in article_starts)]
+
+
+class LawIndex:
+    def __init__(self, buffer=None, documents=None, reference_map=None):
+        if buffer is None:
+            from law_data import DOCUMENTS, PROMPT_TEXT, REFERENCE_MAP
+            buffer, documents, reference_map = PROMPT_TEXT, DOCUMENTS, REFERENCE_MAP
+        self.buffer = buffer
+        self.reference_map = reference_map
+        self.titles = {doc_id: title for doc_id, title, _ in documents}
+        self.references = parse_reference_map(reference_map)
+        self.provisions = []
+        self.doc_spans = {}
+        cursor = 0
+        for doc_id, title, text in documents:
+            base = buffer.find(text, cursor)
+            if base < 0:
+                continue
+            cursor = base + len(text)
+            self.doc_spans[doc_id] = (base, cursor)
+            url, hints = self.reference_for(doc_id)
+            self.provisions.extend(_parse_document(doc_id, text, base, url, hints))
+
+        # (資料ID, 条, 項) → レコード。項を省略したキーは条全体（節）を指す
+        self.by_key = {}
+        for provision in self.provisions:
+            if provision.article is None or provision.kind == "chapter":
+                continue
+            self.by_key.setdefault((provision.doc_id, provision.article, provision.paragraph), provision)
+        self.version = hashlib.sha256((buffer + reference_map).encode("utf-8")).hexdigest()[:16]
+
+    def reference_for(self, doc_id):
+        prefix = REFERENCE_TITLES.get(doc_id)
+        for title, (url, hints) in self.references.items():
+            if prefix and title.startswith(prefix):
+                return url, hints
+        return None, []
+
+    def lookup(self, doc_id, article, paragraph=None):
+        return self.by_key.get((doc_id, article, paragraph))
+
+    def text(self, provision):
+        return self.buffer[provision.start:provision.end]
+
+    def label(self, provision):
+        """「第23条第5項」のような算用数字の表記。"""
+        if provision.kind == "article":
+            return f"第{provision.article}条"
+        if provision.kind == "paragraph":
+            return f"第{provision.article}条第{provision.paragraph}項"
+        return provision.heading
+
+
+@functools.lru_cache(maxsize=None)
+def get_index():
+    """インデックスは1プロセスにつき1回だけ構築する（保存済みなら読み込むだけ）。"""
+    return artifacts.load_or_build("law_index", SOURCES, LawIndex)
@@ -0,0 +1,162 @@
+import re
+import unicodedata
+
+import artifacts
+import citations
+import config
+import law_index
+
+# ==============================================================================
+# 条文の直接表示（AIを呼ばない近道）
+# 「第23条第5項を全文で」「重大事態の定義は？」のような、条文を引くだけの質問を見分け、
+# 法律データの原文を回答の形式（┏━┓の罫線ボックス）でそのまま返す。
+# 少しでも判断に迷う質問（状況の説明・資料つき・長文など）は None を返し、いつもどおりAIに送る。
+# ==============================================================================
+
+# 用語 → 引く条文。(資料ID, 条, 項) か (資料ID, 見出しに含まれる語)
+TOPICS = {
+    "いじめ": [("ijime_act", 2, 1), ("basic_policy", "いじめの定義")],
+    "重大事態": [("ijime_act", 28, 1)],
+    "いじめの解消": [("basic_policy", "解消の定義")],
+    "解消": [("basic_policy", "解消の定義")],
+    "出席扱い": [("truancy", "出席扱い")],
+}
+
+# 用語だけの質問を条文の照会とみなすための語（「いじめ」だけの入力は照会とみなさない）
+TOPIC_INTENT_RE = re.compile(r"定義|要件|条件|意味|とは|全文|条文|原文")
+ARTICLE_RE = re.compile(rf"第?({law_index.NUMERAL})条(?:第?({law_index.NUMERAL})項)?")
+# 照会の言い回し。これらと条文番号・資料名・用語を除いて何も残らなければ、条文を引くだけの質問とみなす
+# （「違反」「該当」「適用」「義務」のような内容のある語が1つでも残れば、状況の相談としてAIに任せる）
+FILLER_RE = re.compile(
+    r"について|に関する|全文で?|条文|原文|本文|内容|定義|要件|条件|意味|とは|なに|何|どんな|"
+    r"教えて|見せて|表示して|表示|読みたい|見たい|知りたい|ほしい|欲しい|お願いします|お願い|"
+    r"ください|下さい|でしょうか|ですか|です|って|"
+    r"[をはのがかもで]|[?!。、.,「」]"
+)
+BOX_LINE = "━" * 36
+
+
+class LookupTable:
+    """資料名・用語の照合器と、用語ごとの条文をまとめた表（artifacts に保存して使い回す）。"""
+
+    def __init__(self):
+        index = law_index.get_index()
+        self.topics = {}
+        for term, targets in TOPICS.items():
+            provisions = [self._resolve(index, target) for target in targets]
+            self.topics[term] = [p for p in provisions if p is not None]
+        self.topic_matcher = citations.Matcher({term: term for term in TOPICS})
+
+    @staticmethod
+    def _resolve(index, target):
+        if len(target) == 3:
+            return index.lookup(*target)
+        doc_id, heading = target
+        return next((p for p in index.provisions
+                     if p.doc_id == doc_id and p.kind != "article" and heading in (p.heading or "")), None)
+
+
+_table = None
+
+
+def get_table():
+    global _table
+    if _table is None:
+        sources = law_index.SOURCES + ("citations.py", "lookup.py")
+        _table = artifacts.load_or_build("lookup_table", sources, LookupTable)
+    return _table
+
+
+def _normalize(prompt):
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", prompt))
+
+
+def _without_matches(matcher, text):
+    keep = [True] * len(text)
+    for start, length, _ in matcher.find(text):
+        keep[start:start + length] = [False] * length
+    return "".join(ch for ch, kept in zip(text, keep) if kept)
+
+
+def detect(prompt, index=None):
+    """条文を引くだけの質問なら表示する条文（law_index.Provision）の一覧、そうでなければ（迷う場合も）None。"""
+    text = _normalize(prompt)
+    if not text or len(text) > config.LOCAL_LOOKUP_MAX_CHARS or "条の" in text:
+        return None
+    index = index or law_index.get_index()
+
+    # 資料名（書かれていなければ、いじめ防止対策推進法の条文とみなす）
+    matcher = citations.get_matcher()
+    documents = {doc_id for _, _, doc_id in matcher.find(text)}
+    if len(documents) > 1:
+        return None
+    doc_id = next(iter(documents), None)
+
+    provisions = []
+    references = list(ARTICLE_RE.finditer(text))
+    if references:
+        for match in references:
+            try:
+                article = law_index.to_int(match.group(1))
+                paragraph = law_index.to_int(match.group(2)) if match.group(2) else None
+            except ValueError:
+                return None
+            provision = index.lookup(doc_id or "ijime_act", article, paragraph)
+            if provision is None:
+                return None
+            provisions.append(provision)
+        rest = ARTICLE_RE.sub("", text)
+    else:
+        table = get_table()
+        terms = sorted(table.topic_matcher.find(text), key=lambda m: (-m[1], m[0]))
+        if not terms or not TOPIC_INTENT_RE.search(text):
+            return None
+        term = terms[0][2]
+        provisions = [p for p in table.topics[term] if doc_id is None or p.doc_id == doc_id]
+        if not provisions:
+            return None
+        rest = _without_matches(table.topic_matcher, text)
+
+    # 資料名と照会の言い回しを除いて、内容のある語が残るなら状況の相談としてAIに任せる
+    if FILLER_RE.sub("", _without_matches(matcher, rest)):
+        return None
+    return provisions
+
+
+def _location(index, provision):
+    if provision.kind == "paragraph":
+        location = f"【 第{provision.article}条 第{provision.paragraph}項 】"
+    elif provision.kind == "article":
+        location = f"【 第{provision.article}条 】"
+    else:
+        location = f"【 {provision.heading.strip('（）')} 】"
+    return f"**{location}**" + (f" （{provision.page}）" if provision.page else "")
+
+
+def format_box(index, provision):
+    """回答の形式（SYSTEM_INSTRUCTION の出力フォーマット）どおりの罫線ボックスと原文。"""
+    url = provision.url or index.reference_for(provision.doc_id)[0]
+    quoted = "\n".join(f"> {line}" if line.strip() else ">" for line in index.text(provision).strip().splitlines())
+    return (
+        f"┏{BOX_LINE}┓\n\n"
+        f"　📖 **根拠資料**\n　**{index.titles[provision.doc_id]}**\n\n"
+        f"　📍 **該当箇所**\n　{_location(index, provision)}\n\n"
+        f"　🔗 **入手先URL**\n　{url or '（法律データに入手先URLの登録がありません）'}\n\n"
+        f"┗{BOX_LINE}┛\n\n"
+        f"> **内容:**\n{quoted}"
+    )
+
+
+def answer(prompt, index=None):
+    """条文を引くだけの質問なら、原文をそのまま示す回答。そうでなければ None。"""
+    index = index or law_index.get_index()
+    found = detect(prompt, index)
+    if found is None:
+        return None
+    boxes = "\n\n".join(format_box(index, provision) for provision in found)
+    return (
+        "【法律データの原文】ご質問の箇所を、法律データからそのまま表示します。\n\n"
+        f"{boxes}\n\n"
+        "**解説:** 上は法律データ（law_data.py）に収録された原文です。"
+        "ご自身の状況に当てはめた分析が必要な場合は、経緯や資料を添えてご相談ください。"
+    )
@@ -0,0 +1,274 @@
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+import config
+
+# ==============================================================================
+# 1ターンごとの計測（どこに時間がかかっているかを記録する）
+# 添付資料の前処理（種類別）・履歴の組み立て・start_chat・send_message（最初の応答まで／全体）・
+# 表示の各区間の時間、トークン数、エラーの種類を1ターン分まとめて出力先（シンク）に渡す。
+# 出力先は JSON Lines のログと、Prometheus 形式のテキスト（ファイル・HTTP）から選べる。
+# ==============================================================================
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+_current = contextvars.ContextVar("metrics_turn", default=None)
+
+
+def classify_error(error):
+    """エラーを画面の案内と同じ区分に分ける。"""
+    message = str(error)
+    name = type(error).__name__
+    if name == "QueueFull":
+        return "queue_full"
+    if "429" in message or "ResourceExhausted" in message:
+        return "rate_limited"
+    if "500" in message or "Internal error" in message:
+        return "server_error"
+    if "finish_reason" in message and "1" in message:
+        return "safety"
+    return "other"
+
+
+class Turn:
+    """1回の質問〜回答の計測。with で囲んだ間は record() がこのターンに記録される。"""
+
+    def __init__(self, session_id=None, sinks=None):
+        self.session_id = session_id
+        self.sinks = get_sinks() if sinks is None else sinks
+        self.started = time.monotonic()
+        self.spans = []         # (名前, ラベル, 秒)
+        self.usage = {}
+        self.error = None
+        self.attributes = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        if exc is not None and self.error is None:
+            self.fail(exc)
+        self.finish()
+        return False
+
+    def record(self, name, seconds, **labels):
+        self.spans.append((name, labels, seconds))
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start, **labels)
+
+    def stream(self, response, started, **labels):
+        """応答のチャンクをそのまま流しつつ、最初のチャンクまでと全体の時間を測る。"""
+        first = True
+        for chunk in response:
+            if first:
+                self.record("first_chunk", time.monotonic() - started, **labels)
+                first = False
+            yield chunk
+        self.record("response_total", time.monotonic() - started, **labels)
+        self.set_usage(getattr(response, "usage_metadata", None))
+
+    def set_usage(self, usage_metadata):
+        if usage_metadata is None:
+            return
+        for field in ("prompt_token_count", "candidates_token_count", "total_token_count", "cached_content_token_count"):
+            value = getattr(usage_metadata, field, None)
+            if value:
+                self.usage[field] = int(value)
+
+    def fail(self, error):
+        self.error = {"class": type(error).__name__, "category": classify_error(error)}
+
+    def finish(self):
+        self.record("turn_total", time.monotonic() - self.started)
+        event = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "session": self.session_id,
+            "spans": [{"name": name, **labels, "seconds": round(seconds, 4)} for name, labels, seconds in self.spans],
+            "usage": self.usage,
+            "error": self.error,
+            **self.attributes,
+        }
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception:
+                # 計測の失敗で相談の処理を止めない
+                pass
+
+
+def record(name, seconds, **labels):
+    """いま計測中のターンがあれば記録する（なければ何もしない）。"""
+    turn = _current.get()
+    if turn is not None:
+        turn.record(name, seconds, **labels)
+
+
+def record_after(session_id, name, seconds, **labels):
+    """
+    ターンの記録を出力した後に測った区間（回答を画面に表示し終えるまで など）を、別の1件として出力先に渡す。
+    会話IDでターンの記録と突き合わせる。ターンの数には数えない。
+    """
+    event = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+        "session": session_id,
+        "spans": [{"name": name, **labels, "seconds": round(seconds, 4)}],
+        "usage": {},
+        "error": None,
+        "after_turn": True,
+    }
+    for sink in get_sinks():
+        try:
+            sink.emit(event)
+        except Exception:
+            pass
+
+
+# ---------------------------------------------------------
+# 出力先（シンク）
+# ---------------------------------------------------------
+class JsonLogSink:
+    """1ターン1行の JSON Lines ファイル。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class PrometheusSink:
+    """
+    Prometheus のテキスト形式で集計する。
+    path を指定すると textfile collector 用のファイルを毎ターン書き換え、port を指定すると /metrics で返す。
+    """
+
+    def __init__(self, path=None, port=0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._buckets = defaultdict(lambda: [0] * len(SECONDS_BUCKETS))
+        self._sums = Counter()
+        self._counts = Counter()
+        self._tokens = Counter()
+        self._errors = Counter()
+        self._turns = 0
+        if port:
+            self._serve(port)
+
+    def emit(self, event):
+        with self._lock:
+            if not event.get("after_turn"):
+                self._turns += 1
+            for span in event["spans"]:
+                key = (span["name"], span.get("kind", ""))
+                for i, bound in enumerate(SECONDS_BUCKETS):
+                    if span["seconds"] <= bound:
+                        self._buckets[key][i] += 1
+                self._sums[key] += span["seconds"]
+                self._counts[key] += 1
+            for field, value in event["usage"].items():
+                self._tokens[field] += value
+            if event["error"]:
+                self._errors[(event["error"]["category"], event["error"]["class"])] += 1
+            text = self._render()
+        if self.path:
+            partial = self.path + ".part"
+            with open(partial, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(partial, self.path)
+
+    def render(self):
+        with self._lock:
+            return self._render()
+
+    def _render(self):
+        lines = [
+            "# HELP ijime_turns_total Number of consultation turns.",
+            "# TYPE ijime_turns_total counter",
+            f"ijime_turns_total {self._turns}",
+            "# HELP ijime_stage_seconds Time spent per stage of a turn.",
+            "# TYPE ijime_stage_seconds histogram",
+        ]
+        for (stage, kind), buckets in sorted(self._buckets.items()):
+            labels = f'stage="{stage}"' + (f',kind="{kind}"' if kind else "")
+            for bound, count in zip(SECONDS_BUCKETS, buckets):
+                lines.append(f'ijime_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'ijime_stage_seconds_bucket{{{labels},le="+Inf"}} {self._counts[(stage, kind)]}')
+            lines.append(f"ijime_stage_seconds_sum{{{labels}}} {self._sums[(stage, kind)]:.4f}")
+            lines.append(f"ijime_stage_seconds_count{{{labels}}} {self._counts[(stage, kind)]}")
+        lines += ["# HELP ijime_tokens_total Tokens reported by the backend.", "# TYPE ijime_tokens_total counter"]
+        lines += [f'ijime_tokens_total{{field="{field}"}} {value}' for field, value in sorted(self._tokens.items())]
+        lines += ["# HELP ijime_errors_total Failed turns by error category.", "# TYPE ijime_errors_total counter"]
+        lines += [f'ijime_errors_total{{category="{category}",class="{name}"}} {count}'
+                  for (category, name), count in sorted(self._errors.items())]
+        return "\n".join(lines) + "\n"
+
+    def _serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.end_headers()
+                if self.path == "/metrics":
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+
+def _create_jsonl_sink():
+    return JsonLogSink(config.METRICS_LOG_PATH)
+
+
+def _create_prometheus_sink():
+    return PrometheusSink(config.METRICS_PROM_PATH or None, config.METRICS_PORT)
+
+
+SINKS = {
+    "jsonl": _create_jsonl_sink,
+    "prometheus": _create_prometheus_sink,
+}
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    """設定された出力先（プロセス共通）。METRICS_SINKS が空なら計測結果はどこにも出さない。"""
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            names = [name.strip() for name in config.METRICS_SINKS.split(",") if name.strip()]
+            _sinks = [SINKS[name]() for name in names]
+        return _sinks
+
+
+def set_sinks(sinks):
+    """出力先を差し替える（ベンチマークなどで結果を直接受け取るとき）。"""
+    global _sinks
+    with _sinks_lock:
+        _sinks = list(sinks)
@@ -0,0 +1,51 @@
+import hashlib
+import threading
+import time
+
+import config
+import law_index
+
+# ==============================================================================
+# プロセス共通のモデルキャッシュ
+# 同じシステムプロンプトのモデルはセッションごとに作らず、全セッションで1つを共有する。
+# キーはシステムプロンプトと法律データのバージョンのハッシュ。
+# ==============================================================================
+
+_lock = threading.Lock()
+_models = {}    # キー → (モデル, 有効期限)
+
+
+def cache_key(model_name, system_instruction, corpus_version=None):
+    corpus_version = corpus_version or law_index.get_index().version
+    digest = hashlib.sha256(f"{model_name}\n{corpus_version}\n{system_instruction}".encode("utf-8"))
+    return f"ijime-{digest.hexdigest()[:24]}"
+
+
+def get_model(backend, model_name, system_instruction, safety_settings):
+    key = cache_key(model_name, system_instruction)
+    with _lock:
+        entry = _models.get(key)
+        if entry and (entry[1] is None or entry[1] > time.time()):
+            return entry[0]
+
+        model, expires_at = None, None
+        if config.CONTEXT_CACHE and backend.supports_context_cache:
+            try:
+                model = backend.create_cached_model(
+                    model_name, system_instruction, safety_settings,
+                    ttl=config.CONTEXT_CACHE_TTL, display_name=key
+                )
+                # サーバー側キャッシュが切れる少し前に作り直す
+                expires_at = time.time() + config.CONTEXT_CACHE_TTL * 0.9
+            except Exception:
+                # 最小トークン数に満たない・モデルが非対応などの場合は通常のモデルを使う
+                model = None
+        if model is None:
+            model = backend.create_model(model_name, system_instruction, safety_settings)
+        _models[key] = (model, expires_at)
+        return model
+
+
+def clear():
+    with _lock:
+        _models.clear()
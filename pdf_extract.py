@@ -0,0 +1,109 @@
+import io
+import os
+import re
+import tempfile
+from collections import deque, namedtuple
+
+import config
+import workers
+
+# ==============================================================================
+# PDFのページ単位抽出
+# ページごとに [P.n] を付けて取り出し、大きなPDFはページ範囲に分けてプロセスプールで並列に読む。
+# 1ページの失敗でファイル全体を落とさず、そのページだけエラーとして印を付ける。
+# ==============================================================================
+
+# error: 読み取りに失敗したときの理由（成功時は None）
+PageResult = namedtuple("PageResult", ["number", "text", "error"])
+
+EMPTY_PAGE_NOTE = "（テキストなし：画像だけのページの可能性があります）"
+PAGE_MARK_RE = re.compile(r"^\[P\.(\d+)\]", re.M)
+
+def _read_pages(reader, start, stop):
+    results = []
+    for index in range(start, stop):
+        try:
+            text = reader.pages[index].extract_text() or ""
+            results.append(PageResult(index + 1, text, None))
+        except Exception as e:
+            results.append(PageResult(index + 1, "", f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _extract_range(path, start, stop):
+    # プロセスプールの作業単位。PDFの中身ではなくファイルパスだけを受け取る
+    import pypdf
+    with open(path, "rb") as f:
+        return _read_pages(pypdf.PdfReader(f), start, stop)
+
+
+def iter_pages(data):
+    """ページ順に PageResult を返すジェネレーター。先読みは数タスク分だけに抑える。"""
+    # pypdf はPDFが来たときに初めて読み込む（起動を速くするため）
+    import pypdf
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    total = len(reader.pages)
+    if total < config.PDF_PARALLEL_MIN_PAGES or config.PDF_WORKERS <= 1:
+        batch = config.PDF_PAGES_PER_TASK
+        for start in range(0, total, batch):
+            yield from _read_pages(reader, start, min(start + batch, total))
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    pending = deque()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        pool = workers.process_pool()
+        ranges = deque(
+            (start, min(start + config.PDF_PAGES_PER_TASK, total))
+            for start in range(0, total, config.PDF_PAGES_PER_TASK)
+        )
+        while ranges or pending:
+            while ranges and len(pending) < config.PDF_WORKERS * 2:
+                start, stop = ranges.popleft()
+                pending.append((start, stop, pool.submit(_extract_range, path, start, stop)))
+            start, stop, future = pending.popleft()
+            try:
+                yield from future.result()
+            except Exception as e:
+                # 作業プロセスごと失敗した範囲も、ページ単位のエラーとして返す
+                for index in range(start, stop):
+                    yield PageResult(index + 1, "", f"{type(e).__name__}: {e}")
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+        os.remove(path)
+
+
+def format_page(page):
+    if page.error:
+        return f"[P.{page.number}] （読み取りエラー：{page.error}）"
+    if not page.text.strip():
+        return f"[P.{page.number}] {EMPTY_PAGE_NOTE}"
+    return f"[P.{page.number}]\n{page.text}"
+
+
+def split_pages(text):
+    """extract_text の全文を (ページ番号, 本文) に戻す。読み取れなかったページは含めない。"""
+    matches = list(PAGE_MARK_RE.finditer(text))
+    for match, following in zip(matches, matches[1:] + [None]):
+        body = text[match.end():following.start() if following else len(text)]
+        # 読み取れなかったページは [P.n] と同じ行に理由が書かれている
+        if body.startswith("\n") and body.strip():
+            yield int(match.group(1)), body.strip("\n")
+
+
+def extract_text(data):
+    """
+    ページ番号付きの全文と、読めなかったページの一覧を返す。
+    戻り値: (テキスト, [(ページ番号, 理由), ...])
+    """
+    blocks, problems = [], []
+    for page in iter_pages(data):
+        blocks.append(format_page(page))
+        if page.error:
+            problems.append((page.number, page.error))
+        elif not page.text.strip():
+            problems.append((page.number, EMPTY_PAGE_NOTE))
+    return "\n".join(blocks), problems
@@ -0,0 +1,175 @@
+import random
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+import config
+
+# ==============================================================================
+# 送信の流量制御（プロセス全体で共有）
+# 全セッションの送信をトークンバケットで割り当て量に合わせ、待ち行列はセッションごとに順番に回す。
+# 429・500 などの一時的なエラーは、ゆらぎを付けた指数バックオフで自動的に再送する。
+# ==============================================================================
+
+# position: 待ち行列での順番（1 = 次に送信）、retry_in: 再送までの秒数、attempt: 何回目の送信か
+WaitStatus = namedtuple("WaitStatus", ["position", "retry_in", "attempt"])
+
+RETRYABLE_MARKERS = ("429", "ResourceExhausted", "500", "Internal error", "503", "ServiceUnavailable")
+THROTTLE_MARKERS = ("429", "ResourceExhausted")
+
+
+class QueueFull(Exception):
+    """待ち行列が上限に達した、または制限時間内に順番が来なかった。"""
+
+
+class Cancelled(Exception):
+    """送信の前に（順番待ち・再送待ちの間に）利用者が取り消した。"""
+
+
+def is_retryable(error):
+    message = f"{type(error).__name__}: {error}"
+    return any(marker in message for marker in RETRYABLE_MARKERS)
+
+
+def is_throttled(error):
+    message = f"{type(error).__name__}: {error}"
+    return any(marker in message for marker in THROTTLE_MARKERS)
+
+
+class RateLimiter:
+    """
+    トークンバケット＋セッション間で公平な待ち行列。
+    同じセッションの送信が続いても、他のセッションの送信と1件ずつ交互に順番が回る。
+    """
+
+    def __init__(self, requests_per_minute, burst, max_waiting, clock=time.monotonic):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(burst, 1)
+        self.max_waiting = max_waiting
+        # clock: 経過時間を測る関数（テストでは手で進める時計に差し替える）
+        self._clock = clock
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._queues = OrderedDict()    # セッションID → 待っている送信の deque
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _position(self, session_id, ticket):
+        # 各セッションの先頭から1件ずつ取る順番で、何番目になるかを数える
+        # （自分より前のセッションは同じ周回で先に、後ろのセッションは後に回る）
+        mine = self._queues[session_id].index(ticket)
+        position, before = 0, True
+        for other, queue in self._queues.items():
+            position += min(len(queue), mine + 1 if before else mine)
+            if other == session_id:
+                before = False
+        return position
+
+    def _remove(self, session_id, ticket):
+        queue = self._queues[session_id]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[session_id]
+        self._waiting -= 1
+        self._cond.notify_all()
+
+    def acquire(self, session_id, on_wait=None, timeout=None, cancel=None):
+        """
+        送信の順番が来るまで待つ。待っている間は on_wait(WaitStatus) で順番を知らせる。
+        cancel（threading.Event）が立ったら列から抜けて Cancelled を投げる。
+        """
+        timeout = config.RATE_QUEUE_TIMEOUT if timeout is None else timeout
+        deadline = self._clock() + timeout
+        ticket = object()
+        with self._cond:
+            if self._waiting >= self.max_waiting:
+                raise QueueFull("送信待ちの列が上限に達しました")
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._waiting += 1
+
+        reported = None
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled("送信の前に取り消されました")
+                with self._cond:
+                    now = self._clock()
+                    self._refill(now)
+                    head_session = next(iter(self._queues))
+                    is_head = head_session == session_id and self._queues[session_id][0] is ticket
+                    if is_head and self._tokens >= 1 and now >= self._paused_until:
+                        self._tokens -= 1
+                        self._remove(session_id, ticket)
+                        # 送信したセッションは列の最後尾に回す
+                        if session_id in self._queues:
+                            self._queues.move_to_end(session_id)
+                        return
+                    if now >= deadline:
+                        raise QueueFull("制限時間内に送信の順番が来ませんでした")
+                    position = self._position(session_id, ticket)
+                    if is_head:
+                        delay = max((1 - self._tokens) / self.rate, self._paused_until - now, 0.01)
+                    else:
+                        delay = 1.0
+                    if on_wait is None or position == reported:
+                        self._cond.wait(min(delay, deadline - now))
+                        continue
+                # 画面の更新はロックの外で行う
+                reported = position
+                on_wait(WaitStatus(position, None, None))
+        except BaseException:
+            with self._cond:
+                if session_id in self._queues and ticket in self._queues[session_id]:
+                    self._remove(session_id, ticket)
+            raise
+
+    def pause(self, seconds):
+        """サーバーから 429 が返ったら、全セッションの送信をしばらく止める（各自の再送が重ならないように）。"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+            self._cond.notify_all()
+
+    @property
+    def waiting(self):
+        with self._cond:
+            return self._waiting
+
+
+LIMITER = RateLimiter(config.RATE_LIMIT_RPM, config.RATE_LIMIT_BURST, config.RATE_QUEUE_MAX)
+
+
+def backoff_delay(attempt, rng=random):
+    """ゆらぎ付き指数バックオフ（0〜基準値×2^attempt の一様乱数、上限あり）。"""
+    return rng.uniform(0, min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def send_message(chat, content, session_id, on_wait=None, limiter=None, cancel=None, **kwargs):
+    """
+    chat.send_message を流量制御と自動再送つきで呼ぶ。
+    再送できないエラー、または再送回数を使い切ったときは最後のエラーをそのまま投げる。
+    cancel（threading.Event）が送信前に立ったら Cancelled を投げる（送信済みの呼び出しは止めない）。
+    """
+    limiter = limiter or LIMITER
+    attempts = max(config.RETRY_MAX_ATTEMPTS, 1)
+    for attempt in range(attempts):
+        limiter.acquire(session_id, on_wait, cancel=cancel)
+        try:
+            return chat.send_message(content, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            if is_throttled(e):
+                limiter.pause(min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2 ** attempt) / 2)
+            if on_wait:
+                on_wait(WaitStatus(None, delay, attempt + 2))
+            if cancel is not None:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
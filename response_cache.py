@@ -0,0 +1,196 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import config
+import law_index
+
+# ==============================================================================
+# 回答キャッシュ（temperature 0 の分析は同じ入力なら同じ回答になる）
+# キーは法律データのバージョン・システムプロンプト・履歴・質問・添付資料の中身のハッシュ。
+# メモリ上のLRUと、任意でディスク（SQLite）の2段。どちらも合計サイズで古いものから消す。
+# 法律データが変わるとバージョンが変わり、古い回答は使われずに消える。
+# ==============================================================================
+
+SPACE_RE = re.compile(r"\s+")
+
+
+# ---------------------------------------------------------
+# キーの計算
+# ---------------------------------------------------------
+def _normalize_text(text):
+    return SPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def _part_token(part):
+    if isinstance(part, str):
+        return "t:" + _normalize_text(part)
+    if isinstance(part, dict) and "data" in part:
+        return f"b:{part.get('mime_type', '')}:{hashlib.sha256(part['data']).hexdigest()}"
+    # アップロード済みファイル（音声の区間）は中身のハッシュ入りの表示名で見分ける
+    name = getattr(part, "display_name", None) or getattr(part, "name", None)
+    if name:
+        return f"f:{name}"
+    return "r:" + repr(part)
+
+
+def make_key(model_name, system_instruction, history, content, corpus_version=None):
+    corpus_version = corpus_version or law_index.get_index().version
+    digest = hashlib.sha256()
+    for line in (corpus_version, model_name, hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()):
+        digest.update(line.encode("utf-8") + b"\0")
+    for entry in history:
+        digest.update(b"\1" + entry["role"].encode("utf-8"))
+        for part in entry["parts"]:
+            digest.update(b"\0" + _part_token(part).encode("utf-8"))
+    digest.update(b"\2")
+    for part in content:
+        digest.update(b"\0" + _part_token(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# ---------------------------------------------------------
+# メモリ（LRU・合計サイズで削除）
+# ---------------------------------------------------------
+class MemoryTier:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()     # キー → 回答
+
+    def get(self, key):
+        answer = self._items.get(key)
+        if answer is not None:
+            self._items.move_to_end(key)
+        return answer
+
+    def put(self, key, answer):
+        if key in self._items:
+            self.size -= len(self._items.pop(key).encode("utf-8"))
+        self._items[key] = answer
+        self.size += len(answer.encode("utf-8"))
+        while self.size > self.max_bytes and self._items:
+            _, old = self._items.popitem(last=False)
+            self.size -= len(old.encode("utf-8"))
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+
+# ---------------------------------------------------------
+# ディスク（SQLite・合計サイズで使われていない順に削除）
+# ---------------------------------------------------------
+class SQLiteTier:
+    def __init__(self, path, max_bytes, corpus_version):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # 回答には相談の中身が書かれているので、session_store と同じく本人だけが読み書きできるファイルにする
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if hasattr(os, "fchmod"):
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+        self.max_bytes = max_bytes
+        self.corpus_version = corpus_version
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, corpus_version TEXT, answer TEXT,"
+            " size INTEGER, created REAL, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        # 法律データが変わっていたら、以前のバージョンの回答はまとめて消す
+        self._conn.execute("DELETE FROM responses WHERE corpus_version != ?", (corpus_version,))
+        self._conn.commit()
+
+    def get(self, key):
+        row = self._conn.execute("SELECT answer FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._conn.commit()
+        return row[0]
+
+    def put(self, key, answer):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (key, self.corpus_version, answer, len(answer.encode("utf-8")), now, now)
+        )
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            # 使われていない順に、合計が上限に収まるまで消す
+            excess = total - self.max_bytes
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+            doomed = []
+            for old_key, size in rows:
+                if excess <= 0:
+                    break
+                doomed.append((old_key,))
+                excess -= size
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self._conn.commit()
+
+    def clear(self):
+        self._conn.execute("DELETE FROM responses")
+        self._conn.commit()
+
+
+class ResponseCache:
+    def __init__(self, memory_bytes, disk_path=None, disk_bytes=0, corpus_version=None):
+        self.corpus_version = corpus_version or law_index.get_index().version
+        self.memory = MemoryTier(memory_bytes)
+        self.disk = SQLiteTier(disk_path, disk_bytes, self.corpus_version) if disk_path else None
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            answer = self.memory.get(key)
+            if answer is None and self.disk is not None:
+                answer = self.disk.get(key)
+                if answer is not None:
+                    self.memory.put(key, answer)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def put(self, key, answer):
+        if not answer:
+            return
+        with self._lock:
+            self.memory.put(key, answer)
+            if self.disk is not None:
+                self.disk.put(key, answer)
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            if self.disk is not None:
+                self.disk.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                config.RESPONSE_CACHE_MEMORY_BYTES,
+                config.RESPONSE_CACHE_PATH or None,
+                config.RESPONSE_CACHE_DISK_BYTES,
+            )
+        return _cache
@@ -0,0 +1,136 @@
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict, namedtuple
+
+import artifacts
+import law_index
+
+# ==============================================================================
+# 法律データの検索エンジン（文字n-gram + BM25）
+# 質問文と証拠資料に関連する条文・項目だけを選び出して送信量を減らす
+# ==============================================================================
+
+Chunk = namedtuple("Chunk", ["doc_id", "doc_title", "label", "text", "page", "url"])
+
+QUERY_EVIDENCE_CHARS = 3000
+
+
+# ---------------------------------------------------------
+# コーパスの分割（law_index の項・節レコード単位）
+# ---------------------------------------------------------
+def split_chunks(index=None):
+    index = index or law_index.get_index()
+    chunks = []
+    for provision in index.provisions:
+        # 条全体は項と重複し、章は見出しだけなので検索対象にしない
+        if provision.kind in ("article", "chapter"):
+            continue
+        label = index.label(provision)
+        if provision.kind == "paragraph" and provision.heading.startswith("（"):
+            label = f"{label}{provision.heading}"
+        chunks.append(Chunk(provision.doc_id, index.titles[provision.doc_id], label,
+                            index.text(provision), provision.page, provision.url))
+    return chunks
+
+
+# ---------------------------------------------------------
+# 文字n-gram
+# ---------------------------------------------------------
+def char_ngrams(text, n=2):
+    text = re.sub(r"[^\w]|_", "", unicodedata.normalize("NFKC", text).lower())
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+class BM25Index:
+    def __init__(self, texts, n=2, k1=1.2, b=0.75):
+        self.n, self.k1, self.b = n, k1, b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for i, text in enumerate(texts):
+            grams = Counter(char_ngrams(text, n))
+            self.lengths.append(sum(grams.values()))
+            for gram, tf in grams.items():
+                self.postings[gram].append((i, tf))
+        total = len(self.lengths)
+        self.avgdl = (sum(self.lengths) / total) if total else 0.0
+        self.idf = {
+            gram: math.log(1 + (total - len(posts) + 0.5) / (len(posts) + 0.5))
+            for gram, posts in self.postings.items()
+        }
+
+    def search(self, query, top_k):
+        scores = defaultdict(float)
+        for gram in set(char_ngrams(query, self.n)):
+            idf = self.idf.get(gram)
+            if idf is None:
+                continue
+            for i, tf in self.postings[gram]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avgdl)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+# ==============================================================================
+# 検索ステージ（差し替え可能）
+# ==============================================================================
+class FullCorpusRetriever:
+    """従来動作：全資料をシステムプロンプトに入れるので、質問ごとの抜粋は不要。"""
+
+    sends_full_corpus = True
+
+    def retrieve(self, query, top_k):
+        return []
+
+
+class BM25Retriever:
+    sends_full_corpus = False
+    # 構築した索引は artifacts に保存する（この内容が変わったら作り直す）
+    artifact_sources = law_index.SOURCES + ("retrieval.py",)
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks if chunks is not None else split_chunks()
+        self.index = BM25Index([f"{c.doc_title} {c.label}\n{c.text}" for c in self.chunks])
+
+    def retrieve(self, query, top_k):
+        return [self.chunks[i] for i, _ in self.index.search(query, top_k)]
+
+
+RETRIEVERS = {
+    "full": FullCorpusRetriever,
+    "bm25": BM25Retriever,
+}
+_instances = {}
+
+
+def register_retriever(name, factory):
+    RETRIEVERS[name] = factory
+    _instances.pop(name, None)
+
+
+def get_retriever(mode):
+    # 索引の構築は1プロセスにつき1回だけ（保存済みの索引があれば読み込むだけ）
+    if mode not in _instances:
+        factory = RETRIEVERS.get(mode, FullCorpusRetriever)
+        sources = getattr(factory, "artifact_sources", None)
+        _instances[mode] = artifacts.load_or_build(f"retriever_{mode}", sources, factory) if sources else factory()
+    return _instances[mode]
+
+
+def build_query(prompt, evidence_texts=()):
+    parts = [prompt]
+    for text in evidence_texts:
+        parts.append(text[:QUERY_EVIDENCE_CHARS])
+    return "\n".join(parts)
+
+
+def format_chunks(chunks):
+    blocks = []
+    for c in chunks:
+        source = "　".join(part for part in (c.page, c.url) if part)
+        header = f"■{c.doc_title}　{c.label}" + (f"　[{source}]" if source else "")
+        blocks.append(f"{header}\n{c.text}")
+    return "\n\n".join(blocks)
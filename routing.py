@@ -0,0 +1,60 @@
+from collections import namedtuple
+
+import config
+import prompts
+from tokens import estimate_part_tokens
+
+# ==============================================================================
+# モデルの振り分け
+# 1ターンごとに、新しい資料の有無・質問の長さ・履歴の量から、使うモデルの設定（プロファイル）を選ぶ。
+# 資料の分析や最初の相談は通常のモデル、短い追加の質問は軽くて速いモデルに回す。
+# ==============================================================================
+
+# instruction: prompts.SYSTEM_INSTRUCTIONS のキー（プロファイルごとのシステムプロンプト）
+ModelProfile = namedtuple("ModelProfile", ["name", "model_name", "instruction"])
+# reason: 振り分けの理由（計測ログに残す）
+Route = namedtuple("Route", ["profile", "reason"])
+
+
+def _default_profiles():
+    profiles = {"full": ModelProfile("full", config.MODEL_NAME, "full")}
+    if config.LIGHT_MODEL_NAME:
+        profiles["light"] = ModelProfile("light", config.LIGHT_MODEL_NAME, "light")
+    return profiles
+
+
+PROFILES = _default_profiles()
+
+
+def register_profile(name, model_name, instruction="full"):
+    PROFILES[name] = ModelProfile(name, model_name, instruction)
+
+
+def system_instruction(profile):
+    return prompts.SYSTEM_INSTRUCTIONS[profile.instruction]
+
+
+def history_tokens(history):
+    return sum(estimate_part_tokens(part) for message in history for part in message["parts"])
+
+
+def route(prompt, new_evidence, history):
+    """
+    このターンのモデルを選ぶ。
+    new_evidence: 今回初めて送る資料（attachments.ProcessedAttachment）、history: start_chat に渡す履歴
+    """
+    full = PROFILES["full"]
+    if not config.ROUTING or "light" not in PROFILES:
+        return Route(full, "routing_off")
+    # 新しい資料（写真1枚でも）は中身の分析が必要なので、質問が短くても通常のモデル
+    if new_evidence:
+        kinds = sorted({item.kind for item in new_evidence})
+        return Route(full, f"evidence:{'+'.join(kinds)}")
+    if not any(message["role"] == "user" for message in history):
+        # 最初の相談は経緯の分析になるので通常のモデル
+        return Route(full, "first_question")
+    if len(prompt) > config.ROUTING_LIGHT_MAX_PROMPT_CHARS:
+        return Route(full, "long_prompt")
+    if history_tokens(history) > config.ROUTING_LIGHT_MAX_HISTORY_TOKENS:
+        return Route(full, "long_history")
+    return Route(PROFILES["light"], "follow_up")
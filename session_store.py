@@ -0,0 +1,344 @@
+import base64
+import codecs
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+from functools import lru_cache
+
+import attachments
+import config
+import evidence_store
+
+# ==============================================================================
+# 会話の保存（SQLite）
+# メッセージは1件ずつ追記し、画面を操作するたびに履歴全体を書き直さない。
+# 添付資料から取り出した大きなデータ（PDFの全文・写真）はメッセージとは別の表に圧縮して置き、
+# メッセージには中身のハッシュだけを持たせる。サーバーを再起動しても会話を続けられる。
+# ==============================================================================
+
+ROLES = ("user", "assistant")
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+READ_CHUNK = 64 * 1024
+
+
+# ---------------------------------------------------------
+# 履歴ファイルの書き出し・読み込み
+# ---------------------------------------------------------
+def validate_message(message, index):
+    """保存した履歴の1件を確かめ、必要な項目だけの dict にして返す。"""
+    where = f"{index + 1}件目のメッセージ"
+    if not isinstance(message, dict):
+        raise ValueError(f"{where}の形式が正しくありません")
+    if message.get("role") not in ROLES:
+        raise ValueError(f"{where}の role が正しくありません: {message.get('role')!r}")
+    if not isinstance(message.get("content"), str):
+        raise ValueError(f"{where}の content が文字列ではありません")
+    clean = {"role": message["role"], "content": message["content"]}
+    records = message.get("attachments")
+    if records is not None:
+        if not isinstance(records, list):
+            raise ValueError(f"{where}の attachments が配列ではありません")
+        clean_records = []
+        for record in records:
+            if not (isinstance(record, dict) and isinstance(record.get("name"), str)
+                    and isinstance(record.get("digest"), str) and DIGEST_RE.match(record["digest"])):
+                raise ValueError(f"{where}の添付資料の記録が正しくありません")
+            clean_records.append({"digest": record["digest"], "name": record["name"]})
+        if clean_records:
+            clean["attachments"] = clean_records
+    return clean
+
+
+def _iter_json_array(text):
+    """JSON配列の要素を、ファイル全体を読み込まずに1つずつ返す。"""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof, started = "", 0, False, False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer) or not started and buffer[pos] == "\ufeff":
+            if eof:
+                raise ValueError("履歴ファイルが途中で終わっています")
+            chunk = text.read(READ_CHUNK)
+            eof = not chunk
+            buffer, pos = buffer[pos:].lstrip("\ufeff") + chunk, 0
+            continue
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("履歴ファイルの形式が正しくありません（メッセージの配列ではありません）")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError("履歴ファイルの JSON が壊れています")
+            # 要素が読み込み済みの範囲をまたいでいるので、続きを読んでからやり直す
+            chunk = text.read(READ_CHUNK)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield value
+        pos = end
+
+
+def read_history(fileobj, max_messages=None):
+    """
+    保存した履歴（.json または .json.gz）を少しずつ読み、形式を確かめたメッセージの一覧を返す。
+    """
+    max_messages = config.HISTORY_MAX_MESSAGES if max_messages is None else max_messages
+    raw = fileobj
+    raw.seek(0)
+    if raw.read(2) == b"\x1f\x8b":
+        raw.seek(0)
+        raw = gzip.GzipFile(fileobj=raw, mode="rb")
+    else:
+        raw.seek(0)
+    text = codecs.getreader("utf-8")(raw)
+    messages = []
+    for index, message in enumerate(_iter_json_array(text)):
+        if index >= max_messages:
+            raise ValueError(f"メッセージが多すぎます（上限 {max_messages:,} 件）")
+        messages.append(validate_message(message, index))
+    return messages
+
+
+def export_history(messages):
+    """ダウンロード用の履歴（gzip 圧縮した JSON）。ボタンが押されたときだけ作る。"""
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as gz:
+        gz.write(b"[\n")
+        for i, message in enumerate(messages):
+            if i:
+                gz.write(b",\n")
+            gz.write(json.dumps(message, ensure_ascii=False, indent=2).encode("utf-8"))
+        gz.write(b"\n]\n")
+    return out.getvalue()
+
+
+# ---------------------------------------------------------
+# 添付資料の抽出結果（メッセージとは別に、圧縮して保存）
+# ---------------------------------------------------------
+def _pack(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def _encode_parts(parts):
+    encoded = []
+    for part in parts:
+        if isinstance(part, str):
+            encoded.append({"text": part})
+        elif isinstance(part, dict) and "data" in part:
+            encoded.append({"mime_type": part["mime_type"], "data": base64.b64encode(part["data"]).decode("ascii")})
+        else:
+            # アップロード済みファイルの参照などは保存しない
+            return None
+    return encoded
+
+
+def _decode_parts(encoded):
+    return [p["text"] if "text" in p else {"mime_type": p["mime_type"], "data": base64.b64decode(p["data"])}
+            for p in encoded]
+
+
+# ---------------------------------------------------------
+# 保存先
+# ---------------------------------------------------------
+class SessionStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # 会話と添付資料が入るので、本人だけが読み書きできるファイルにする（WAL などの補助ファイルも同じ権限で作られる）
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if hasattr(os, "fchmod"):
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY, created REAL, updated REAL);
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT, seq INTEGER, role TEXT, content TEXT, attachments TEXT,
+                    PRIMARY KEY (session_id, seq));
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT PRIMARY KEY, name TEXT, mime_type TEXT, kind TEXT,
+                    parts BLOB, text BLOB, fingerprint INTEGER, used REAL);
+            """)
+            self._conn.commit()
+
+    def _touch(self, session_id, now):
+        self._conn.execute(
+            "INSERT INTO sessions VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET updated = excluded.updated",
+            (session_id, now, now)
+        )
+
+    def _row(self, session_id, seq, message):
+        records = message.get("attachments")
+        return (session_id, seq, message["role"], message["content"],
+                json.dumps(records, ensure_ascii=False) if records else None)
+
+    def put_message(self, session_id, seq, message):
+        """seq 番目のメッセージを書き込む（追加・添付記録の更新のどちらにも使う）。"""
+        with self._lock:
+            self._touch(session_id, time.time())
+            self._conn.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", self._row(session_id, seq, message))
+            self._conn.commit()
+
+    def replace_messages(self, session_id, messages):
+        with self._lock:
+            self._touch(session_id, time.time())
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                                   (self._row(session_id, seq, m) for seq, m in enumerate(messages)))
+            self._conn.commit()
+
+    def exists(self, session_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+    def load_messages(self, session_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content, attachments FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        messages = []
+        for role, content, records in rows:
+            message = {"role": role, "content": content}
+            if records:
+                message["attachments"] = json.loads(records)
+            messages.append(message)
+        return messages
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+    def put_attachment(self, item):
+        # 音声は区間ごとにディスクとアップロード済みファイルで管理しているので、ここには置かない
+        if item.error or item.kind == "audio":
+            return
+        parts = _encode_parts(item.parts)
+        if parts is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (item.digest, item.name, item.mime_type, item.kind, _pack(parts),
+                 _pack(item.text) if item.text else None, item.fingerprint, time.time())
+            )
+            self._conn.commit()
+
+    def delete_attachment(self, digest):
+        with self._lock:
+            self._conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            self._conn.commit()
+
+    def get_attachment(self, digest):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, mime_type, kind, parts, text, fingerprint FROM blobs WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE blobs SET used = ? WHERE digest = ?", (time.time(), digest))
+                self._conn.commit()
+        if row is None:
+            return None
+        name, mime_type, kind, parts, text, fingerprint = row
+        return attachments.ProcessedAttachment(
+            digest, name, mime_type, kind, _decode_parts(_unpack(parts)),
+            _unpack(text) if text else None, None, fingerprint
+        )
+
+    def purge(self, days):
+        """しばらく使われていない会話と添付資料を消す。"""
+        cutoff = time.time() - days * 86400
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM messages WHERE session_id IN (SELECT id FROM sessions WHERE updated < ?)", (cutoff,)
+            )
+            self._conn.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,))
+            self._conn.execute("DELETE FROM blobs WHERE used < ?", (cutoff,))
+            self._conn.commit()
+
+
+# ---------------------------------------------------------
+# 画面の会話の再開（URL の会話IDだけでは開けないよう、このブラウザに発行した会話かを署名で確かめる）
+# ---------------------------------------------------------
+SESSION_COOKIE = "ijime_session"
+SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+SECRET_FILE = "session_secret"
+
+
+@lru_cache(maxsize=1)
+def _secret():
+    if config.SESSION_SECRET:
+        return config.SESSION_SECRET.encode("utf-8")
+    # 再起動後も同じ鍵を使うため、本人だけが読めるファイルに保存する（保存できなければこのプロセスの間だけ使う）
+    try:
+        evidence_store.private_dir(config.DATA_DIR)
+        path = os.path.join(config.DATA_DIR, SECRET_FILE)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(path, "rb") as f:
+                secret = f.read()
+            if len(secret) >= 32:
+                return secret
+            raise OSError(f"署名鍵のファイルが壊れています: {path}")
+        secret = secrets.token_bytes(32)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+        return secret
+    except OSError:
+        return secrets.token_bytes(32)
+
+
+def session_token(session_id):
+    """会話IDの署名（このブラウザのクッキーに入れる。URL には載せない）。"""
+    return hmac.new(_secret(), session_id.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def can_resume(session_id, token):
+    """URL の会話IDが、このブラウザに発行した（クッキーの署名が合う）ものか。"""
+    return (isinstance(session_id, str) and bool(SESSION_ID_RE.match(session_id)) and isinstance(token, str)
+            and hmac.compare_digest(token, session_token(session_id)))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """設定された保存先（プロセス共通）。SESSION_DB_PATH が空なら None（メモリ上だけで動く）。"""
+    global _store
+    with _store_lock:
+        if _store is None and config.SESSION_DB_PATH:
+            _store = SessionStore(config.SESSION_DB_PATH)
+            _store.purge(config.SESSION_RETENTION_DAYS)
+            # メモリ上のキャッシュから消えた添付資料も、ここから読み戻せるようにする
+            attachments.CACHE.backing = _store
+        return _store
@@ -0,0 +1,306 @@
+import codecs
+import datetime
+import io
+import random
+import re
+from collections import Counter
+
+import config
+from tokens import estimate_tokens
+
+# ==============================================================================
+# 表データ（Excel・CSV）の取り込み
+# 全シートを1行ずつ読み、列の概要・日付の範囲・月別の欠席数と、予算内のTSV行にまとめる。
+# 行数がいくら多くても、メモリと送信量は予算の分しか使わない。
+# pandas・openpyxl は読み込みに時間がかかるため、表ファイルが来たときに初めて読み込む。
+# ==============================================================================
+
+DATE_RE = re.compile(r"(\d{4})\s*[-/年.]\s*(\d{1,2})\s*[-/月.]\s*(\d{1,2})")
+ABSENCE_HEADER_RE = re.compile(r"欠席|出欠|出席|勤怠|状況|区分")
+TOP_VALUES = 5
+MAX_DISTINCT = 50
+HEAD_ROWS = 20
+CSV_CHUNK_ROWS = 5000
+OMITTED_NOTE = "（以下省略：表のまとめが予算{budget:,}トークンを超えるため、残り{rest:,}行分のまとめを省きました）"
+
+
+# ---------------------------------------------------------
+# 値の判定
+# ---------------------------------------------------------
+def _cell_text(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d") if value.time() == datetime.time() else value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).replace("\t", " ").replace("\n", " ").strip()
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, str):
+        match = DATE_RE.search(value)
+        if match:
+            try:
+                return datetime.date(*(int(g) for g in match.groups()))
+            except ValueError:
+                return None
+    return None
+
+
+def _as_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value.replace(",", ""))
+        except ValueError:
+            return None
+    return None
+
+
+# ---------------------------------------------------------
+# 列・シートの集計（1行ずつ更新する）
+# ---------------------------------------------------------
+class ColumnProfile:
+    def __init__(self, name):
+        self.name = name
+        self.filled = 0
+        self.numbers = 0
+        self.dates = 0
+        self.min_number = self.max_number = None
+        self.min_date = self.max_date = None
+        self.values = Counter()
+        self.too_many_values = False
+
+    def add(self, value, text):
+        """1セル分を集計し、日付として読めたらその日付を返す。"""
+        if not text:
+            return None
+        self.filled += 1
+        date = _as_date(value)
+        number = None if date else _as_number(value)
+        if date:
+            self.dates += 1
+            self.min_date = min(self.min_date or date, date)
+            self.max_date = max(self.max_date or date, date)
+        elif number is not None:
+            self.numbers += 1
+            self.min_number = number if self.min_number is None else min(self.min_number, number)
+            self.max_number = number if self.max_number is None else max(self.max_number, number)
+        if not self.too_many_values:
+            self.values[text] += 1
+            if len(self.values) > MAX_DISTINCT:
+                self.too_many_values = True
+                self.values.clear()
+        return date
+
+    def describe(self):
+        if not self.filled:
+            return f"・{self.name}: 空欄のみ"
+        if self.dates >= self.filled / 2:
+            return f"・{self.name}: 日付 {self.min_date}〜{self.max_date}（記入{self.filled}件）"
+        if self.numbers >= self.filled / 2:
+            return f"・{self.name}: 数値 {_cell_text(self.min_number)}〜{_cell_text(self.max_number)}（記入{self.filled}件）"
+        if self.too_many_values:
+            return f"・{self.name}: 文字（{MAX_DISTINCT}種類以上、記入{self.filled}件）"
+        top = "、".join(f"{value} {count}" for value, count in self.values.most_common(TOP_VALUES))
+        return f"・{self.name}: 文字 {len(self.values)}種類（{top}）"
+
+
+class SheetProfile:
+    def __init__(self, title, header, row_budget):
+        self.title = title
+        self.header = header
+        self.columns = [ColumnProfile(name) for name in header]
+        self.rows = 0
+        self.absence_by_month = Counter()
+        self.absence_columns = [i for i, name in enumerate(header) if ABSENCE_HEADER_RE.search(name)]
+        self.row_budget = row_budget
+        self.head = []
+        self.kept_tokens = 0
+        self.sample = []
+        self.capacity = 0
+        self.sampling = False
+        self.random = random.Random(0)
+
+    def add(self, row):
+        self.rows += 1
+        row = list(row[:len(self.columns)]) + [None] * (len(self.columns) - len(row))
+        texts = [_cell_text(value) for value in row]
+        first_date = None
+        for column, value, text in zip(self.columns, row, texts):
+            date = column.add(value, text)
+            first_date = first_date or date
+        if first_date and self.absence_columns:
+            self._count_absence(row, f"{first_date.year}-{first_date.month:02d}")
+        self._keep_row(texts)
+
+    def _count_absence(self, row, month):
+        # 行の最初の日付の月に、欠席を表す値（「欠」を含む文字・欠席日数の数値）を加える
+        for i in self.absence_columns:
+            value = row[i]
+            number = _as_number(value)
+            if number is not None and "日数" in self.columns[i].name:
+                self.absence_by_month[month] += number
+            elif isinstance(value, str) and "欠" in value:
+                self.absence_by_month[month] += 1
+
+    def _keep_row(self, cells):
+        line = "\t".join(cells)
+        if not self.sampling:
+            cost = estimate_tokens(line)
+            if self.kept_tokens + cost <= self.row_budget:
+                self.head.append(line)
+                self.kept_tokens += cost
+                return
+            # 予算を超えたら先頭の数行だけ残し、以降は無作為抽出に切り替える
+            self.sampling = True
+            self.sample = list(enumerate(self.head))[HEAD_ROWS:]
+            self.head = self.head[:HEAD_ROWS]
+            self.capacity = len(self.sample)
+        # 無作為抽出（リザーバーサンプリング）：抽出件数は切り替え時点で予算に入っていた行数で固定
+        seen = self.rows - len(self.head)
+        if len(self.sample) < self.capacity:
+            self.sample.append((self.rows, line))
+        elif self.capacity:
+            slot = self.random.randrange(seen)
+            if slot < self.capacity:
+                self.sample[slot] = (self.rows, line)
+
+    def _render_absence(self):
+        months = sorted(self.absence_by_month.items())
+        by_year = Counter()
+        for month, count in months:
+            year, mon = (int(part) for part in month.split("-"))
+            by_year[year if mon >= 4 else year - 1] += count
+        lines = ["欠席の集計（「欠」を含む記録の件数・欠席日数の合計。不登校重大事態の目安は年間30日）:"]
+        lines += [f"{year}年度\t{_cell_text(float(count))}" for year, count in sorted(by_year.items())]
+        # 月別は直近24か月分まで
+        lines.append("月別:")
+        lines += [f"{month}\t{_cell_text(float(count))}" for month, count in months[-24:]]
+        return lines
+
+    def render(self):
+        lines = [f"■シート「{self.title}」 {self.rows:,}行 × {len(self.columns)}列", "列の概要:"]
+        lines += [column.describe() for column in self.columns]
+        if self.absence_by_month:
+            lines += self._render_absence()
+        if self.sampling:
+            lines.append(f"行データ（全{self.rows:,}行のうち先頭{len(self.head)}行＋無作為抽出{len(self.sample)}行、TSV）:")
+        else:
+            lines.append("行データ（TSV）:")
+        lines.append("\t".join(self.header))
+        lines += self.head
+        if self.sampling:
+            lines.append("…（中略：以下は無作為抽出、元の行順）")
+            lines += [line for _, line in sorted(self.sample)]
+        return "\n".join(lines)
+
+
+# ---------------------------------------------------------
+# 読み込み（全シート・1行ずつ）
+# ---------------------------------------------------------
+def _header_and_rows(rows):
+    for row in rows:
+        if any(_cell_text(value) for value in row):
+            header = [_cell_text(value) or f"列{i + 1}" for i, value in enumerate(row)]
+            return header, rows
+    return [], iter(())
+
+
+def _detect_encoding(data):
+    sample = data[:65536]
+    for encoding in ("utf-8-sig", "cp932"):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=len(data) <= 65536)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "utf-8-sig"
+
+
+def _csv_rows(data):
+    import pandas as pd
+    reader = pd.read_csv(
+        io.BytesIO(data), header=None, dtype=str, keep_default_na=False,
+        encoding=_detect_encoding(data), chunksize=CSV_CHUNK_ROWS, encoding_errors="replace"
+    )
+    for chunk in reader:
+        yield from chunk.itertuples(index=False, name=None)
+
+
+def iter_sheets(data, mime_type):
+    """(シート名, 行のイテレーター, シート数) を順に返す。"""
+    if "csv" in mime_type:
+        yield "CSV", _csv_rows(data), 1
+        return
+    if data[:2] == b"PK":
+        import openpyxl
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                yield sheet.title, sheet.iter_rows(values_only=True), len(workbook.worksheets)
+        finally:
+            workbook.close()
+        return
+    # 旧形式（.xls）は pandas に任せる
+    import pandas as pd
+    frames = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None)
+    for title, df in frames.items():
+        yield title, df.itertuples(index=False, name=None), len(frames)
+
+
+def _row_passage(title, header, first, lines):
+    return f"シート「{title}」{first}〜{first + len(lines) - 1}行目", "\t".join(header) + "\n" + "\n".join(lines)
+
+
+def _fit_budget(text, budget):
+    """見出し・列の概要・行データをまとめて予算内に収め、超えた分は省いたと明記する。"""
+    lines = text.split("\n")
+    costs = [estimate_tokens(line) for line in lines]
+    if sum(costs) <= budget:
+        return text
+    # 省略の注記の分も予算に含める
+    limit = budget - estimate_tokens(OMITTED_NOTE.format(budget=budget, rest=len(lines)))
+    used = kept = 0
+    while kept < len(lines) and used + costs[kept] <= limit:
+        used += costs[kept]
+        kept += 1
+    return "\n".join(lines[:kept] + [OMITTED_NOTE.format(budget=budget, rest=len(lines) - kept)])
+
+
+def summarize_table(data, mime_type, budget=None, passages=None):
+    """
+    表ファイル全体をトークン予算内のテキストにまとめる（シート・列の概要も予算に数える）。
+    passages（evidence_store.spool など append を持つもの）を渡すと、全行を EVIDENCE_ROWS_PER_PASSAGE 行ずつの
+    (場所, TSV) にして1つずつ渡す（資料の索引用。行をメモリにためない）。
+    """
+    budget = budget or config.TABLE_TOKEN_BUDGET
+    blocks = []
+    for title, rows, sheet_count in iter_sheets(data, mime_type):
+        header, rows = _header_and_rows(iter(rows))
+        if not header:
+            continue
+        # 行データに使える予算は、概要の分を残してシートごとに均等割り（全体は最後に予算で切る）
+        profile = SheetProfile(title, header, row_budget=budget // 2 // sheet_count)
+        lines = []
+        for row in rows:
+            profile.add(row)
+            if passages is not None:
+                lines.append("\t".join(_cell_text(value) for value in row[:len(header)]))
+                if len(lines) == config.EVIDENCE_ROWS_PER_PASSAGE:
+                    passages.append(_row_passage(title, header, profile.rows - len(lines) + 1, lines))
+                    lines = []
+        if lines:
+            passages.append(_row_passage(title, header, profile.rows - len(lines) + 1, lines))
+        blocks.append(profile.render())
+    return _fit_budget("\n\n".join(blocks), budget)
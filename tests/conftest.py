@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# ==============================================================================
+# テストの共通設定
+# config は読み込まれた時点の環境変数で決まるので、アプリのモジュールより先に設定する。
+# AIは代替バックエンド（fake_backend）で動かし、会話・資料の索引・回答はディスクに残さない。
+# ==============================================================================
+
+os.environ.update({
+    "IJIME_BACKEND": "fake",
+    "IJIME_SESSION_DB_PATH": "",
+    "IJIME_EVIDENCE_DIR": "",
+    "IJIME_RESPONSE_CACHE": "0",
+    "IJIME_METRICS_SINKS": "",
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def evidence_dir(tmp_path, monkeypatch):
+    """資料の索引を tmp_path に置いて有効にする。"""
+    import config
+    import evidence_store
+    monkeypatch.setattr(config, "EVIDENCE_DIR", str(tmp_path))
+    evidence_store.available.cache_clear()
+    yield tmp_path
+    evidence_store.available.cache_clear()
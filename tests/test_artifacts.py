@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+import artifacts
+import config
+
+# ==============================================================================
+# 事前計算したデータ（artifacts）：本人が保存した完全なファイルだけを読み込む
+# ==============================================================================
+
+
+@pytest.fixture
+def artifact_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "artifacts"
+    monkeypatch.setattr(config, "ARTIFACT_DIR", str(directory))
+    return directory
+
+
+def test_saved_artifact_is_reused(artifact_dir):
+    assert artifacts.load_or_build("sample", ["config.py"], lambda: {"built": 1}) == {"built": 1}
+    path = artifacts.path_for("sample", ["config.py"])
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert artifacts.load_or_build("sample", ["config.py"], lambda: {"built": 2}) == {"built": 1}
+
+
+@pytest.mark.parametrize("spoil", [
+    lambda path: open(path, "wb").write(b"\x80\x05broken"),
+    lambda path: os.chmod(path, 0o666),
+])
+def test_broken_or_writable_artifact_is_rebuilt(artifact_dir, spoil, capsys):
+    artifacts.load_or_build("sample", ["config.py"], lambda: {"built": 1})
+    spoil(artifacts.path_for("sample", ["config.py"]))
+    assert artifacts.load_or_build("sample", ["config.py"], lambda: {"built": 2}) == {"built": 2}
+    assert "作り直します" in capsys.readouterr().err
@@ -0,0 +1,69 @@
+import pytest
+
+import attachments
+import engine
+import evidence_store
+from fake_backend import FakeChat
+
+# ==============================================================================
+# 送信済みの資料（attachments）：全文を送るのは最初のターンだけ
+# ==============================================================================
+
+
+def _size(parts):
+    return sum(len(part) for part in parts if isinstance(part, str))
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """送信ごとの (履歴の文字列, 今回の送信内容)。"""
+    sent = []
+    send_message = FakeChat.send_message
+
+    def recording(self, content, *args, **kwargs):
+        history = "".join(part for entry in self.history for part in entry["parts"] if isinstance(part, str))
+        sent.append((history, content))
+        return send_message(self, content, *args, **kwargs)
+
+    monkeypatch.setattr(FakeChat, "send_message", recording)
+    return sent
+
+
+def _report(pages):
+    text = "\n".join(f"[P.{n}]\n{n}ページ目。欠席の記録と面談の経過。" + "担任の所見。" * 100 for n in range(1, pages + 1))
+    item = attachments.ProcessedAttachment(
+        f"{pages:064x}", "報告書.pdf", "application/pdf", "pdf", [f"【参照資料(PDF)】報告書.pdf\n{text}"], text, None
+    )
+    attachments.CACHE.put(item)
+    return item
+
+
+def test_earlier_attachment_is_not_resent_in_full(evidence_dir, sent):
+    item = _report(3)
+    session = engine.Session()
+    # 最初のターンで送り、索引に登録した状態（run_turn が資料を受け取ったあとと同じ）
+    session.messages += [
+        {"role": "user", "content": "報告書を送ります", "attachments": attachments.attachment_records([item])},
+        {"role": "assistant", "content": "拝見しました。"},
+    ]
+    session.sent_attachments[item.digest] = item.name
+    evidence_store.get_store(session.session_id).add(item)
+
+    prompts = ("欠席の記録はどうなっていますか", "担任の所見は", "面談の経過は")
+    for prompt in prompts:
+        events = list(engine.run_turn(session, prompt, stream=False))
+        assert events[-1].kind == "done"
+    page = "担任の所見。" * 100
+    histories = [history for history, _ in sent]
+    # 履歴には資料の名前だけが残り、ターンを重ねても全文は付け直さない（増えるのは質問と回答の分だけ）
+    assert all(page not in history for history in histories)
+    growth = [len(after) - len(before) for before, after in zip(histories, histories[1:])]
+    assert all(0 < size < _size(item.parts) for size in growth)
+    # 中身は質問ごとの【資料からの抜粋】で送る
+    assert all(evidence_store.EXCERPT_HEADER in "".join(content) for _, content in sent)
+
+
+def test_without_index_history_keeps_the_content():
+    item = _report(1)
+    message = {"role": "user", "content": "報告書", "attachments": attachments.attachment_records([item])}
+    assert attachments.history_parts(message) == ["報告書", *item.parts]
@@ -0,0 +1,54 @@
+import citations
+import law_index
+import lookup
+
+# ==============================================================================
+# 回答の引用チェック（citations）：資料名の照合と、入手先URLの修正
+# ==============================================================================
+
+
+def test_matcher_finds_overlapping_patterns_in_one_pass():
+    matcher = citations.Matcher({"he": 1, "she": 2, "his": 3, "hers": 4})
+    assert sorted(matcher.find("ushers")) == [(1, 3, 2), (2, 2, 1), (2, 4, 4)]
+    assert list(matcher.find("xyz")) == []
+
+
+def test_matcher_best_prefers_the_longest_match():
+    matcher = citations.Matcher({"推進法": "short", "いじめ防止対策推進法": "long", "基本方針": "policy"})
+    assert matcher.best("いじめ防止対策推進法 第23条") == "long"
+    assert matcher.best("基本方針と推進法") == "policy"
+    assert matcher.best("関係のない文") is None
+
+
+def _box(article, paragraph, url):
+    index = law_index.get_index()
+    box = lookup.format_box(index, index.lookup("ijime_act", article, paragraph))
+    known_url, _ = index.reference_for("ijime_act")
+    return box.replace(known_url, url), known_url
+
+
+def test_verify_keeps_a_correct_citation():
+    index = law_index.get_index()
+    known_url, _ = index.reference_for("ijime_act")
+    box, _ = _box(23, 5, known_url)
+    fixed, found = citations.verify(box)
+    assert fixed == box
+    assert [(c.doc_id, c.status) for c in found] == [("ijime_act", "verified")]
+    assert found[0].excerpt
+
+
+def test_verify_rewrites_a_wrong_url():
+    box, known_url = _box(28, 1, "https://example.com/wrong")
+    fixed, found = citations.verify("前置き\n" + box + "\n後書き")
+    assert "https://example.com/wrong" not in fixed
+    assert known_url in fixed
+    assert fixed.startswith("前置き\n") and fixed.endswith("\n後書き")
+    assert found[0].status == "fixed"
+
+
+def test_verify_reports_missing_article_and_unknown_document():
+    box, _ = _box(23, 5, "https://example.com/wrong")
+    missing = box.replace("第23条 第5項", "第99条")
+    unknown = box.replace("いじめ防止対策推進法", "架空の規則")
+    _, found = citations.verify(missing + "\n\n" + unknown)
+    assert [c.status for c in found] == ["not_found", "unknown_document"]
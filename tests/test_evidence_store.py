@@ -0,0 +1,74 @@
+import os
+
+import attachments
+import api_server
+import engine
+import evidence_store
+from tokens import estimate_tokens
+
+# ==============================================================================
+# 資料の索引（evidence_store）：抜粋の予算と、会話の削除・保存期間
+# ==============================================================================
+
+
+def _pdf(name, pages):
+    text = "\n".join(f"[P.{n}]\n{body}" for n, body in enumerate(pages, 1))
+    digest = name.encode("utf-8").hex().ljust(64, "0")[:64]
+    item = attachments.ProcessedAttachment(
+        digest, name, "application/pdf", "pdf", [f"【参照資料(PDF)】{name}\n{text}"], text, None
+    )
+    attachments.CACHE.put(item)
+    return item
+
+
+def test_excerpt_fallback_stays_within_budget(evidence_dir, monkeypatch):
+    store = evidence_store.get_store("budget")
+    # A は質問に合う短いページで予算を使い切り、B は合う箇所が大きすぎて入らない（冒頭で補う）
+    a = _pdf("A.pdf", ["欠席が続いた。" * 40] * 5)
+    b = _pdf("B.pdf", ["欠席" + "経過の記録。" * 130])
+    for item in (a, b):
+        store.add(item)
+    sent = []
+    monkeypatch.setattr(evidence_store, "format_passages", lambda passages, budget=None: sent.extend(passages))
+    evidence_store.excerpt(store, "欠席", [a.digest, b.digest], budget=1000)
+    assert {p.digest for p in sent} == {a.digest, b.digest}
+    assert sum(estimate_tokens(p.text) for p in sent) <= 1000
+
+
+def _session_with_evidence():
+    item = _pdf("記録.pdf", ["面談の記録。"])
+    session = engine.Session()
+    session.sent_attachments[item.digest] = item.name
+    store = evidence_store.get_store(session.session_id)
+    store.add(item)
+    return session, item, store.directory
+
+
+def test_reset_deletes_session_evidence(evidence_dir):
+    session, item, directory = _session_with_evidence()
+    assert os.path.isdir(directory)
+    session.reset()
+    assert not os.path.exists(directory)
+    assert attachments.CACHE.get(item.digest) is None
+
+
+def test_api_delete_removes_session_evidence(evidence_dir):
+    registry = api_server.SessionRegistry(10, 3600)
+    session, item, directory = _session_with_evidence()
+    registry._items[session.session_id] = (session, 0, None)
+    assert registry.delete(session.session_id)
+    assert not os.path.exists(directory)
+    assert attachments.CACHE.get(item.digest) is None
+
+
+def test_purge_keeps_indexes_that_are_still_written(evidence_dir):
+    _, _, directory = _session_with_evidence()
+    old = 0
+    # 追記ではフォルダの時刻は変わらない。中のファイルが新しければ使われている索引として残す
+    os.utime(directory, (old, old))
+    evidence_store.purge(1)
+    assert os.path.isdir(directory)
+    for name in [*os.listdir(directory), ""]:
+        os.utime(os.path.join(directory, name), (old, old))
+    evidence_store.purge(1)
+    assert not os.path.exists(directory)
@@ -0,0 +1,152 @@
+import random
+import threading
+
+import pytest
+
+import attachments
+import backends
+import config
+import engine
+import model_cache
+import rate_limit
+import routing
+from fake_backend import FakeBackend, FakeResourceExhausted
+
+# ==============================================================================
+# 代替バックエンド（fake_backend）で、APIを呼ばずに分析の流れを確かめる
+# ==============================================================================
+
+
+# ---------------------------------------------------------
+# モデルの共有（model_cache）
+# ---------------------------------------------------------
+def test_model_is_shared_across_sessions():
+    backend = backends.get_backend()
+    model_cache.clear()
+    before = backend.models_created
+    for prompt in ("学校が重大事態として扱わない", "担任が相談に応じてくれない"):
+        events = list(engine.run_turn(engine.Session(), prompt, stream=False))
+        assert events[-1].kind == "done"
+    # 別々の会話でも、同じシステムプロンプトのモデルは1回しか作らない
+    assert backend.models_created - before == 1
+
+
+def test_model_cache_keys_on_system_instruction():
+    backend = backends.get_backend()
+    model_cache.clear()
+    first = model_cache.get_model(backend, "model-a", "指示A", None)
+    assert model_cache.get_model(backend, "model-a", "指示A", None) is first
+    assert model_cache.get_model(backend, "model-a", "指示B", None) is not first
+    assert model_cache.get_model(backend, "model-b", "指示A", None) is not first
+
+
+# ---------------------------------------------------------
+# 流量制御と自動再送（rate_limit）
+# ---------------------------------------------------------
+@pytest.fixture
+def fast_retry(monkeypatch):
+    monkeypatch.setattr(config, "RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(config, "RETRY_MAX_DELAY", 0.05)
+    monkeypatch.setattr(config, "RETRY_MAX_ATTEMPTS", 4)
+
+
+def _chat(backend):
+    return backend.create_model("model", "指示", None).start_chat()
+
+
+def test_send_message_retries_after_429(fast_retry):
+    backend = FakeBackend(fail_next=2)
+    limiter = rate_limit.RateLimiter(6000, 10, 10)
+    waits = []
+    response = rate_limit.send_message(_chat(backend), ["質問"], "s1", on_wait=waits.append, limiter=limiter)
+    assert response.text
+    assert (backend.calls, backend.errors) == (3, 2)
+    # 再送の前に、何回目の送信を待っているかを知らせる
+    assert [w.attempt for w in waits if w.retry_in is not None] == [2, 3]
+
+
+def test_send_message_gives_up_after_max_attempts(fast_retry):
+    backend = FakeBackend(fail_next=10)
+    with pytest.raises(FakeResourceExhausted):
+        rate_limit.send_message(_chat(backend), ["質問"], "s1", limiter=rate_limit.RateLimiter(6000, 10, 10))
+    assert backend.calls == config.RETRY_MAX_ATTEMPTS
+
+
+def test_backoff_delay_grows_and_is_capped(fast_retry):
+    rng = random.Random(0)
+    for attempt in range(8):
+        limit = min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2 ** attempt)
+        assert all(0 <= rate_limit.backoff_delay(attempt, rng) <= limit for _ in range(50))
+
+
+class FakeClock:
+    """手で進める時計。進めたら待っているスレッドを起こし、新しい時刻で順番を確かめさせる。"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.limiter = None
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        with self.limiter._cond:
+            self.limiter._cond.notify_all()
+
+
+def _queue(limiter, session_id, then=None):
+    """送信待ちの列に並ぶスレッドを始め、列に入ったのを確かめてから返す。"""
+    queued = threading.Event()
+
+    def run():
+        limiter.acquire(session_id, on_wait=lambda status: queued.set(), timeout=60)
+        if then:
+            then()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert queued.wait(5)
+    return thread
+
+
+def test_queue_takes_turns_between_sessions():
+    # 1分600件（0.1秒に1件）・ため置き1件。止めた時計の上で全員を並ばせ、時計を進めて1件ずつ通す
+    clock = FakeClock()
+    limiter = clock.limiter = rate_limit.RateLimiter(600, 1, 10, clock=clock)
+    limiter.pause(1)
+    order, passed = [], threading.Semaphore(0)
+    threads = [_queue(limiter, name[0], lambda name=name: (order.append(name), passed.release()))
+               for name in ("A1", "A2", "A3", "B1")]
+    clock.advance(1)
+    for _ in threads:
+        assert passed.acquire(timeout=5)
+        clock.advance(0.1)
+    for thread in threads:
+        thread.join()
+    # 同じ会話の送信が続いても、ほかの会話と1件ずつ交互に回る（会話の中では並んだ順）
+    assert order == ["A1", "B1", "A2", "A3"]
+
+
+def test_queue_full_is_reported():
+    clock = FakeClock()
+    limiter = clock.limiter = rate_limit.RateLimiter(60, 1, 1, clock=clock)
+    limiter.pause(1)
+    thread = _queue(limiter, "A")
+    with pytest.raises(rate_limit.QueueFull):
+        limiter.acquire("B", timeout=5)
+    clock.advance(1)
+    thread.join()
+
+
+# ---------------------------------------------------------
+# モデルの振り分け（routing）
+# ---------------------------------------------------------
+def test_new_evidence_always_goes_to_full_model():
+    history = [{"role": "user", "parts": ["担任が相談に応じてくれない"]}, {"role": "model", "parts": ["回答"]}]
+    photo = attachments.ProcessedAttachment("0" * 64, "写真.jpg", "image/jpeg", "image",
+                                            [{"mime_type": "image/jpeg", "data": b""}], None, None)
+    assert routing.route("これは？", [], history).profile.name == "light"
+    # 短い追加の質問でも、新しい写真があれば通常のモデルで分析する
+    route = routing.route("これは？", [photo], history)
+    assert (route.profile.name, route.reason) == ("full", "evidence:image")
@@ -0,0 +1,57 @@
+import citations
+import config
+import history
+
+# ==============================================================================
+# 会話履歴の組み立て（history）：トークン予算・要約・引用つきのやり取りの優先
+# ==============================================================================
+
+
+def _turn(i, user=None, answer=None):
+    return [
+        {"role": "user", "content": user or f"相談{i}" + "あ" * 100},
+        {"role": "assistant", "content": answer or f"回答{i}" + "い" * 100},
+    ]
+
+
+def _texts(entries):
+    return [(entry["role"], entry["parts"][0]) for entry in entries]
+
+
+def _as_sent(messages):
+    return [("user" if m["role"] == "user" else "model", m["content"]) for m in messages]
+
+
+def test_history_within_budget_is_sent_as_is():
+    messages = _turn(0) + _turn(1)
+    built = history.build_history(messages, budget=10000, keep_turns=1)
+    assert _texts(built) == _as_sent(messages)
+
+
+def test_old_turns_are_folded_and_cited_turn_is_pinned():
+    pinned = _turn(1, user="第23条第5項は？", answer="短い回答")
+    messages = _turn(0) + pinned + _turn(2) + _turn(3) + _turn(4) + _turn(5)
+    built = history.build_history(messages, budget=500, keep_turns=2)
+
+    summary = built[0]["parts"][0]
+    assert built[0]["role"] == "user" and summary.startswith(history.SUMMARY_HEADER)
+    assert "相談0" in summary and "相談3" in summary and "相談4" not in summary
+    # 要約の次がユーザー発言になるので、受け答えを1つ挟む
+    assert _texts(built[1:2]) == [("model", history.SUMMARY_ACK)]
+    # 条文を尋ねたやり取りは、新しい引用なしのやり取りより優先して原文のまま残す
+    assert _texts(built[2:4]) == [("user", "第23条第5項は？"), ("model", "短い回答")]
+    # 直近 keep_turns ターンは必ずそのまま
+    assert _texts(built[4:]) == _as_sent(_turn(4) + _turn(5))
+
+
+def test_summary_is_capped_from_the_oldest_line(monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_SUMMARY_MAX_TOKENS", 300)
+    messages = [m for i in range(6) for m in _turn(i)]
+    summary = history.build_history(messages, budget=0, keep_turns=1)[0]["parts"][0]
+    assert "相談4" in summary and "相談0" not in summary
+
+
+def test_citation_report_is_not_sent_back():
+    answer = "回答の本文" + citations.REPORT_SEPARATOR + "\n- ✅ 第23条：原文を確認しました"
+    built = history.build_history(_turn(0, answer=answer), budget=10000, keep_turns=1)
+    assert _texts(built)[-1] == ("model", "回答の本文")
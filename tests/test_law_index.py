@@ -0,0 +1,75 @@
+import pytest
+
+import law_index
+
+# ==============================================================================
+# 法律データの構造化インデックス（law_index）：漢数字と、条・項の範囲
+# ==============================================================================
+
+TEXT = """いじめ防止対策推進法
+
+第一章　総則
+
+（定義）
+第二条　この法律において「いじめ」とは、行為をいう。
+２　この法律において「学校」とは、学校をいう。
+３　この法律において「児童等」とは、児童をいう。
+
+（基本理念）
+第三条　いじめの防止等の対策は、行われなければならない。
+"""
+REFERENCE_MAP = """■いじめ防止対策推進法（平成25年法律第71号）
+https://example.jp/ijime
+P.3(定義) P.4(基本理念)
+"""
+
+
+@pytest.mark.parametrize("numeral, expected", [
+    ("23", 23), ("２３", 23), ("二十三", 23), ("十", 10), ("十五", 15), ("百二", 102), ("三千", 3000), ("〇", 0),
+])
+def test_to_int_reads_kanji_and_full_width_numerals(numeral, expected):
+    assert law_index.to_int(numeral) == expected
+
+
+def test_to_int_rejects_other_text():
+    with pytest.raises(ValueError):
+        law_index.to_int("二十条")
+
+
+@pytest.fixture(scope="module")
+def index():
+    # 本文は連結した文字列の途中にあっても、その位置で引ける
+    return law_index.LawIndex("前置き\n" + TEXT, [("ijime_act", "いじめ防止対策推進法", TEXT)], REFERENCE_MAP)
+
+
+def test_paragraph_spans(index):
+    first = index.lookup("ijime_act", 2, 1)
+    # 第1項は条の見出し（（定義））から、第2項以降は項の行だけ
+    assert index.text(first) == "（定義）\n第二条　この法律において「いじめ」とは、行為をいう。"
+    assert index.text(index.lookup("ijime_act", 2, 2)) == "２　この法律において「学校」とは、学校をいう。"
+    assert index.text(index.lookup("ijime_act", 2, 3)) == "３　この法律において「児童等」とは、児童をいう。"
+    assert index.lookup("ijime_act", 2, 4) is None
+
+
+def test_article_spans_all_paragraphs(index):
+    article = index.lookup("ijime_act", 2)
+    assert article.kind == "article"
+    assert index.text(article).startswith("（定義）\n第二条")
+    assert index.text(article).endswith("「児童等」とは、児童をいう。")
+    assert index.label(article) == "第2条"
+    assert index.label(index.lookup("ijime_act", 2, 3)) == "第2条第3項"
+
+
+def test_reference_map_gives_url_and_page(index):
+    assert index.lookup("ijime_act", 3, 1).heading == "（基本理念）"
+    assert [(p.page, p.url) for p in (index.lookup("ijime_act", 2), index.lookup("ijime_act", 3))] == [
+        ("P.3", "https://example.jp/ijime"), ("P.4", "https://example.jp/ijime"),
+    ]
+    chapters = [p for p in index.provisions if p.kind == "chapter"]
+    assert [(p.article, p.heading) for p in chapters] == [(1, "第一章　総則")]
+
+
+def test_bundled_law_data_has_key_provisions():
+    index = law_index.get_index()
+    assert "重大事態" in index.text(index.lookup("ijime_act", 28, 1))
+    assert index.lookup("ijime_act", 23, 5) is not None
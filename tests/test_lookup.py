@@ -0,0 +1,47 @@
+import pytest
+
+import engine
+import lookup
+
+# ==============================================================================
+# 条文の直接表示（lookup）：条文を引くだけの質問だけを近道に通す
+# ==============================================================================
+
+
+@pytest.mark.parametrize("prompt, expected", [
+    ("第23条第5項を全文で", [("ijime_act", 23, 5)]),
+    ("第23条を見せてください", [("ijime_act", 23, None)]),
+    ("いじめ防止対策推進法第28条", [("ijime_act", 28, None)]),
+    ("重大事態の定義は？", [("ijime_act", 28, 1)]),
+])
+def test_plain_lookups_are_detected(prompt, expected):
+    found = lookup.detect(prompt)
+    assert [(p.doc_id, p.article, p.paragraph) for p in found] == expected
+
+
+@pytest.mark.parametrize("prompt", [
+    "第23条違反では？",
+    "第23条違反？",
+    "第28条該当ですか",
+    "第28条適用？",
+    "第23条の義務",
+    "重大事態に該当しますか",
+    "いじめ",
+])
+def test_questions_about_the_situation_go_to_the_ai(prompt):
+    # 条文番号があっても、違反・該当・適用などの判断を求める質問は近道に通さない
+    assert lookup.detect(prompt) is None
+
+
+def _done(session, prompt):
+    events = list(engine.run_turn(session, prompt, stream=False))
+    assert events[-1].kind == "done"
+    return events[-1].data
+
+
+def test_follow_up_lookup_goes_to_the_ai():
+    session = engine.Session()
+    assert _done(session, "第23条を見せてください")["local"]
+    # それまでのやり取りがある会話では、同じ言い回しでも状況に当てはめる質問としてAIに任せる
+    _done(session, "担任が相談に応じてくれない")
+    assert not _done(session, "第23条を見せてください")["local"]
@@ -0,0 +1,26 @@
+import spreadsheet
+from tokens import estimate_tokens
+
+# ==============================================================================
+# 表データのまとめ（spreadsheet）が予算を守るか
+# ==============================================================================
+
+
+def _csv(columns, rows):
+    lines = [",".join(f"項目{c}" for c in range(columns))]
+    lines += [",".join(f"値{r}-{c}" for c in range(columns)) for r in range(rows)]
+    return "\n".join(lines).encode("utf-8")
+
+
+def test_small_table_is_kept_whole():
+    text = spreadsheet.summarize_table(_csv(2, 3), "text/csv", budget=6000)
+    assert "値2-1" in text
+    assert "以下省略" not in text
+
+
+def test_column_profiles_count_against_budget():
+    # 列の概要だけで予算を超える表でも、全体を予算内に収めて省略を明記する
+    text = spreadsheet.summarize_table(_csv(60, 100), "text/csv", budget=300)
+    assert estimate_tokens(text) <= 300
+    assert text.startswith("■シート「CSV」")
+    assert text.endswith("行分のまとめを省きました）")
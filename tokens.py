@@ -0,0 +1,24 @@
+# ==============================================================================
+# トークン数の概算（APIを呼ばずにローカルで見積もる）
+# ==============================================================================
+
+# 画像・音声のおおよそのトークン数
+IMAGE_TOKENS = 258
+AUDIO_BYTES_PER_TOKEN = 500
+
+
+def estimate_tokens(text):
+    """日本語は1文字≒1トークン、英数字は4文字≒1トークンとして概算する。"""
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def estimate_part_tokens(part):
+    if isinstance(part, str):
+        return estimate_tokens(part)
+    if isinstance(part, dict) and "data" in part and not part.get("mime_type", "").startswith("image"):
+        return len(part["data"]) // AUDIO_BYTES_PER_TOKEN + 1
+    if getattr(part, "size_bytes", None):
+        # File API でアップロード済みのファイル（音声の区間など）
+        return part.size_bytes // AUDIO_BYTES_PER_TOKEN + 1
+    return IMAGE_TOKENS
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# ==============================================================================
+# 共有のワーカープール
+# PDF・表の解析（CPU処理）はプロセス、写真・音声の読み書き（I/O）はスレッドで動かす。
+# 画面から受け付けた分析（jobs.py）は、それとは別のスレッドのプールで動かす。
+# プールはプロセス全体で1つずつだけ作り、全セッションで使い回す。
+# ==============================================================================
+
+_process_pool = None
+_thread_pool = None
+_job_pool = None
+_lock = threading.Lock()
+
+
+def process_pool():
+    # multiprocessing は最初にプロセスが必要になったときに読み込む（起動を速くするため）
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    global _process_pool
+    with _lock:
+        # 作業プロセスが異常終了したプールは以後使えないので作り直す
+        if _process_pool is None or getattr(_process_pool, "_broken", False):
+            # Streamlit はスレッドで動くので fork ではなく spawn で起動する
+            _process_pool = ProcessPoolExecutor(
+                max_workers=config.PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def thread_pool():
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(
+                max_workers=config.ATTACHMENT_THREADS,
+                thread_name_prefix="attachment"
+            )
+        return _thread_pool
+
+
+def job_pool():
+    global _job_pool
+    with _lock:
+        if _job_pool is None:
+            _job_pool = ThreadPoolExecutor(
+                max_workers=config.JOB_WORKERS,
+                thread_name_prefix="job"
+            )
+        return _job_pool